@@ -0,0 +1,263 @@
+"""Benchmark the preprocessing stages on synthetic phantoms (see phantom.py)
+
+    For each phantom size, a 4D phantom is generated and each stage is timed:
+        split_whole - process_nifti.convert_4D_to_3D (whole 4D volume loaded at once)
+        split     - process_nifti.convert_4D_to_3D (streaming mode)
+        average   - geometric_averages.compute_geometric_averages of the split files
+        mask      - create_masks.process_b0_image of b0_averaged.nrrd
+        convert   - svtools.svconvert_batch of all averaged .nrrd files to .nii.gz
+        pipeline  - pipeline.run_pipeline (split + average + mask in a single pass)
+
+    Each stage is run '--repeat' times - the fastest and the median run are reported. Peak memory of a stage is measured in one additional run with tracemalloc (python and numpy allocations - memory allocated inside SimpleITK / opencv is not included). The quality of the mask is checked against the ground truth body of the phantom (Dice score).
+
+    Results are printed and optionally saved to a .json report. With '--baseline', results are compared to a stored baseline, and the script exits with an error code if any stage is slower than the baseline by more than '--tolerance' (relative - both the fastest and the median run, and by more than '--time_floor' seconds), uses more memory by more than '--memory_tolerance' (and by more than '--memory_floor' MB - stages with near-zero peaks are not flagged for tiny differences), or if the Dice score dropped. Use '--save_baseline' to store the current results as a new baseline (baselines are machine specific - keep one per machine).
+
+    Usage:
+        python benchmark.py
+        python benchmark.py --sizes 128x20 256x40 --directions 6 --repeat 3 --report benchmark.json
+        python benchmark.py --save_baseline benchmark_baseline.json
+        python benchmark.py --baseline benchmark_baseline.json --tolerance 0.25
+
+"""
+
+import argparse
+import os
+import io
+import sys
+import glob
+import json
+import time
+import shutil
+import platform
+import tempfile
+import tracemalloc
+import contextlib
+
+import numpy as np
+
+import svtools as sv
+import process_nifti as pn
+import geometric_averages as ga
+import create_masks as cm
+import pipeline
+import maskio
+import phantom
+
+
+STAGES = ['split_whole', 'split', 'average', 'mask', 'convert', 'pipeline']
+
+
+def load_args():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes',type=str,nargs='+',default=['128x20','256x40'],help='phantom sizes as <matrix>x<slices>')
+    parser.add_argument('--bvals',type=int,nargs='+',default=[0,50,100,200,400,600],help='b-values of the phantom')
+    parser.add_argument('--directions',type=int,default=6,help='number of diffusion directions of each b-value')
+    parser.add_argument('--stages',type=str,nargs='+',default=STAGES,choices=STAGES,help='stages to benchmark')
+    parser.add_argument('--repeat',type=int,default=5,help='number of timed runs of each stage (fastest and median run are reported)')
+    parser.add_argument('--workdir',type=str,default=None,help='directory for phantoms and outputs (default - temporary directory, removed at the end)')
+    parser.add_argument('--report',type=str,default=None,help='path to .json file where results are saved')
+    parser.add_argument('--baseline',type=str,default=None,help='path to a baseline .json file - exit with an error if results regressed')
+    parser.add_argument('--save_baseline',type=str,default=None,help='path to .json file where results are saved as a new baseline')
+    parser.add_argument('--tolerance',type=float,default=0.2,help='allowed relative increase of time over the baseline')
+    parser.add_argument('--time_floor',type=float,default=0.05,help='time differences below this many seconds are never regressions')
+    parser.add_argument('--memory_tolerance',type=float,default=0.1,help='allowed relative increase of peak memory over the baseline')
+    parser.add_argument('--memory_floor',type=float,default=5,help='peak memory differences below this many MB are never regressions')
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+
+    # load input arguments
+    args = load_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="ivim_benchmark_")
+    try:
+        results = run_benchmark(args.sizes, args.bvals, args.directions, args.stages, args.repeat, workdir)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results)
+
+    for savename in [args.report, args.save_baseline]:
+        if savename:
+            with open(savename, 'w') as f:
+                json.dump(results, f, indent=4)
+            print(f"Saved results to: {savename}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if args.repeat < 3:
+            print(f"WARNING: times of {args.repeat} run(s) are noisy - use --repeat 3 or more to compare with a baseline")
+        regressions = compare(results, baseline, args.tolerance, args.memory_tolerance, args.time_floor, args.memory_floor)
+        if regressions:
+            print("\nREGRESSIONS:")
+            for r in regressions:
+                print("  " + r)
+            sys.exit(1)
+        print("\nNo regressions against baseline")
+
+
+def parse_size(size):
+
+    """'256x40' -> (256, 40)"""
+
+    matrix, slices = size.lower().split('x')
+    return int(matrix), int(slices)
+
+
+def measure(func, repeat=3):
+
+    """Time a function (`repeat` runs) and measure its peak memory (one extra run with tracemalloc). Output of the function is suppressed
+
+    Returns:
+        seconds (float): fastest run
+        median (float): median run
+        peak_mb (float)
+    """
+
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        try:
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    return min(times), float(np.median(times)), peak / 2**20
+
+
+def dice(mask, truth):
+
+    """Dice score of two boolean masks"""
+
+    return 2 * np.logical_and(mask, truth).sum() / max(mask.sum() + truth.sum(), 1)
+
+
+def benchmark_size(matrix, slices, bvals, directions, stages, repeat, workdir):
+
+    """Generate a phantom of a given size and benchmark each stage on it
+
+    Returns:
+        results (dict): stage -> {'time': seconds (fastest run), 'time_median': seconds, 'peak_mb': MB[, 'dice': float]}
+    """
+
+    # phantom
+    dirname = os.path.join(workdir, f"phantom_{matrix}x{slices}")
+    impath = os.path.join(dirname, "phantom.nii.gz")
+    with contextlib.redirect_stdout(io.StringIO()):
+        phantom.write_phantom(impath, matrix, slices, bvals, directions)
+    full_bvals = pn.get_bvector(impath.replace(".nii.gz", ".bval"))
+    truth = np.load(impath.replace(".nii.gz", "_truth.npz"))['body']
+
+    # separate output directories for the stage-by-stage chain and for the fused pipeline
+    splitdir = os.path.join(dirname, "split")
+    os.makedirs(splitdir, exist_ok=True)
+    splitpath = os.path.join(splitdir, "phantom.nii.gz")
+    shutil.copyfile(impath, splitpath)
+    outputdir = os.path.join(splitdir, "averaged") + "/"
+    os.makedirs(outputdir, exist_ok=True)
+
+    # every stage depends on the outputs of the previous ones - stages that are not benchmarked are still run once (split_whole writes the same files as split, which runs after it)
+    funcs = {'split_whole': lambda: pn.convert_4D_to_3D(splitpath, full_bvals, directions, stream=False),
+             'split': lambda: pn.convert_4D_to_3D(splitpath, full_bvals, directions, stream=True),
+             'average': lambda: ga.compute_geometric_averages(sorted(glob.glob(splitdir + "/b*#_*.nii.gz")), outputdir, overwrite=True),
+             'mask': lambda: cm.process_b0_image(outputdir + "b0_averaged.nrrd"),
+             'convert': lambda: sv.svconvert_batch([(f, ".nii.gz") for f in glob.glob(outputdir + "b*_averaged.nrrd")], verbose=False, skip_existing=False),
+             'pipeline': lambda: pipeline.run_pipeline(impath, full_bvals)}
+
+    results = {}
+    for stage in STAGES:
+        if stage not in stages:
+            if stage not in ['split_whole', 'pipeline']:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    funcs[stage]()
+            continue
+
+        seconds, median, peak_mb = measure(funcs[stage], repeat)
+        results[stage] = {'time': round(seconds, 4), 'time_median': round(median, 4), 'peak_mb': round(peak_mb, 2)}
+
+        # quality of the outputs
+        if stage in ['mask', 'pipeline']:
+            maskpath = outputdir + "mask.nrrd" if stage == 'mask' else os.path.join(dirname, "averaged", "mask.nrrd")
+            results[stage]['dice'] = round(float(dice(maskio.load_mask(maskpath), truth)), 4)
+
+        print(f"{matrix}x{slices} {stage}: {results[stage]}")
+
+    return results
+
+
+def run_benchmark(sizes, bvals, directions, stages=STAGES, repeat=3, workdir=None):
+
+    """Benchmark all stages for each phantom size
+
+    Args:
+        sizes (list): phantom sizes as '<matrix>x<slices>' strings
+        bvals (list): b-values of the phantom
+        directions (int): number of diffusion directions of each b-value
+        stages (list): stages to benchmark - see STAGES
+        repeat (int): number of timed runs of each stage
+        workdir (str): directory for phantoms and outputs
+    Returns:
+        results (dict): {'machine': {..}, 'config': {..}, 'sizes': {size: {stage: {'time', 'time_median', 'peak_mb', ['dice']}}}}
+    """
+
+    results = {'machine': {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+               'config': {'bvals': bvals, 'directions': directions, 'repeat': repeat},
+               'sizes': {}}
+
+    for size in sizes:
+        matrix, slices = parse_size(size)
+        results['sizes'][size] = benchmark_size(matrix, slices, bvals, directions, stages, repeat, workdir)
+
+    return results
+
+
+def print_results(results):
+
+    print(f"\n{'size':<10} {'stage':<12} {'time (s)':>10} {'median (s)':>11} {'peak (MB)':>10} {'dice':>8}")
+    for size, stages in results['sizes'].items():
+        for stage, r in stages.items():
+            print(f"{size:<10} {stage:<12} {r['time']:>10.3f} {r['time_median']:>11.3f} {r['peak_mb']:>10.1f} {r.get('dice', ''):>8}")
+
+
+def compare(results, baseline, tolerance=0.2, memory_tolerance=0.1, time_floor=0.05, memory_floor=5):
+
+    """Compare results to a baseline. Only sizes and stages present in both are compared
+
+    A stage is slower if its fastest and its median run (if the baseline has one) are both above the baseline by more than `tolerance` and by more than `time_floor` seconds. It uses more memory if its peak is above the baseline by more than `memory_tolerance` and by more than `memory_floor` MB
+
+    Returns:
+        regressions (list): description of each regression (empty if none)
+    """
+
+    regressions = []
+    for size, stages in results['sizes'].items():
+        for stage, r in stages.items():
+            b = baseline['sizes'].get(size, {}).get(stage)
+            if b is None:
+                continue
+            slower = [k for k in ['time', 'time_median'] if k in b and k in r]
+            if all(r[k] > b[k] * (1 + tolerance) and r[k] - b[k] > time_floor for k in slower):
+                regressions.append(f"{size} {stage}: time {r['time']:.3f}s > baseline {b['time']:.3f}s (+{100*tolerance:.0f}%)")
+            if r['peak_mb'] > b['peak_mb'] * (1 + memory_tolerance) and r['peak_mb'] - b['peak_mb'] > memory_floor:
+                regressions.append(f"{size} {stage}: peak memory {r['peak_mb']:.1f}MB > baseline {b['peak_mb']:.1f}MB (+{100*memory_tolerance:.0f}%)")
+            if 'dice' in b and r.get('dice', 0) < b['dice'] - 0.01:
+                regressions.append(f"{size} {stage}: mask dice {r.get('dice')} < baseline {b['dice']}")
+
+    return regressions
+
+
+if __name__=='__main__':
+
+    main()
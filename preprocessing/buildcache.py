@@ -0,0 +1,245 @@
+"""Content-hashed incremental build cache for preprocessing stages
+
+    Each stage (e.g. 'split', 'average', 'mask') is identified by a key - a hash of the CONTENT of its input files and of its parameters (e.g. b-values, masktype, mask thresholds).
+    The key is recorded in a per-stage manifest (.buildcache/<stage>.json in the output directory) together with the stage outputs.
+    A stage is only rerun if its key changed (i.e. inputs or parameters changed) or if any of its outputs are missing / were modified.
+
+    Hashes of input files are reused from the manifest if file size and modification time have not changed, so unchanged inputs are not re-read.
+
+    Optionally, outputs can also be kept in a shared content-addressed store (a directory that can be shared between reruns, branches and subjects). If a stage with the same key was ever computed, its outputs are copied from the store instead of being recomputed. The store is bounded in size - least recently used entries are evicted first.
+
+    Usage (from python):
+
+        import buildcache as bc
+        bc.cached_stage('mask', inputs=[b0path], params={'masktype': 'improved'}, outputs=[maskpath], run=lambda: process_b0_image(b0path), manifest_dir=outputdir)
+
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+
+
+MANIFEST_DIR = ".buildcache"
+
+
+# -----------
+# Hashing
+# -----------
+
+def file_hash(path, chunksize=1<<22):
+
+    """Hash the content of a file"""
+
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunksize), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def file_stat(path):
+
+    """Size and modification time of a file - used to detect changes without reading the file"""
+
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+def input_hashes(inputs, manifest=None):
+
+    """Get content hashes of input files. Hashes recorded in `manifest` are reused if the file has not changed (same size and modification time)"""
+
+    recorded = manifest.get('inputs', {}) if manifest else {}
+    hashes = {}
+    for path in inputs:
+        path = os.path.abspath(path)
+        stat = file_stat(path)
+        if path in recorded and recorded[path]['stat'] == stat:
+            hashes[path] = recorded[path]
+        else:
+            hashes[path] = {'stat': stat, 'hash': file_hash(path)}
+    return hashes
+
+def stage_key(stage, hashes, params):
+
+    """Key of a stage: hash of the stage name, content of the inputs (order matters, paths do not) and stage parameters"""
+
+    content = {'stage': stage,
+               'inputs': [h['hash'] for h in hashes.values()],
+               'params': params}
+    return hashlib.blake2b(json.dumps(content, sort_keys=True, default=str).encode(), digest_size=20).hexdigest()
+
+
+# -----------
+# Per-stage manifest
+# -----------
+
+def manifest_path(manifest_dir, stage):
+    return os.path.join(manifest_dir, MANIFEST_DIR, stage + ".json")
+
+def read_manifest(manifest_dir, stage):
+
+    path = manifest_path(manifest_dir, stage)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def write_manifest(manifest_dir, stage, key, hashes, params, outputs):
+
+    path = manifest_path(manifest_dir, stage)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    manifest = {'key': key,
+                'params': params,
+                'inputs': hashes,
+                'outputs': {os.path.abspath(o): file_stat(o) for o in outputs}}
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2, default=str)
+
+def is_current(manifest, key, outputs):
+
+    """Check if a stage is up to date: same key and all outputs exist unchanged since they were recorded"""
+
+    if manifest is None or manifest['key'] != key:
+        return False
+    recorded = manifest['outputs']
+    for o in outputs:
+        o = os.path.abspath(o)
+        if not os.path.exists(o) or recorded.get(o) != file_stat(o):
+            return False
+    return True
+
+
+# -----------
+# Shared content-addressed store
+# -----------
+
+def copy_atomic(src, dst):
+
+    """Copy a file to a temporary name next to `dst`, then rename it to `dst` - `dst` is never partially written"""
+
+    tmp = dst + ".tmp" + str(os.getpid())
+    try:
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def store_fetch(store, key, outputs):
+
+    """Copy outputs of a stage from the store (if present). Returns True if found
+
+    The entry may be evicted by another process during the copy - this is treated as a miss (outputs that were already copied are complete files, but no manifest is written for them)
+    """
+
+    entry = os.path.join(store, key)
+    if not all(os.path.exists(os.path.join(entry, os.path.basename(o))) for o in outputs):
+        return False
+    try:
+        # mark as recently used first, so that the entry is the last to be evicted while it is copied
+        os.utime(entry)
+        for o in outputs:
+            copy_atomic(os.path.join(entry, os.path.basename(o)), o)
+    except FileNotFoundError:
+        return False
+    return True
+
+def store_put(store, key, outputs, max_size=None):
+
+    """Add outputs of a stage to the store, then evict least recently used entries if the store is larger than `max_size` (bytes)"""
+
+    entry = os.path.join(store, key)
+    try:
+        os.utime(entry)
+    except FileNotFoundError:
+        # copy to a temporary directory first and publish it with a single rename, so that partially written entries are never used
+        tmp = entry + ".tmp" + str(os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        try:
+            for o in outputs:
+                shutil.copyfile(o, os.path.join(tmp, os.path.basename(o)))
+            os.replace(tmp, entry)
+        except OSError:
+            # same entry was added by another process in the meantime (os.replace does not replace a non-empty directory)
+            if not os.path.isdir(entry):
+                raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    if max_size is not None:
+        evict(store, max_size)
+
+def entry_size(entry):
+    return sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+
+def evict(store, max_size):
+
+    """Remove least recently used entries until the store is smaller than `max_size` (bytes). Entries removed by another process in the meantime are skipped"""
+
+    entries, sizes = [], {}
+    for e in os.listdir(store):
+        e = os.path.join(store, e)
+        if ".tmp" in e:
+            continue
+        try:
+            mtime, size = os.path.getmtime(e), entry_size(e)
+        except FileNotFoundError:
+            continue
+        entries.append((mtime, e))
+        sizes[e] = size
+    total = sum(sizes.values())
+    for _, e in sorted(entries):
+        if total <= max_size:
+            break
+        shutil.rmtree(e, ignore_errors=True)
+        total -= sizes[e]
+        print(f"Evicted from cache store: {e}")
+
+
+# -----------
+# Run a stage
+# -----------
+
+def cached_stage(stage, inputs, params, outputs, run, manifest_dir, store=None, max_store_size=None):
+
+    """Run a stage only if its inputs or parameters changed
+
+    Args:
+        stage (str): name of the stage (e.g. 'average')
+        inputs (list): paths to input files
+        params (dict): stage parameters (must be json serializable)
+        outputs (list): paths to all output files of the stage
+        run (callable): function that computes the outputs
+        manifest_dir (str): directory where the stage manifest is kept (usually the output directory)
+        store (str): optional path to a shared content-addressed store
+        max_store_size (int): maximum size of the store in bytes (least recently used entries are evicted)
+    Returns:
+        ran (bool): True if the stage was (re)computed, False if up to date outputs were reused
+
+    """
+
+    manifest = read_manifest(manifest_dir, stage)
+    hashes = input_hashes(inputs, manifest)
+    key = stage_key(stage, hashes, params)
+
+    if is_current(manifest, key, outputs):
+        print(f"Stage '{stage}' is up to date, skipping")
+        return False
+
+    if store is not None and store_fetch(store, key, outputs):
+        print(f"Stage '{stage}' outputs copied from cache store")
+        write_manifest(manifest_dir, stage, key, hashes, params, outputs)
+        return False
+
+    start = time.time()
+    run()
+    write_manifest(manifest_dir, stage, key, hashes, params, outputs)
+    if store is not None:
+        os.makedirs(store, exist_ok=True)
+        store_put(store, key, outputs, max_store_size)
+    print(f"Stage '{stage}' computed in {time.time()-start:.1f}s")
+
+    return True
@@ -0,0 +1,218 @@
+"""Regression check of the masks of create_masks.py against the original implementation
+
+    create_masks.create_mask builds the mask as uint8, filters the slices in chunks (see create_masks.filter_slices) and removes small objects and fills small holes of all slices at once (see create_masks.remove_small_objects_2D). Masks must be exactly the same as those of the original implementation (baseline_create_mask - a verbatim copy: float mask, opencv filters on the whole stack, skimage.morphology applied to each slice in a loop). This script compares both:
+        1. on random boolean stacks - cleanup step only - objects and holes of all sizes around the thresholds, pixels that touch only diagonally
+        2. on b0 images of synthetic phantoms (see phantom.py) - whole masks of all mask types. One phantom has several chunks of slices (see create_masks.OPENCV_CHANNELS) - it repeats a smaller phantom, so that its noise threshold is the same and the original implementation (which opencv limits to one chunk of slices) runs on one repeat
+        3. on b0_averaged.nrrd of the given directories (optional - e.g. a few subjects of a real cohort, at most create_masks.OPENCV_CHANNELS slices)
+
+    The script exits with a non-zero code if any mask differs. scikit-image is only needed by this check - it is not a requirement of the pipeline (pip install scikit-image).
+
+    Usage:
+        python check_masks.py
+        python check_masks.py -d <directory> <directory> ...
+
+"""
+
+import argparse
+import os
+import sys
+import inspect
+import types
+
+import numpy as np
+import cv2
+from scipy import ndimage
+
+import svtools as sv
+import create_masks as cm
+import phantom
+
+
+def load_args():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--directories',type=str,nargs='+',default=[],help='directories with b0_averaged.nrrd (or averaged/b0_averaged.nrrd) to check as well')
+    parser.add_argument('--seed',type=int,default=0,help='random seed of the synthetic stacks')
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+
+    # load input args
+    args = load_args()
+
+    try:
+        import skimage
+    except ImportError:
+        sys.exit("scikit-image is required by this check: pip install scikit-image")
+    print(f"Comparing with scikit-image {skimage.__version__}")
+
+    results = []
+
+    # 1. cleanup step only
+    for name, stack, object_threshold, hole_threshold in random_stacks(args.seed):
+        results.append((name, np.count_nonzero(cleanup(stack, object_threshold, hole_threshold) != reference_cleanup(stack, object_threshold, hole_threshold))))
+        print_result(*results[-1])
+
+    # 2-3. whole masks
+    images = list(phantom_images(args.seed)) + [(d, b0_image(d), 1) for d in args.directories]
+    for name, im, repeats in images:
+        # the original implementation runs on one repeat - all steps after the noise threshold are applied to each slice separately
+        for masktype in ('improved', 'simple', 'dummy'):
+            reference = np.concatenate([baseline_create_mask(im, masktype)] * repeats, axis=2)
+            results.append((f"{name}, {masktype}", np.count_nonzero(cm.create_mask(np.concatenate([im] * repeats, axis=2), masktype) != reference)))
+            print_result(*results[-1])
+
+    different = sum(n > 0 for _, n in results)
+    print(f"Checked {len(results)} cases: {len(results) - different} identical, {different} different")
+    if different:
+        sys.exit(1)
+
+
+def print_result(name, n):
+    print(f"{'OK' if n == 0 else 'DIFFERENT'}: {name}" + (f" ({n} voxels)" if n else ""))
+
+
+def cleanup(stack, object_threshold, hole_threshold):
+
+    """Step 5 of create_mask - small objects and small holes of each slice removed at once"""
+
+    cleaned = cm.remove_small_objects_2D(stack, object_threshold)
+    return ~cm.remove_small_objects_2D(~cleaned, hole_threshold)
+
+
+def skimage_morphology():
+
+    """remove_small_objects / remove_small_holes of scikit-image with the behaviour of scikit-image 0.17 (version of the original implementation) - objects and holes smaller than the threshold are removed
+
+    Since scikit-image 0.26 sizes are given as `max_size` (largest size that is removed) - the deprecated min_size / area_threshold also remove objects of exactly the threshold size, unlike 0.17
+    """
+
+    from skimage import morphology
+
+    if 'max_size' not in inspect.signature(morphology.remove_small_objects).parameters:
+        return morphology
+    return types.SimpleNamespace(remove_small_objects=lambda ar, min_size: morphology.remove_small_objects(ar, max_size=min_size - 1),
+                                 remove_small_holes=lambda ar, area_threshold: morphology.remove_small_holes(ar, max_size=area_threshold - 1))
+
+
+def reference_cleanup(stack, object_threshold, hole_threshold):
+
+    """Step 5 of the original create_mask - scikit-image, one slice at a time"""
+
+    morphology = skimage_morphology()
+    out = np.zeros_like(stack)
+    for sl in range(stack.shape[-1]):
+        cleaned = morphology.remove_small_objects(stack[:,:,sl], min_size=object_threshold)
+        out[:,:,sl] = morphology.remove_small_holes(cleaned, area_threshold=hole_threshold)
+    return out
+
+
+def baseline_create_mask(im, masktype='improved'):
+
+    """Original create_masks.create_mask - verbatim (apart from the scikit-image import - see skimage_morphology). opencv accepts at most create_masks.OPENCV_CHANNELS slices"""
+
+    morphology = skimage_morphology()
+
+    if masktype=='improved':
+    
+        # IMPROVED MASKING PROCESS
+        # 1. Measure noise in the corners of the image
+        # 2. Mask image by mean of noise (as threshold)
+        # 3. Erode + Dilate 
+        # 4. Add median blur to remove sharp edges
+        # 5. Remove small objects + Remove small holes 
+
+        # 1. Measure noise in the corners of the image
+        corners = im[0:20,0:20,:]+im[-20:,-20:,:]   #+ref_im[-20:,0:20,:]+ref_im[0:20,-20:,:] -> not so great 
+        threshold = np.mean(corners)#+np.std(corners)
+
+        # 2. Mask image by mean of noise (as threshold)
+        mask = np.zeros_like(im)
+        mask[im>threshold] = 1 
+
+        # 3. Erode + Dilate     
+        kernel_erode = np.ones((3,3), np.uint8) 
+        kernel_dilate = np.ones((3,3), np.uint8) 
+        img_erosion = cv2.erode(mask, kernel_erode, iterations=1) 
+        img_dilation = cv2.dilate(img_erosion, kernel_dilate, iterations=1) 
+
+        # 4. Add median blur to remove sharp edges
+        img_dilation = cv2.medianBlur(img_dilation,5)
+
+        # 5. Remove small objects + Remove small holes 
+        small_object_threshold = 2000 
+        small_hole_threshold = 1000
+        # NB must be done for each slice separately (else doesn't work)
+        slices = img_dilation.shape[-1]
+        for sl in range(0,slices): 
+            im = img_dilation[:,:,sl]    
+            arr = im > 0
+            cleaned = morphology.remove_small_objects(arr, min_size=small_object_threshold)  # threshold 
+            cleaned = morphology.remove_small_holes(cleaned, area_threshold=small_hole_threshold) # source https://stackoverflow.com/questions/55056456/failed-to-remove-noise-by-remove-small-objects    
+            # put back into the mask
+            mask[:,:,sl] = cleaned.astype(mask.dtype)
+    
+    elif masktype=='simple':
+        threshold = 25
+        
+        mask = np.zeros_like(im)
+        mask[im>threshold] = 1 
+
+    elif masktype=='dummy':
+        mask = np.ones_like(im)
+        
+    else: 
+        sys.exit('mask type not recognised. Please supply correct mask type')
+    
+    return mask 
+
+
+def random_stacks(seed=0):
+
+    """Random boolean stacks (x,y,slices) and thresholds - noise of different densities and smooth blobs
+
+    Yields:
+        (name, stack, object_threshold, hole_threshold)
+    """
+
+    rng = np.random.default_rng(seed)
+    for density in (0.2, 0.45, 0.6, 0.8):
+        for thresholds in ((2, 2), (5, 10), (40, 20)):
+            yield (f"noise {density}, thresholds {thresholds}", rng.random((64, 64, 8)) < density, *thresholds)
+    for sigma in (4, 8):
+        blobs = ndimage.gaussian_filter(rng.random((256, 256, 8)), (sigma, sigma, 0))
+        for q in (40, 60):
+            stack = blobs > np.percentile(blobs, q)
+            yield f"blobs sigma {sigma}, {100 - q}% foreground", stack, cm.MASK_PARAMS['small_object_threshold'], cm.MASK_PARAMS['small_hole_threshold']
+
+
+def phantom_images(seed=0):
+
+    """b0 images (first volume, float32 as b0_averaged.nrrd) of synthetic phantoms - several matrix sizes and noise levels
+
+    Yields:
+        (name, im, repeats): the image that is checked is `im` repeated `repeats` times along the slices
+    """
+
+    for matrix, slices, noise, repeats in ((128, 6, 20., 1), (192, 6, 60., 1), (256, 6, 120., 1), (128, 100, 40., 3)):
+        data, _, _, _ = phantom.make_phantom(matrix=matrix, slices=slices, bvals=(0,), directions=1, noise=noise, seed=seed)
+        yield f"phantom {matrix}x{matrix}x{slices * repeats}, noise {noise:g}", data[..., 0].astype(np.float32), repeats
+
+
+def b0_image(directory):
+
+    """b0_averaged.nrrd of a directory - same lookup as create_masks.process_dir"""
+
+    b0path = os.path.join(directory, "averaged", "b0_averaged.nrrd")
+    if not os.path.exists(b0path):
+        b0path = os.path.join(directory, "b0_averaged.nrrd")
+    im, _ = sv.read_image(b0path)
+    return im
+
+
+if __name__ == '__main__':
+
+    main()
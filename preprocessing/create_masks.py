@@ -4,10 +4,20 @@ The mask is based on estimation of noise thresholds in the image and ensures tha
 
 Mask is saved into the same folder as 'b0_averaged.nrrd' image. In default case this would be '/averaged/' folder
 
+Mask is stored as uint8. Use '--packed' to also write a bit-packed copy of the mask (mask_packed.npz - see maskio.py). Use maskio.load_mask to read either file as a boolean array (or as indices of voxels inside the mask). 
+
 Please specify path to directory(-ies) where a '/averaged/b0_averaged.nrrd' file exists.
 
 Usage: 
     python create_masks.py -d <directory>
+    python create_masks.py -d <directory> --cache 
+    python create_masks.py -d <directory> --packed 
+    python create_masks.py -d <directory> --instrument 
+    python create_masks.py -d <directory> --memory_budget 256 
+
+Use '--cache' to skip directories where b0_averaged.nrrd and mask parameters have not changed since the mask was last created (see buildcache.py). 
+
+Use '--memory_budget <MB>' to create the mask in slabs of slices that fit into the budget (see slabs.py). The noise threshold is measured over all slices first, and all remaining steps are applied to each slice separately - so the mask is the same as the mask of the whole volume. 
 
 """
 
@@ -19,12 +29,25 @@ import argparse
 import numpy as np 
 import nrrd 
 import cv2
-from skimage import morphology
+from scipy import ndimage
+
+import svtools as sv
+import buildcache as bc 
+import maskio 
+import instrument 
+import slabs 
 
 def load_args():
     
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--directories',type=str,nargs='+', required = True, help='full paths to directories to be processed')
+    parser.add_argument('--masktype',type=str,default='improved',choices=['improved','simple','dummy'],help='type of mask to create')
+    parser.add_argument('--packed',action="store_true",help='if used, a bit-packed copy of the mask is also saved (mask_packed.npz)')
+    parser.add_argument('--cache',action="store_true",help='if used, the mask is only recomputed if b0_averaged.nrrd or mask parameters changed')
+    parser.add_argument('--cache_store',type=str,default=None,help='optional path to a shared content-addressed cache store')
+    parser.add_argument('--cache_store_size',type=float,default=None,help='maximum size of the cache store in GB')
+    parser.add_argument('--instrument',action="store_true",help='if used, timings, memory and bytes read / written are saved to instrument_mask.json next to the mask (see instrument.py)')
+    parser.add_argument('--memory_budget',type=float,default=None,help='if used, the mask is created in slabs of slices that fit into this many MB')
     args = parser.parse_args()
     
     return args
@@ -59,12 +82,25 @@ def process_dir(args,path):
     assert os.path.exists(b0path), f"No b0_averaged.nrrd file found. Please ensure that b0_averaged.nrrd exists in the supplied directory or in the subfolder /averaged/ of this same directory"
     
     # create and save mask
-    process_b0_image(b0path, maskname = 'mask.nrrd', masktype='improved')
+    maskpath = b0path.replace("b0_averaged.nrrd", 'mask.nrrd')
+    outputs = [maskpath, maskio.sidecar_path(maskpath)] if args.packed else [maskpath]
+    if args.instrument: 
+        instrument.start(os.path.abspath(path))
+    with instrument.stage('mask', inputs=[b0path], outputs=outputs): 
+        if args.cache: 
+            params = dict(MASK_PARAMS, masktype=args.masktype)
+            max_store_size = int(args.cache_store_size*1e9) if args.cache_store_size else None
+            bc.cached_stage('mask', [b0path], params, outputs, lambda: process_b0_image(b0path, maskname = 'mask.nrrd', masktype=args.masktype, packed=args.packed, memory_budget=args.memory_budget), os.path.dirname(b0path), args.cache_store, max_store_size)
+        else: 
+            process_b0_image(b0path, maskname = 'mask.nrrd', masktype=args.masktype, packed=args.packed, memory_budget=args.memory_budget)
+    instrument.finish(os.path.join(os.path.dirname(b0path), "instrument_mask.json"))
     
     
-def process_b0_image(b0path, maskname = 'mask.nrrd', masktype="improved"):
-    """Given a b0 image, create a mask"""
+def process_b0_image(b0path, maskname = 'mask.nrrd', masktype="improved", packed=False, memory_budget=None):
+    """Given a b0 image, create a mask (uint8). If `packed` - also save a bit-packed copy of the mask. If `memory_budget` (MB) - create the mask in slabs (see mask_slabs)"""
     
+    if memory_budget is not None: 
+        return mask_slabs(b0path, b0path.replace("b0_averaged.nrrd", maskname), masktype, packed, memory_budget)
 
     # get directory name 
     dirname = os.path.dirname(b0path) + "/"
@@ -77,13 +113,62 @@ def process_b0_image(b0path, maskname = 'mask.nrrd', masktype="improved"):
 
     # save mask 
     savename = b0path.replace("b0_averaged.nrrd", maskname) 
-    nrrd.write(savename, mask, header=hdr)
+    with sv.atomic_write(savename) as tmp: 
+        nrrd.write(tmp, mask, header=hdr)
+    if packed: 
+        maskio.write_packed(mask, maskio.sidecar_path(savename))
     
     print(f"Saved mask to: {savename}")
 
 
 
-def create_mask(im, masktype='improved'):
+# default parameters of the mask 
+MASK_PARAMS = {'corner_size': 20,               # size of the (square) image corners used to measure noise 
+               'kernel_size': 3,                # erode / dilate kernel 
+               'median_size': 5,                # median blur kernel 
+               'small_object_threshold': 2000,  # objects smaller than this (in pixels, per slice) are removed 
+               'small_hole_threshold': 1000,    # holes smaller than this (in pixels, per slice) are filled 
+               'simple_threshold': 25}          # intensity threshold of the 'simple' mask 
+
+# largest number of slices that opencv filters in one call (channels - CV_CN_MAX of opencv 5)
+OPENCV_CHANNELS = 128 
+
+def scale_mask_params(factor, params=MASK_PARAMS): 
+    
+    """Mask parameters for an image downsampled in-plane by `factor` (e.g. every 4th voxel - see preview.py)
+    
+    Sizes (in pixels) are divided by `factor`, areas (in pixels per slice) by `factor`**2. Kernels stay odd - a median size of 1 skips the median blur. Intensity thresholds are not changed. 
+    """
+    
+    # nearest odd size 
+    odd = lambda size: max(1, 2 * int(round((size / factor - 1) / 2)) + 1)
+    return dict(params, 
+                corner_size=max(2, int(round(params['corner_size'] / factor))), 
+                kernel_size=odd(params['kernel_size']), 
+                median_size=odd(params['median_size']), 
+                small_object_threshold=max(1, int(round(params['small_object_threshold'] / factor**2))), 
+                small_hole_threshold=max(1, int(round(params['small_hole_threshold'] / factor**2))))
+
+def corner_sum(im, corner_size=20): 
+    
+    """Sum of two opposite (square) corners of each slice - noise samples of the image"""
+    
+    return im[0:corner_size,0:corner_size,:]+im[-corner_size:,-corner_size:,:]   #+ref_im[-20:,0:20,:]+ref_im[0:20,-20:,:] -> not so great 
+
+def create_mask(im, masktype='improved', threshold=None, **params):
+    
+    """Create mask of an image (b0). Returns a uint8 mask (0 - background, 1 - foreground)
+    
+    Args: 
+        im (np.ndarray): 3D image (x,y,slices) 
+        masktype (str): 'improved', 'simple' (threshold only) or 'dummy' (all ones) 
+        threshold (float): noise threshold of the 'improved' mask - if None, it is measured in the corners of `im` (given when `im` is a slab of a larger image - see mask_slabs)
+        params: parameters of the mask that differ from MASK_PARAMS (e.g. kernel_size=5) - all other parameters are taken from MASK_PARAMS, which is also the cache key of the mask 
+    """
+    
+    unknown = set(params) - set(MASK_PARAMS)
+    assert not unknown, f"Unknown mask parameters: {unknown}"
+    params = dict(MASK_PARAMS, **params)
     
     if masktype=='improved':
     
@@ -95,43 +180,36 @@ def create_mask(im, masktype='improved'):
         # 5. Remove small objects + Remove small holes 
 
         # 1. Measure noise in the corners of the image
-        corners = im[0:20,0:20,:]+im[-20:,-20:,:]   #+ref_im[-20:,0:20,:]+ref_im[0:20,-20:,:] -> not so great 
-        threshold = np.mean(corners)#+np.std(corners)
+        if threshold is None: 
+            threshold = np.mean(corner_sum(im, params['corner_size']))#+np.std(corners)
 
-        # 2. Mask image by mean of noise (as threshold)
-        mask = np.zeros_like(im)
-        mask[im>threshold] = 1 
+        # 2. Mask image by mean of noise (as threshold) - uint8 mask 
+        mask = (im>threshold).view(np.uint8)
 
-        # 3. Erode + Dilate     
-        kernel_erode = np.ones((3,3), np.uint8) 
-        kernel_dilate = np.ones((3,3), np.uint8) 
-        img_erosion = cv2.erode(mask, kernel_erode, iterations=1) 
-        img_dilation = cv2.dilate(img_erosion, kernel_dilate, iterations=1) 
+        # 3. Erode + Dilate (opencv treats slices as channels, i.e. each slice is processed separately)
+        kernel_erode = np.ones((params['kernel_size'],params['kernel_size']), np.uint8) 
+        kernel_dilate = np.ones((params['kernel_size'],params['kernel_size']), np.uint8) 
+        img_erosion = filter_slices(cv2.erode, mask, kernel_erode, iterations=1) 
+        img_dilation = filter_slices(cv2.dilate, img_erosion, kernel_dilate, iterations=1) 
 
         # 4. Add median blur to remove sharp edges
-        img_dilation = cv2.medianBlur(img_dilation,5)
+        if params['median_size'] > 1: 
+            img_dilation = filter_slices(cv2.medianBlur, img_dilation, params['median_size'])
 
         # 5. Remove small objects + Remove small holes 
-        small_object_threshold = 2000 
-        small_hole_threshold = 1000
-        # NB must be done for each slice separately (else doesn't work)
-        slices = img_dilation.shape[-1]
-        for sl in range(0,slices): 
-            im = img_dilation[:,:,sl]    
-            arr = im > 0
-            cleaned = morphology.remove_small_objects(arr, min_size=small_object_threshold)  # threshold 
-            cleaned = morphology.remove_small_holes(cleaned, area_threshold=small_hole_threshold) # source https://stackoverflow.com/questions/55056456/failed-to-remove-noise-by-remove-small-objects    
-            # put back into the mask
-            mask[:,:,sl] = cleaned.astype(mask.dtype)
+        # NB must be done for each slice separately (else doesn't work) - all slices are labelled at once with a 2D connectivity structure
+        cleaned = remove_small_objects_2D(img_dilation > 0, params['small_object_threshold'])
+        cleaned = ~remove_small_objects_2D(~cleaned, params['small_hole_threshold'])   # remove small holes. Source https://stackoverflow.com/questions/55056456/failed-to-remove-noise-by-remove-small-objects    
+
+        mask = cleaned.view(np.uint8)
     
     elif masktype=='simple':
-        threshold = 25
+        threshold = params['simple_threshold']
         
-        mask = np.zeros_like(im)
-        mask[im>threshold] = 1 
+        mask = (im>threshold).view(np.uint8)
 
     elif masktype=='dummy':
-        mask = np.ones_like(im)
+        mask = np.ones(im.shape, dtype=np.uint8)
         
     else: 
         sys.exit('mask type not recognised. Please supply correct mask type')
@@ -141,6 +219,68 @@ def create_mask(im, masktype='improved'):
     
     
 
+def mask_slabs(b0path, savename, masktype='improved', packed=False, memory_budget=256): 
+    
+    """Create a mask from b0_averaged.nrrd slab by slab - same mask as process_b0_image 
+    
+    b0 is read twice: first the corners of all slices (noise threshold of the whole image), then each slab is masked and written. 
+    If `packed`, the mask is read back to write the bit-packed copy (1 byte per voxel). 
+    """
+    
+    header = nrrd.read_header(b0path)
+    shape = tuple(header['sizes'])
+    
+    # per slice: b0 slab + uint8 / bool / int32 (labels) intermediates of create_mask 
+    size = slabs.slab_size(32 * shape[0] * shape[1], memory_budget, shape[2])
+    
+    # 1. noise threshold of the whole image (same array as in create_mask, so the mean is exactly the same)
+    threshold = None 
+    if masktype == 'improved': 
+        corners = [corner_sum(slab, MASK_PARAMS['corner_size']) for _, _, slab in slabs.nrrd_slabs(b0path, size)]
+        threshold = np.mean(np.concatenate(corners, axis=2))
+    
+    # 2. all other steps are slice by slice 
+    with sv.atomic_write(savename) as tmp, slabs.nrrd_writer(tmp, shape, np.uint8, header) as writer: 
+        for _, _, slab in slabs.nrrd_slabs(b0path, size): 
+            writer.write(create_mask(slab, masktype, threshold=threshold))
+    if packed: 
+        maskio.write_packed(maskio.load_mask(savename), maskio.sidecar_path(savename))
+    
+    print(f"Saved mask to: {savename}")
+    
+    return savename 
+
+def filter_slices(func, stack, *args, **kwargs):
+    
+    """Apply a 2D opencv filter to each slice of a (x,y,slices) stack 
+    
+    Opencv treats the last dimension as channels (filtered independently), but accepts a limited number of channels per call (512 in opencv 4, 128 in opencv 5) - slices are filtered in chunks of OPENCV_CHANNELS.
+    """
+    
+    out = np.empty_like(stack)
+    for s in range(0, stack.shape[-1], OPENCV_CHANNELS): 
+        chunk = np.ascontiguousarray(stack[:,:,s:s+OPENCV_CHANNELS])
+        out[:,:,s:s+OPENCV_CHANNELS] = func(chunk, *args, **kwargs).reshape(chunk.shape)
+    return out 
+
+def remove_small_objects_2D(arr, min_size):
+    
+    """Remove connected objects smaller than `min_size` pixels from each slice of a boolean (x,y,slices) stack 
+    
+    Equivalent to skimage.morphology.remove_small_objects (connectivity=1) applied to each slice separately. 
+    Objects are labelled in all slices at once - the structuring element connects pixels within a slice only. 
+    """
+    
+    structure = np.zeros((3,3,3), dtype=bool)
+    structure[:,:,1] = ndimage.generate_binary_structure(2, 1)
+    labels, _ = ndimage.label(arr, structure=structure)
+    sizes = np.bincount(labels.ravel())
+    too_small = sizes < min_size 
+    too_small[0] = False   # background 
+    
+    return arr & ~too_small[labels]
+
+
 if __name__ == '__main__':
 
     main()
@@ -0,0 +1,292 @@
+"""Convert a DWI DICOM series directly into 3D b-value volumes (b<bval>#_<dir>.nii.gz) or geometric averages - without the 4D nifti (dcm2niix + process_nifti.py)
+
+    The series directory must contain the DICOM files of a single DWI series, one slice per file (e.g. a directory sorted by sort_dicoms.py). Siemens mosaic and enhanced (multi-frame) DICOMs are not supported - use dcm2niix + process_nifti.py for these.
+
+    1. Headers of all files are read (no pixel data) and slices are grouped into 3D volumes by b-value and gradient direction (standard diffusion tags, or Siemens / GE / Philips private tags). Repeated acquisitions of the same b-value and direction become separate volumes.
+    2. Volumes are ordered by acquisition (instance number). b-values are optionally corrected against the protocol (b-values given to the scanner, one per volume in acquisition order) - e.g. low b-values that the scanner reports as 0 (see process_nifti.correct_bvals).
+    3. Volumes are read one at a time (slices of a volume in parallel) and either written as b<bval>#_<dir>.nii.gz (same naming as process_nifti.py), or geometrically averaged straight away (same output as geometric_averages.py - averaged/b<bval>_averaged.nrrd and averaged/bvalsFileNames_average.txt).
+
+    The b-value of each volume is also written to <output>/<name>.bval (after correction), so the output can be checked in the same way as the output of dcm2niix.
+
+    Usage:
+        python dicom_to_volumes.py -d <dicom series directory> -o <output directory>
+        python dicom_to_volumes.py -d <dicom series directory> -o <output directory> --protocol <protocol .txt file>
+        python dicom_to_volumes.py -d <dicom series directory> -o <output directory> --average --noabsolute
+        python dicom_to_volumes.py -d <dicom series directory> -o <output directory> --average --save_directions
+
+"""
+
+import argparse
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import nrrd
+import pydicom
+
+import svtools as sv
+import process_nifti as pn
+import geometric_averages as ga
+
+
+# diffusion tags with their value representation (private tags of implicit VR files are decoded with it): standard tags first, then vendor specific private tags
+BVAL_TAGS = [(0x00189087, 'FD'),    # DiffusionBValue
+             (0x0019100C, 'IS'),    # Siemens
+             (0x00431039, 'IS'),    # GE (first value)
+             (0x20011003, 'FL')]    # Philips
+GRADIENT_TAGS = [((0x00189089,), 'FD'),                         # DiffusionGradientOrientation
+                 ((0x0019100E,), 'FD'),                         # Siemens
+                 ((0x001910BB, 0x001910BC, 0x001910BD), 'DS'),  # GE
+                 ((0x200510B0, 0x200510B1, 0x200510B2), 'FL')]  # Philips
+
+# binary value representations -> little endian data type
+BINARY_VRS = {'FL': '<f4', 'FD': '<f8'}
+
+GEOMETRY_TAGS = ['ImagePositionPatient', 'ImageOrientationPatient', 'PixelSpacing', 'InstanceNumber', 'Rows', 'Columns']
+
+
+def load_args():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--directory',type=str, required = True, help='directory with the dicom files of a single DWI series')
+    parser.add_argument('-o', '--output',type=str, required = True, help='output directory')
+    parser.add_argument('--name',type=str,default='dwi',help='name of the .bval file written to the output directory')
+    parser.add_argument('--protocol',type=str,default=None,help='.txt file with the b-values given to the scanner (one per volume, in acquisition order) - reported b-values are checked and corrected against it')
+    parser.add_argument('--average',action="store_true",help='if used, volumes are geometrically averaged straight away (averaged/b<bval>_averaged.nrrd) instead of being written as 3D files')
+    parser.add_argument('--save_directions',action="store_true",help='if used with --average, 3D files (b<bval>#_<dir>.nii.gz) are written as well')
+    parser.add_argument('--noabsolute',action="store_true",help='if used, the paths of b-value files written to .txt files will be relative, not absolute')
+    parser.add_argument('--workers',type=int,default=os.cpu_count(),help='number of threads that read dicom files')
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+
+    # load input args
+    args = load_args()
+
+    assert os.path.isdir(args.directory), f"not a directory: {args.directory}"
+    os.makedirs(args.output, exist_ok=True)
+
+    protocol = pn.read_protocol(args.protocol) if args.protocol else None
+    filepaths_type = 'relative' if args.noabsolute else 'absolute'
+    convert_series(args.directory, args.output, protocol=protocol, average=args.average, save_directions=args.save_directions, filepaths_type=filepaths_type, name=args.name, workers=args.workers)
+
+
+def element_value(ds, tag, vr):
+
+    """Values of a (possibly private) tag as a list of floats (None if the tag is missing or empty). Private tags read with implicit VR are raw bytes - they are decoded according to `vr` ('IS', 'DS', 'FL' or 'FD')"""
+
+    elem = ds.get(tag)
+    if elem is None or elem.value is None or elem.value == b'' or elem.value == '':
+        return None
+    value = elem.value
+    if isinstance(value, bytes):
+        if vr in BINARY_VRS:
+            dtype = np.dtype(BINARY_VRS[vr])
+            value = np.frombuffer(value[:len(value)//dtype.itemsize*dtype.itemsize], dtype=dtype)
+        else:
+            value = value.decode(errors='replace').strip('\x00 ').split('\\')
+    if not isinstance(value, (list, tuple, np.ndarray, pydicom.multival.MultiValue)):
+        value = [value]
+    return [float(v) for v in value] or None
+
+
+def diffusion_info(ds):
+
+    """b-value and gradient direction of a slice (b-value is None and gradient is zero if not found)"""
+
+    bval = None
+    for tag, vr in BVAL_TAGS:
+        values = element_value(ds, tag, vr)
+        if values is not None:
+            # GE adds 10^9 to the b-value
+            bval = values[0] % 1e9 if tag == 0x00431039 else values[0]
+            break
+
+    gradient = np.zeros(3)
+    for tags, vr in GRADIENT_TAGS:
+        values = [element_value(ds, t, vr) for t in tags]
+        if all(v is not None for v in values):
+            gradient = np.array([v for value in values for v in value], dtype=np.float64)[:3]
+            break
+
+    return bval, gradient
+
+
+def read_header(path):
+
+    """Read the geometry and diffusion tags of a dicom slice - header only, without pixel data. Returns None for files that are not DWI slices (e.g. a localizer or a report in the series directory)"""
+
+    tags = GEOMETRY_TAGS + [t for t, _ in BVAL_TAGS] + [t for tags, _ in GRADIENT_TAGS for t in tags]
+    try:
+        ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=tags)
+    except pydicom.errors.InvalidDicomError:
+        return None
+    bval, gradient = diffusion_info(ds)
+    if bval is None or any(ds.get(tag) is None for tag in GEOMETRY_TAGS[:3] + GEOMETRY_TAGS[4:]):
+        return None
+
+    return {'file': path,
+            'bval': bval,
+            'gradient': gradient,
+            'position': np.array([float(v) for v in ds.ImagePositionPatient]),
+            'orientation': np.array([float(v) for v in ds.ImageOrientationPatient]),
+            'spacing': np.array([float(v) for v in ds.PixelSpacing]),
+            'instance': int(ds.get('InstanceNumber', 0) or 0),
+            'shape': (int(ds.Rows), int(ds.Columns))}
+
+
+def group_volumes(headers):
+
+    """Group slices into 3D volumes by b-value and gradient direction
+
+    Repeated acquisitions of the same b-value and gradient are split into separate volumes (n-th occurrence of each slice location belongs to the n-th volume).
+
+    Returns:
+        volumes (list): lists of slice headers (sorted along the slice normal), one list per volume, in acquisition order
+    """
+
+    # slice location along the normal of the slices
+    normal = np.cross(headers[0]['orientation'][:3], headers[0]['orientation'][3:])
+    for h in headers:
+        h['location'] = round(float(np.dot(h['position'], normal)), 3)
+    nslices = len({h['location'] for h in headers})
+
+    groups = {}
+    for h in sorted(headers, key=lambda h: h['instance']):
+        key = (round(h['bval'], 1), tuple(np.round(h['gradient'], 3)))
+        groups.setdefault(key, []).append(h)
+
+    volumes = []
+    for key, slices in groups.items():
+        occurrence = Counter()
+        repeats = {}
+        for h in slices:
+            repeats.setdefault(occurrence[h['location']], []).append(h)
+            occurrence[h['location']] += 1
+        for vol in repeats.values():
+            assert len(vol) == nslices, f"Incomplete volume (b={key[0]}, gradient={key[1]}): {len(vol)} of {nslices} slices"
+            volumes.append(sorted(vol, key=lambda h: h['location']))
+
+    # acquisition order
+    return sorted(volumes, key=lambda vol: min(h['instance'] for h in vol))
+
+
+def volume_affine(slices):
+
+    """Nifti (RAS) affine of a volume with data indexed as (column, row, slice)"""
+
+    first, last = slices[0], slices[-1]
+    row_dir, col_dir = first['orientation'][:3], first['orientation'][3:]
+    row_spacing, col_spacing = first['spacing']
+    if len(slices) > 1:
+        slice_step = (last['position'] - first['position']) / (len(slices) - 1)
+    else:
+        slice_step = np.cross(row_dir, col_dir)
+
+    # dicom patient coordinates are LPS
+    affine = np.eye(4)
+    affine[:3,0] = row_dir * col_spacing
+    affine[:3,1] = col_dir * row_spacing
+    affine[:3,2] = slice_step
+    affine[:3,3] = first['position']
+
+    return np.diag([-1, -1, 1, 1]) @ affine
+
+
+def read_slice(path):
+
+    """Pixel data of a slice as (column, row), with rescale slope / intercept applied (if not trivial)"""
+
+    ds = pydicom.dcmread(path)
+    data = ds.pixel_array.T
+    slope, inter = float(ds.get('RescaleSlope', 1) or 1), float(ds.get('RescaleIntercept', 0) or 0)
+    if slope != 1 or inter != 0:
+        data = data * np.float32(slope) + np.float32(inter)
+    return data
+
+
+def read_volume(slices, executor):
+
+    """Read all slices of a volume (in parallel) into a 3D array (x, y, slice)"""
+
+    return np.stack(list(executor.map(read_slice, [h['file'] for h in slices])), axis=-1)
+
+
+def convert_series(directory, outputdir, protocol=None, average=False, save_directions=False, filepaths_type='absolute', name='dwi', workers=None):
+
+    """Convert a DWI dicom series into 3D volumes (or geometric averages) in a single pass
+
+    Args:
+        directory (str): directory with the dicom files of a single DWI series
+        outputdir (str): output directory
+        protocol (list): b-values given to the scanner, one per volume in acquisition order (optional) - see process_nifti.correct_bvals
+        average (bool): if True, write geometric averages (<outputdir>/averaged/) instead of 3D files
+        save_directions (bool): if True (and average), also write 3D files
+        filepaths_type (str): 'absolute' or 'relative' paths in bvalsFileNames_average.txt
+        name (str): name of the .bval file
+        workers (int): number of threads that read dicom files
+    Returns:
+        bvals (list): b-value of each volume (after correction)
+    """
+
+    files = sorted(e.path for e in os.scandir(directory) if e.is_file())
+    with ThreadPoolExecutor(workers) as executor:
+
+        # 1. headers only
+        headers = list(executor.map(read_header, files))
+        skipped = [f for f, h in zip(files, headers) if h is None]
+        if skipped:
+            print(f"WARNING: skipped {len(skipped)} files without a b-value or image geometry (not DWI slices): " + ", ".join(os.path.basename(f) for f in skipped))
+        headers = [h for h in headers if h is not None]
+        assert headers, f"No DWI slices found in {directory}"
+        volumes = group_volumes(headers)
+        affine = volume_affine(volumes[0])
+        print(f"Found {len(volumes)} volumes of {len(volumes[0])} slices in {len(files)} files")
+
+        # 2. b-values
+        bvals = [int(round(vol[0]['bval'])) for vol in volumes]
+        if protocol is not None:
+            bvals = pn.correct_bvals([vol[0]['bval'] for vol in volumes], protocol)
+        with open(os.path.join(outputdir, name + ".bval"), 'w') as f:
+            f.write(' '.join(str(b) for b in bvals) + '\n')
+
+        # 3. read volumes one at a time
+        outputdir = outputdir + "/" if not outputdir.endswith("/") else outputdir
+        savenames = pn.get_savenames(outputdir, bvals)
+        acc, c, buf = {}, Counter(), None
+        for i, (vol, bvalnum) in enumerate(zip(volumes, bvals)):
+            data = read_volume(vol, executor)
+
+            if not average or save_directions:
+                pn.save_volume(data, affine, None, savenames[i])
+                print(savenames[i])
+
+            if average:
+                if bvalnum not in acc:
+                    acc[bvalnum] = np.zeros(data.shape, dtype=np.float32)
+                if buf is None:
+                    buf = np.empty(data.shape, dtype=np.float32)
+                ga.add_log(acc[bvalnum], data, buf)
+                c[bvalnum] += 1
+
+    # geometric averages
+    if average:
+        avgdir = outputdir + "averaged/"
+        os.makedirs(avgdir, exist_ok=True)
+        nrrd_header = sv.nifti2nrrd_header(affine)
+        for bvalnum in sorted(acc):
+            savename = avgdir + "b" + str(bvalnum) + "_averaged.nrrd"
+            nrrd.write(savename, ga.exp_mean(acc[bvalnum], c[bvalnum]), header=nrrd_header)
+            print(f"Averaged {c[bvalnum]} volumes: {savename}")
+        ga.write_bvalsFileNames_average(avgdir, sorted(acc), '.nrrd', filepaths_type, overwrite=True)
+
+    return bvals
+
+
+if __name__=='__main__':
+
+    main()
@@ -13,6 +13,8 @@ cd $savedir
 niidir=$scandir/nii
 mkdir $scandir/nii
 dcm2niix -o $scandir/nii/  $scandir
+# [alternatively, skip dcm2niix and process_nifti.py - convert the DICOMs straight into 3D b-value volumes (or geometric averages with --average), with b-values corrected against the protocol]
+# python dicom_to_volumes.py -d $scandir -o $scandir/volumes/ --protocol <protocol_bvals.txt> --average
 
 # Step 3 - check .bval files in each newly created `niidir` and correct the values manually if necessary 
 # [e.g. the new scanner labels all bvalues less than '50', as '0' in the .bval file and this needs to be corrected manually at this stage]
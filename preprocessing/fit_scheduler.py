@@ -0,0 +1,143 @@
+"""Process-parallel, voxel-chunked IVIM fitting with shared memory
+
+    The (voxels x b-values) signal matrix is placed in shared memory once (or read straight into it - see create_shared and ivim_fit.fit_dir). Worker processes fit contiguous chunks of voxels with any of the fitting methods in ivim_fit.FIT_METHODS (or any function with the same signature) and write results straight into shared parameter arrays - signals and results are never pickled.
+
+    Each chunk is fitted independently, so results do not depend on the number of workers or on the order in which chunks finish (for a fixed chunk size).
+
+    Usage:
+        python ivim_fit.py -d <directory> --method biexp --workers 16 --chunk_size 20000
+
+    or from python:
+
+        import fit_scheduler
+        params = fit_scheduler.fit_parallel(signals, bvals, method='biexp', workers=16)
+
+"""
+
+import os
+import sys
+import time
+from multiprocessing import Pool, shared_memory
+
+import numpy as np
+
+import ivim_fit as fit
+
+
+# shared arrays of the worker process (set by init_worker)
+_worker = {}
+
+
+def attach(name, shape, dtype=np.float64):
+
+    """Attach to an existing shared memory block and view it as an array"""
+
+    # the block is owned (and unlinked) by the parent process. Workers share the parent's resource tracker, so attaching does not change ownership
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def create_shared(shape):
+
+    """New float64 array in a shared memory block owned by the calling process (see release)
+
+    Returns:
+        shm (SharedMemory), array (np.ndarray)
+    """
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape))*8))
+    return shm, np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+
+
+def release(shm):
+
+    """Close and remove a shared memory block created by create_shared. Arrays that view the block must be deleted first"""
+
+    shm.unlink()
+    try:
+        shm.close()
+    except BufferError:
+        # a view is still referenced (e.g. by the traceback of an exception that is being raised) - the block is unmapped when it is garbage collected
+        pass
+
+
+def init_worker(signals_name, signals_shape, results_name, results_shape, bvals, method, kwargs):
+
+    """Attach shared signals and results in a worker process"""
+
+    _worker['signals_shm'], _worker['signals'] = attach(signals_name, signals_shape)
+    _worker['results_shm'], _worker['results'] = attach(results_name, results_shape)
+    _worker['bvals'] = bvals
+    _worker['method'] = fit.FIT_METHODS[method] if isinstance(method, str) else method
+    _worker['kwargs'] = kwargs
+
+
+def fit_chunk(chunk):
+
+    """Fit voxels [start, stop) and write parameters into the shared results"""
+
+    start, stop = chunk
+    params = _worker['method'](_worker['signals'][start:stop], _worker['bvals'], **_worker['kwargs'])
+    for i, p in enumerate(fit.PARAMS):
+        _worker['results'][i, start:stop] = params[p]
+
+    return stop - start
+
+
+def fit_parallel(signals, bvals, method='biexp', workers=None, chunk_size=10000, progress=True, signals_shm=None, **kwargs):
+
+    """Fit IVIM parameters of all voxels in a pool of worker processes
+
+    Args:
+        signals (np.ndarray): (n_voxels, n_bvals) signal matrix
+        bvals (np.ndarray): b-values
+        method (str or callable): name of a method in ivim_fit.FIT_METHODS, or a (picklable) function with the same signature
+        workers (int): number of worker processes (default - number of cpus)
+        chunk_size (int): number of voxels fitted by a worker at a time
+        progress (bool): print progress after each chunk
+        signals_shm (SharedMemory): block that `signals` already views (see create_shared) - signals are then used in place instead of being copied. The block remains owned by the caller
+        kwargs: passed to the fitting method
+    Returns:
+        params (dict): parameter arrays (one value per voxel) - see ivim_fit.PARAMS
+
+    """
+
+    n = len(signals)
+    workers = workers or os.cpu_count()
+    chunks = [(start, min(start+chunk_size, n)) for start in range(0, n, chunk_size)]
+
+    # shared input and output arrays - views of the blocks are deleted before the blocks are released (else close() raises BufferError)
+    own_signals = signals_shm is None
+    if own_signals:
+        signals_shm, shared_signals = create_shared(signals.shape)
+        shared_signals[:] = signals
+        del shared_signals
+    try:
+        results_shm, results = create_shared((len(fit.PARAMS), n))
+    except BaseException:
+        if own_signals:
+            release(signals_shm)
+        raise
+    try:
+        results[:] = np.nan
+
+        initargs = (signals_shm.name, signals.shape, results_shm.name, results.shape, np.asarray(bvals, dtype=np.float64), method, kwargs)
+        start = time.time()
+        done = 0
+        with Pool(workers, initializer=init_worker, initargs=initargs) as pool:
+            for count in pool.imap_unordered(fit_chunk, chunks):
+                done += count
+                if progress:
+                    elapsed = time.time() - start
+                    print(f"\rFitted {done}/{n} voxels ({100*done/max(n,1):.0f}%), {elapsed:.1f}s elapsed", end='', file=sys.stderr, flush=True)
+        if progress:
+            print(file=sys.stderr)
+
+        params = {p: results[i].copy() for i, p in enumerate(fit.PARAMS)}
+    finally:
+        del results
+        release(results_shm)
+        if own_signals:
+            release(signals_shm)
+
+    return params
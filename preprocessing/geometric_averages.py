@@ -1,6 +1,6 @@
 """This file compues geometric averages between different directions of each acquired b-value. 
 
-    B-value files must be in the correct format - e.g. b0#_0.nii.gz, b0#_1.nii.gz, .. b50#_5.nii.gz,..
+    B-value files must be in the correct format - e.g. b0#_0.nii.gz, b0#_1.nii.gz, .. b50#_5.nii.gz,.. (uncompressed b0#_0.nii, .. files are also accepted)
 
     The output is saved to /averaged/ folder in the same directory where b-value files are found. 
     
@@ -8,10 +8,29 @@
     Important: the paths to b-value files in each .txt file are absolute. To change this, use '-noabsolute' flag when specifying input to this function 
     
     
+    By default, geometric averages are computed in python (numpy) and saved directly as /averaged/b<bval>_averaged.nrrd files. 
+    To use the legacy 'averageBVals' binary (CentOS only, writes .vtk files which are then converted to .nrrd) use '--engine averageBVals' flag. 
+    With '--jobs', averageBVals runs for several directories at the same time (output of each run is prefixed by its directory) - see svtools.execute_many. 
+    
+    
     Usage: 
     
         python geometric_averages.py --d <directory path(s)> 
         python geometric_averages.py --d <directory path(s)> --noabsolute
+        python geometric_averages.py --d <directory path(s)> --engine averageBVals
+        python geometric_averages.py --d <directory path(s)> --engine averageBVals --jobs 8 --timeout 3600
+        python geometric_averages.py --d <directory path(s)> --overwrite
+        python geometric_averages.py --d <directory path(s)> --cache
+        python geometric_averages.py --d <directory path(s)> --instrument
+        python geometric_averages.py --d <directory path(s)> --stack
+        python geometric_averages.py --d <directory path(s)> --memory_budget 256
+        python geometric_averages.py --d <directory path(s)> --exclude_outliers
+        
+    By default, the user is prompted whether to recompute existing outputs. Use '--overwrite' or '--skip_existing' for unattended runs. 
+    Use '--stack' to also save all averages in a single 4D file (/averaged/averaged_stack.nrrd) that can be memory-mapped - see stackio.py. 
+    Use '--cache' to only recompute averages if the b-value files changed since they were last averaged (see buildcache.py, numpy engine only). 
+    Use '--memory_budget <MB>' to average in slabs of slices that fit into the budget, instead of whole volumes (numpy engine only, see slabs.py). Outputs are the same. 
+    Use '--exclude_outliers' to leave out directions flagged as outliers in qa_report.json of the directory (written by 'process_nifti.py --qa', see qa.py). Directions of a b-value are never all excluded (numpy engine only). 
         
     Note: directory path is the path to directory that contains these files: b0#_0.nii.gz, b0#_1.nii.gz, .. b50#_5.nii.gz,..
 
@@ -27,7 +46,15 @@ import shutil
 import sys 
 from collections import Counter 
 
+import numpy as np 
+import nrrd 
+
 import svtools as sv
+import buildcache as bc 
+import instrument 
+import stackio 
+import slabs 
+import qa 
 
     
 def load_args():
@@ -35,6 +62,19 @@ def load_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--directories',type=str,nargs='+', required = True, help='full paths to directories to be processed')
     parser.add_argument('--noabsolute',action="store_true",help='if used, the paths of b-value files written to .txt files will be relative, not absolute')    
+    parser.add_argument('--engine',type=str,default='numpy',choices=['numpy','averageBVals'],help='compute geometric averages in python (default) or with the averageBVals binary')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--overwrite',dest='overwrite',action='store_const',const=True,default=None,help='recompute existing outputs without prompting')
+    group.add_argument('--skip_existing',dest='overwrite',action='store_const',const=False,help='keep existing outputs without prompting')
+    parser.add_argument('--jobs',type=int,default=1,help='number of directories averaged at the same time (averageBVals engine only)')
+    parser.add_argument('--timeout',type=float,default=None,help='averageBVals runs longer than this (in seconds) are stopped (averageBVals engine only, if jobs > 1)')
+    parser.add_argument('--cache',action="store_true",help='if used, averages are only recomputed if the b-value files changed (numpy engine only)')
+    parser.add_argument('--cache_store',type=str,default=None,help='optional path to a shared content-addressed cache store')
+    parser.add_argument('--cache_store_size',type=float,default=None,help='maximum size of the cache store in GB')
+    parser.add_argument('--stack',action="store_true",help='if used, averages are also saved as a single 4D file (averaged/averaged_stack.nrrd)')
+    parser.add_argument('--memory_budget',type=float,default=None,help='if used, averages are computed in slabs of slices that fit into this many MB (numpy engine only)')
+    parser.add_argument('--exclude_outliers',action="store_true",help='if used, directions flagged as outliers in qa_report.json of the directory are left out of the averages (numpy engine only, see qa.py)')
+    parser.add_argument('--instrument',action="store_true",help='if used, timings, memory, bytes read / written and file sizes are saved to averaged/instrument_average.json (see instrument.py)')
     args = parser.parse_args()
     
     return args
@@ -46,48 +86,134 @@ def main():
     # load input args 
     args = load_args()
     
+    directories = args.directories if isinstance(args.directories,list) else [args.directories]
+    process_dirs(args, directories)
+    
+def process_dirs(args, directories): 
+    
+    """Processes a list of directories (options are given by `args` - see load_args)"""
+    
+    # run averageBVals for all directories concurrently first 
+    averaged, failed = {}, []
+    if args.engine == 'averageBVals' and args.jobs > 1: 
+        averaged, failed = average_dirs_concurrently(args, directories)
+        directories = [d for d in directories if d not in failed]
+    
     # process list of dirs
-    if isinstance(args.directories,list):
-        for d in args.directories:
-            process_dir(args,d)
-    # process single dir
-    else:
-        process_dir(args,args.directories)
+    for d in directories:
+        process_dir(args,d,averaged=d in averaged,job=averaged.get(d))
+    
+    if failed: 
+        sys.exit(f"averageBVals failed for directories: {failed}")
+        
+def average_dirs_concurrently(args, directories): 
+    
+    """Run averageBVals for many directories at the same time (at most args.jobs at once) 
+    
+    Returns: 
+        averaged (dict): directories where averageBVals was run successfully - or where the user chose to keep existing outputs (only converted to .nrrd by process_dir, never prompted again) -> result of the averageBVals run (see svtools.execute_many - None if outputs were kept) 
+        failed (list): directories where averageBVals failed (or timed out) 
+    """
+    
+    filepaths_type = 'relative' if args.noabsolute else 'absolute'
+    jobs, kept = [], set()
+    for d in directories: 
+        assert os.path.isdir(d), f"not a directory: {d}"
+        path = d + "/"
+        outputdir = path+"averaged/"
+        os.makedirs(outputdir, exist_ok=True)
+        write_bvalsFileNames(path,filepaths_type)
+        cmd = averageBVals_cmd(path+"bvalsFileNames.txt", outputdir, args.overwrite)
+        if cmd is not None: 
+            jobs.append((d, cmd))
+        else: 
+            kept.add(d)
+    
+    results = sv.execute_many(jobs, max_concurrent=args.jobs, timeout=args.timeout)
+    averaged = {r['prefix']: r for r in results if r['returncode'] == 0}
+    averaged.update({d: None for d in kept})
+    failed = [r['prefix'] for r in results if r['returncode'] != 0]
+    
+    return averaged, failed
         
-def process_dir(args,path):
+def process_dir(args,path,averaged=False,job=None):
     
-    """Processes each directory"""
+    """Processes each directory. If `averaged` - averageBVals was already run for this directory (see average_dirs_concurrently). `job` is the result of that run (see svtools.execute_many) - it is added to the instrumentation record"""
     
     # perform various checks 
     assert os.path.exists(path), f"path does not exist {path}"
     assert os.path.isdir(path), f"not a directory: {path}"
     path = path + "/"
     files = glob.glob(path + "*b[0-9]*#*[0-9].nii.gz")
+    if not files: 
+        # try with uncompressed .nii 
+        files = glob.glob(path + "*b[0-9]*#*[0-9].nii")
     if not files: 
         # try with .nrrd
         files = glob.glob(path + "*b[0-9]*#*[0-9].nrrd")    
     assert files, f"no files found of the correct format are not given in correct format - must be b0#_2.nii.gz and similar. Files found are {files}"
     
+    # leave out outlier directions (see qa.py)
+    if args.exclude_outliers: 
+        assert args.engine == 'numpy', "--exclude_outliers is only supported by the numpy engine"
+        reportpath = qa.report_paths(path)[0]
+        assert os.path.exists(reportpath), f"QA report not found - run process_nifti.py with --qa first: {reportpath}"
+        files = qa.exclude_files(files, qa.read_report(reportpath))
+    
     # check how to save bval filepaths 
     filepaths_type = 'relative' if args.noabsolute else 'absolute'
-    extension = '.vtk'
-    
-    # Create .txt files for processing geometric averages
-    #write_bvalsFileNames(args,filepaths_type)
-    write_bvalsFileNames(path,filepaths_type)
-
-    # Create geometric averages
-    bvalfilenames = path+"bvalsFileNames.txt" 
     outputdir = path+"averaged/"
     os.makedirs(outputdir, exist_ok=True)
-    geometric_average(bvalfilenames,outputdir)
+    outputs = [outputdir + "b" + str(bval) + "_averaged.nrrd" for bval in group_by_bval(files)]
     
-    # Convert .vtk files to .nrrd in '/averages/' directory 
-    vtk2nrrd(outputdir)    
+    if args.instrument: 
+        instrument.start(os.path.abspath(path))
+    
+    with instrument.stage('average', inputs=files, outputs=outputs): 
+        if args.engine == 'numpy':
+            
+            # Create geometric averages directly in .nrrd format
+            extension = '.nrrd'
+            if args.cache: 
+                files = natural_sort(files)
+                max_store_size = int(args.cache_store_size*1e9) if args.cache_store_size else None
+                # b-values come from the file names (not part of the content hash of the inputs) - they are part of the key
+                params = {'engine': args.engine, 'bvals': [get_bval(f) for f in files]}
+                bc.cached_stage('average', files, params, outputs, lambda: compute_geometric_averages(files, outputdir, overwrite=True, memory_budget=args.memory_budget), outputdir, args.cache_store, max_store_size)
+            else: 
+                compute_geometric_averages(files, outputdir, overwrite=args.overwrite, memory_budget=args.memory_budget)
+            
+        else: 
+            
+            extension = '.vtk'
+            
+            if job is not None: 
+                # averageBVals ran before the record of this directory was started (all directories at once) - its wall time is added to the record
+                instrument.add_subprocess(job['cmd'], job['time'], job['returncode'])
+            
+            if not averaged: 
+                # Create .txt files for processing geometric averages
+                #write_bvalsFileNames(args,filepaths_type)
+                write_bvalsFileNames(path,filepaths_type)
+
+                # Create geometric averages
+                bvalfilenames = path+"bvalsFileNames.txt" 
+                geometric_average(bvalfilenames,outputdir,overwrite=args.overwrite)
+            
+            # Convert .vtk files to .nrrd in '/averages/' directory 
+            vtk2nrrd(outputdir)    
     
     # Save a .txt file with paths to geometrically averaged files
-    bvals = get_bvals(outputdir)
-    savedir = write_bvalsFileNames_average(outputdir, bvals,extension, filepaths_type)
+    with instrument.stage('write_txt', outputs=[outputdir + "bvalsFileNames_average.txt"]): 
+        bvals = get_bvals(outputdir, extension)
+        savedir = write_bvalsFileNames_average(outputdir, bvals,extension, filepaths_type, overwrite=args.overwrite)
+    
+    # Save all averages in a single 4D file 
+    if args.stack: 
+        with instrument.stage('write_stack', outputs=[outputdir + stackio.STACK_NAME]): 
+            stackio.write_stack_from_files([outputdir + "b" + str(bval) + "_averaged.nrrd" for bval in bvals], bvals, outputdir + stackio.STACK_NAME, memory_budget=args.memory_budget)
+    
+    instrument.finish(outputdir + "instrument_average.json")
     
     print(f"Saved results to {savedir}")
     
@@ -107,6 +233,13 @@ def natural_sort(l):
     alphanum_key = lambda key: [convert(c) for c in re.split('([0-9]+)', key)]
     return sorted(l, key=alphanum_key)
 
+def get_bval(file): 
+    
+    """Extract b-value from the name of a b-value file (e.g. b50#_2.nii.gz -> 50)"""
+    
+    bval_str = re.search(r"b[0-9]*",os.path.basename(file)).group()
+    return int(bval_str[1:])
+
 def vtk2nrrd(outputdir):
     
     """Converts all .vtk files in (geometrically) '/averaged/' directory to .nrrd format 
@@ -118,11 +251,8 @@ def vtk2nrrd(outputdir):
     files = glob.glob(outputdir + "/b*.vtk")
     assert files 
     
-    # convert each file 
-    for file in files:
-        
-        if not os.path.exists(file.replace(".vtk", ".nrrd")):
-            sv.svconvert(file,".nrrd", verbose=False)
+    # convert all files (files that are already converted are skipped)
+    sv.svconvert_batch([(file, ".nrrd") for file in files], verbose=False)
     
 
 
@@ -131,7 +261,7 @@ def get_bvals(path, filetype=".vtk"):
     
     """Get list of bvalues from filenames"""
     
-    files = glob.glob(path + "/*" + filetype)
+    files = glob.glob(path + "/b*_averaged" + filetype)
 
     
     # numbers 
@@ -147,16 +277,18 @@ def get_bvals(path, filetype=".vtk"):
 
 
 def check_if_nifti(scandir):
-    """ Check if files are in .nii.gz format. If yes - convert them to .nrrd. 
+    """ Check if files are in .nii.gz (or .nii) format. If yes - convert them to .nrrd. 
     Required for geometric averaging script """
     
+    ext = ".nii.gz"
     files = glob.glob(scandir+'b*.nii.gz')
+    if not files: 
+        ext = ".nii"
+        files = glob.glob(scandir+'b*.nii')
     if files:
-        print("Files are in .nii.gz format. Converting to .nrrd....")
-        for f in files: 
-            if not os.path.exists(f.replace(".nii.gz", ".nrrd")):
-                sv.svconvert(f,".nrrd", verbose=False)
-        files = [f.replace(".nii.gz", ".nrrd") for f in files]
+        print(f"Files are in {ext} format. Converting to .nrrd....")
+        sv.svconvert_batch([(f, ".nrrd") for f in files], verbose=False)
+        files = [f.replace(ext, ".nrrd") for f in files]
 
     assert files, f"No .nrrd files are found of the correct format in this directory. Files must be b0#_1.nrrd format. Check your files here: {scandir}"    
 
@@ -188,8 +320,7 @@ def write_bvalsFileNames(scandir,filepaths_type='absolute'):
     with open(savename,'w') as t:
         for file in files: 
             # extract bvalue 
-            bval_str = re.search(r"b[0-9]*",file).group()
-            bval = int(bval_str[1:])
+            bval = get_bval(file)
             
             if filepaths_type == 'absolute':
                 # get line 
@@ -202,9 +333,34 @@ def write_bvalsFileNames(scandir,filepaths_type='absolute'):
     
    
     
-def geometric_average(bvalfilenames,outputdir):
-    """Performs geometric averaging of b-values given a .txt input file"""
+def confirm_overwrite(message, overwrite=None):
+    
+    """Decide whether existing outputs should be recomputed 
+    
+    Args: 
+        message (str): warning shown to the user 
+        overwrite (bool): True - recompute, False - keep existing outputs, None - prompt the user 
+    """
+    
+    if overwrite is None: 
+        answer = input(f"\nWARNING: {message}\n Type 'Y' or 'N'\n")
+        return answer.lower() != 'n'
+    return overwrite 
+
+def geometric_average(bvalfilenames,outputdir,overwrite=None):
+    """Performs geometric averaging of b-values given a .txt input file
+    
+    If outputs already exist - they are recomputed if `overwrite` is True, kept if False, and the user is prompted if None. 
+    """
+    
     
+    cmd = averageBVals_cmd(bvalfilenames, outputdir, overwrite)
+    if cmd is not None: 
+        sv.execute(cmd) 
+
+def averageBVals_cmd(bvalfilenames, outputdir, overwrite=None): 
+    
+    """averageBVals command for a .txt input file - or None if outputs already exist and should be kept (see confirm_overwrite)"""
     
     func = "/fileserver/abd/bin/averageBVals"
     
@@ -216,14 +372,121 @@ def geometric_average(bvalfilenames,outputdir):
     
     # prompt the user if files already exist whether to execute or not
     if glob.glob(outputdir+"*.vtk"):
-        answer = input(f"\nWARNING: geometric average files have already been computed. Do you want to recompute?\n{outputdir}\n Type 'Y' or 'N'\n")
-        if answer.lower() == 'n':
-            return 
-    sv.execute(cmd) 
+        if not confirm_overwrite(f"geometric average files have already been computed. Do you want to recompute?\n{outputdir}", overwrite):
+            return None
+    return cmd 
+        
+
+
+def group_by_bval(files):
+    
+    """Group b-value files by their b-value (e.g. {0: [b0#_0.nii.gz, b0#_1.nii.gz, ..], 50: [..]})"""
+    
+    groups = {}
+    for file in natural_sort(files): 
+        groups.setdefault(get_bval(file), []).append(file)
+    return groups 
+
+def add_log(acc, vol, buf=None): 
+    
+    """Add natural log of a volume to a running sum (in place, float32)
+    
+    Negative intensities are treated as zero (i.e. the geometric average of the voxel becomes zero). 
+    
+    Args: 
+        acc (np.ndarray): float32 running sum of log values 
+        vol (np.ndarray): volume to add 
+        buf (np.ndarray): optional float32 buffer of the same shape as `acc` - reused between calls to avoid new allocations
+    """
+    
+    if buf is None: 
+        buf = np.empty(acc.shape, dtype=np.float32)
+    np.maximum(vol, 0, out=buf, casting='unsafe')
+    with np.errstate(divide='ignore'):
+        np.log(buf, out=buf)
+    acc += buf 
+    return acc 
+
+def exp_mean(acc, n): 
+    
+    """Convert a running sum of log values of `n` volumes into their geometric average (in place)"""
+    
+    acc /= n 
+    np.exp(acc, out=acc)
+    return acc 
+
+def compute_geometric_averages(files, outputdir, overwrite=None, memory_budget=None):
+    
+    """Performs geometric averaging of b-value files in python (replaces averageBVals binary)
+    
+    Files are grouped by b-value (from the filename, e.g. b50#_2.nii.gz) and averaged geometrically. Volumes are read one at a time. 
+    Results are written directly to <outputdir>/b<bval>_averaged.nrrd 
+    
+    Args: 
+        files (list): paths to b-value files (.nii.gz, .nii or .nrrd)
+        outputdir (str): directory where averaged files are saved 
+        overwrite (bool): if outputs already exist - True recomputes them, False keeps them, None prompts the user 
+        memory_budget (float): if given (MB), all directions of a b-value are read and averaged in slabs of slices that fit into the budget (see average_slabs)
+    Returns: 
+        bvals (list): list of averaged b-values 
+    """
+    
+    outputdir = outputdir + '/' if not outputdir.endswith('/') else outputdir
+    
+    # prompt the user if files already exist whether to execute or not
+    if glob.glob(outputdir+"b*_averaged.nrrd"):
+        if not confirm_overwrite(f"geometric average files have already been computed. Do you want to recompute?\n{outputdir}", overwrite):
+            return sorted(get_bvals(outputdir, ".nrrd"))
+    
+    groups = group_by_bval(files)
+    for bval, bvalfiles in groups.items(): 
+        
+        if memory_budget is not None: 
+            average_slabs(bvalfiles, outputdir + "b" + str(bval) + "_averaged.nrrd", memory_budget)
+            continue 
+        
+        # sum log values of all directions (header of the first direction is used for the averaged file)
+        acc, buf, header = None, None, None 
+        for f in bvalfiles: 
+            vol, hdr = sv.read_image(f)
+            if acc is None: 
+                acc = np.zeros(vol.shape, dtype=np.float32)
+                buf = np.empty(vol.shape, dtype=np.float32)
+                header = hdr 
+            add_log(acc, vol, buf)
+        averaged = exp_mean(acc, len(bvalfiles))
         
+        savename = outputdir + "b" + str(bval) + "_averaged.nrrd"
+        nrrd.write(savename, averaged, header=header)
+        print(f"Averaged {len(bvalfiles)} files: {savename}")
+        
+    return sorted(groups)
 
+def average_slabs(files, savename, memory_budget): 
+    
+    """Geometric average of files (all directions of one b-value) computed slab by slab - same output as compute_geometric_averages 
+    
+    All files are read in parallel, one slab of slices at a time (each file is read sequentially, once), and the average is written to `savename` slab by slab. 
+    """
+    
+    shape = slabs.image_shape(files[0])
+    header = sv.read_header(files[0])
+    
+    # per slice: running sum + buffer + one slab of each file (float32)
+    size = slabs.slab_size(4 * shape[0] * shape[1] * (len(files) + 2), memory_budget, shape[2])
+    readers = [slabs.image_slabs(f, size) for f in files]
+    with slabs.nrrd_writer(savename, shape, np.float32, header) as writer: 
+        for parts in zip(*readers): 
+            acc = np.zeros(parts[0][2].shape, dtype=np.float32)
+            buf = np.empty(acc.shape, dtype=np.float32)
+            for _, _, slab in parts: 
+                add_log(acc, slab, buf)
+            writer.write(exp_mean(acc, len(files)))
+    print(f"Averaged {len(files)} files: {savename}")
+    
+    return savename 
 
-def write_bvalsFileNames_average(signaldir, bvals, extension='.vtk', filepaths_type='absolute'):
+def write_bvalsFileNames_average(signaldir, bvals, extension='.vtk', filepaths_type='absolute', overwrite=None):
     # source: svtools library 
     """create bvalFilenames_average .txt files required for running IVIM analysis
     
@@ -231,6 +494,7 @@ def write_bvalsFileNames_average(signaldir, bvals, extension='.vtk', filepaths_t
         signaldir (str): path to directory which contains the acquired b-value files (whether geometrically averaged or not) in the form 'b0_averaged.vtk', etc 
         bvals (list): list of bvalues as integers 
         extension (str): specify whether the filesnames are .nrrd or .vtk (default)
+        overwrite (bool): if the .txt file already exists - True overwrites it, False keeps it, None prompts the user 
     Returns: 
         savedir (str): directory to which the bvalsFileNames.txt file was saved. 
 
@@ -243,11 +507,10 @@ def write_bvalsFileNames_average(signaldir, bvals, extension='.vtk', filepaths_t
     lines = []
     
     if os.path.exists(savedir):
-        answer = input(f"\nWARNING: geometric averages .txt file already exists. Do you want to overwrite this file?\n{savedir}\n Type 'Y' or 'N'\n")
-        if answer.lower() == 'n':
+        if not confirm_overwrite(f"geometric averages .txt file already exists. Do you want to overwrite this file?\n{savedir}", overwrite):
             return savedir
     
-    with open(savedir,'w') as f:
+    with sv.atomic_write(savedir) as tmp, open(tmp,'w') as f:
         for bval in bvals:
             
             if filepaths_type == 'absolute':
@@ -0,0 +1,174 @@
+"""Lightweight per-stage instrumentation of the preprocessing scripts
+
+    A record is started for each subject (directory). Every stage run inside the record is timed and measured:
+        time            - wall time (s)
+        cpu_time        - cpu time of this process (s)
+        peak_rss_mb     - peak resident memory of this process (and of finished subprocesses) at the end of the stage. This is a high-water mark of the whole process - in a reused worker process (run_cohort.py) it can come from an earlier subject
+        bytes_read      - bytes read / written by this process during the stage, measured by the kernel (all files, including compressed streams - not the I/O of subprocesses)
+        bytes_written
+        file_sizes      - on-disk size of each input ('inputs') and output ('outputs') file of the stage - sizes only, not measured I/O
+        subprocesses    - command, wall time and return code of each external command (see svtools.execute, svtools.execute_many)
+
+    Optionally, a single stage can be profiled with cProfile - the profile is saved next to the record as <stage>.prof (view with `python -m pstats` or snakeviz).
+
+    Stages run outside of a record are not measured (instrumentation is off unless a record was started), so the scripts can be wrapped unconditionally.
+
+    Usage:
+        python pipeline.py -f <full path to .nii file> --instrument
+        python pipeline.py -f <full path to .nii file> --instrument --profile mask
+        python run_cohort.py -m <manifest> --instrument
+
+    or from python:
+
+        import instrument
+        instrument.start(subject)
+        with instrument.stage('mask', inputs=[b0path], outputs=[maskpath]):
+            process_b0_image(b0path)
+        instrument.finish("averaged/instrument.json")
+
+"""
+
+import os
+import json
+import time
+import cProfile
+import resource
+import contextlib
+
+
+# record of the current subject (None - instrumentation is off)
+_record = None
+
+
+def start(subject, profile=None, profile_dir=None):
+
+    """Start a record for a subject
+
+    Args:
+        subject (str): subject (directory or file) the record refers to
+        profile (str): name of a stage to profile with cProfile (optional)
+        profile_dir (str): directory where the profile is saved (default - current directory)
+    """
+
+    global _record
+    _record = {'subject': subject, 'start': time.strftime("%Y-%m-%dT%H:%M:%S"), 'time': None, 'peak_rss_mb': None,
+               'stages': [], 'subprocesses': [],
+               '_start': time.time(), '_stack': [], '_profile': profile, '_profile_dir': profile_dir or os.getcwd()}
+
+
+def io_counters():
+
+    """Bytes read and written by this process so far (Linux only - zeros elsewhere)"""
+
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(":") for line in f)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def peak_rss_mb():
+
+    """Peak resident memory of this process and of its finished subprocesses (MB)"""
+
+    # ru_maxrss is in kilobytes on linux
+    usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return round(usage / 1024, 1)
+
+
+def file_sizes(paths):
+    return {os.path.abspath(p): os.path.getsize(p) for p in paths if os.path.isfile(p)}
+
+
+@contextlib.contextmanager
+def stage(name, inputs=(), outputs=()):
+
+    """Time and measure a stage (no-op if no record was started)
+
+    Args:
+        name (str): name of the stage
+        inputs (list): input files of the stage (their sizes are recorded in 'file_sizes')
+        outputs (list): output files of the stage (their sizes are recorded in 'file_sizes' at the end of the stage)
+    """
+
+    if _record is None:
+        yield None
+        return
+
+    entry = {'stage': name, 'time': None, 'cpu_time': None, 'peak_rss_mb': None, 'bytes_read': None, 'bytes_written': None,
+             'file_sizes': {'inputs': file_sizes(inputs), 'outputs': {}}, 'subprocesses': []}
+    _record['_stack'].append(entry)
+
+    profiler = cProfile.Profile() if _record['_profile'] == name else None
+    read, written = io_counters()
+    cpu = time.process_time()
+    start = time.time()
+    try:
+        if profiler is not None:
+            profiler.enable()
+        yield entry
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        entry['time'] = round(time.time() - start, 3)
+        entry['cpu_time'] = round(time.process_time() - cpu, 3)
+        entry['peak_rss_mb'] = peak_rss_mb()
+        read_end, written_end = io_counters()
+        entry['bytes_read'] = read_end - read
+        entry['bytes_written'] = written_end - written
+        entry['file_sizes']['outputs'] = file_sizes(outputs)
+        if profiler is not None:
+            entry['profile'] = os.path.join(_record['_profile_dir'], name + ".prof")
+            profiler.dump_stats(entry['profile'])
+        _record['_stack'].pop()
+        _record['stages'].append(entry)
+
+
+def add_subprocess(cmd, seconds, returncode):
+
+    """Record wall time of an external command (in the innermost running stage, if any)"""
+
+    if _record is None:
+        return
+    entry = {'cmd': ' '.join(str(c) for c in cmd), 'time': round(seconds, 3), 'returncode': returncode}
+    target = _record['_stack'][-1] if _record['_stack'] else _record
+    target['subprocesses'].append(entry)
+
+
+def finish(savename=None):
+
+    """Close the current record and (optionally) save it as .json
+
+    Returns:
+        record (dict): the record - or None if no record was started
+    """
+
+    global _record
+    if _record is None:
+        return None
+    record, _record = _record, None
+
+    record['time'] = round(time.time() - record['_start'], 3)
+    record['peak_rss_mb'] = peak_rss_mb()
+    record = {k: v for k, v in record.items() if not k.startswith('_')}
+
+    if savename is not None:
+        dirname = os.path.dirname(savename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(savename, 'w') as f:
+            json.dump(record, f, indent=2)
+        print(f"Saved instrumentation record to: {savename}")
+
+    return record
+
+
+def summary(record):
+
+    """Wall time of each stage of a record - {stage: seconds}"""
+
+    times = {}
+    for entry in record['stages']:
+        times[entry['stage']] = round(times.get(entry['stage'], 0) + entry['time'], 3)
+    return times
@@ -0,0 +1,252 @@
+"""Single entry point for the preprocessing steps, with one subcommand per step
+
+    split      - split 4D files into 3D b-value files (process_nifti.py)
+    average    - geometric averages of b-value files in directories (geometric_averages.py)
+    mask       - masks from b0_averaged.nrrd in directories (create_masks.py)
+    convert    - convert files between .nrrd, .nii, .nii.gz and .vtk (svtools.svconvert_batch)
+    run        - full pipeline (split + average + mask) for 4D files (pipeline.py)
+    stats      - per-ROI statistics of a cohort as a single .csv table (roi_stats.py)
+    preview    - fast downsampled preview (averages, mask, b-value check) with a .png montage per subject (preview.py)
+    startup    - measure the startup time of each subcommand
+
+    Each subcommand accepts many inputs, so a whole batch is processed by a single interpreter - instead of starting python (and importing numpy, nibabel, SimpleITK, opencv, scipy) once per directory in a shell loop. Heavy modules are only imported once the subcommand that needs them runs (e.g. 'average' never imports SimpleITK, opencv or scipy).
+
+    Options of each subcommand are the same as the options of the corresponding script.
+
+    Use '--timing' to print the time spent on setup (ivim.py and parsing of the arguments), imports of the subcommand and the run itself. 'startup' measures the startup of each subcommand in a fresh interpreter (and, for comparison, of a bare interpreter and of importing every module up front).
+
+    Usage:
+        python ivim.py split -f <4D file> <4D file> ... --stream
+        python ivim.py split -f <4D file> <4D file> ... --qa
+        python ivim.py average -d <directory> <directory> ... --exclude_outliers
+        python ivim.py average -d <directory> <directory> ...
+        python ivim.py mask -d <directory> <directory> ... --packed
+        python ivim.py convert -f <file> <file> ... --format .nii.gz
+        python ivim.py run -f <4D file> <4D file> ... --stack
+        python ivim.py stats -d <subject directory> <subject directory> ... -o roi_stats.csv
+        python ivim.py preview -m <manifest> --output previews/
+        python ivim.py --timing average -d <directory>
+        python ivim.py startup --repeat 5
+
+"""
+
+import time
+_start = time.perf_counter()
+
+import argparse
+import os
+import sys
+import subprocess
+
+
+# module that each subcommand imports (only when the subcommand runs)
+MODULES = {'split': 'process_nifti',
+           'average': 'geometric_averages',
+           'mask': 'create_masks',
+           'convert': 'svtools',
+           'run': 'pipeline',
+           'stats': 'roi_stats',
+           'preview': 'preview'}
+
+
+def load_args(argv=None):
+
+    parser = argparse.ArgumentParser(description="IVIM preprocessing")
+    parser.add_argument('--timing',action="store_true",help='if used, setup, import and run times are printed at the end')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    # options shared by several subcommands
+    cache = argparse.ArgumentParser(add_help=False)
+    cache.add_argument('--cache',action="store_true",help='if used, outputs are only recomputed if their inputs or parameters changed')
+    cache.add_argument('--cache_store',type=str,default=None,help='optional path to a shared content-addressed cache store')
+    cache.add_argument('--cache_store_size',type=float,default=None,help='maximum size of the cache store in GB')
+    cache.add_argument('--instrument',action="store_true",help='if used, timings, memory and bytes read / written are saved next to the outputs (see instrument.py)')
+    cache.add_argument('--memory_budget',type=float,default=None,help='if used, volumes are processed in slabs of slices that fit into this many MB (see slabs.py)')
+    masks = argparse.ArgumentParser(add_help=False)
+    masks.add_argument('--masktype',type=str,default='improved',choices=['improved','simple','dummy'],help='type of mask to create')
+    masks.add_argument('--packed',action="store_true",help='if used, a bit-packed copy of the mask is also saved (mask_packed.npz)')
+
+    p = subparsers.add_parser('split', parents=[cache], help='split 4D files into 3D b-value files (process_nifti.py)')
+    p.add_argument('-f', '--files',type=str,nargs='+',required=True,help='4D .nii or .nii.gz files')
+    p.add_argument('-d','--directions',type=int,default=6,help='directions for bval')
+    p.add_argument('--protocol',type=str,default=None,help='.txt file with the b-values given to the scanner (one per volume) - b-values of the .bval file are checked and corrected against it')
+    p.add_argument('--stream',action="store_true",help='if used, 3D volumes are read one at a time')
+    p.add_argument('--workers',type=int,default=1,help='number of parallel workers that compress and write the 3D files')
+    p.add_argument('--pool',type=str,default='thread',choices=['thread','process'],help='type of the writer pool')
+    p.add_argument('--compresslevel',type=int,default=None,choices=range(0,10),metavar='[0-9]',help='gzip compression level of the output .nii.gz files')
+    p.add_argument('--uncompressed',action="store_true",help='if used, 3D files are written as uncompressed .nii files')
+    p.add_argument('--qa',action="store_true",help='if used, quality statistics of each volume are saved to qa_report.json / qa_report.csv (see qa.py)')
+
+    p = subparsers.add_parser('average', parents=[cache], help='geometric averages of b-value files (geometric_averages.py)')
+    p.add_argument('-d', '--directories',type=str,nargs='+',required=True,help='directories with b-value files')
+    p.add_argument('--noabsolute',action="store_true",help='if used, the paths of b-value files written to .txt files will be relative, not absolute')
+    p.add_argument('--engine',type=str,default='numpy',choices=['numpy','averageBVals'],help='compute geometric averages in python (default) or with the averageBVals binary')
+    group = p.add_mutually_exclusive_group()
+    group.add_argument('--overwrite',dest='overwrite',action='store_const',const=True,default=None,help='recompute existing outputs without prompting')
+    group.add_argument('--skip_existing',dest='overwrite',action='store_const',const=False,help='keep existing outputs without prompting')
+    p.add_argument('--jobs',type=int,default=1,help='number of directories averaged at the same time (averageBVals engine only)')
+    p.add_argument('--timeout',type=float,default=None,help='averageBVals runs longer than this (in seconds) are stopped')
+    p.add_argument('--stack',action="store_true",help='if used, averages are also saved as a single 4D file (averaged/averaged_stack.nrrd)')
+    p.add_argument('--exclude_outliers',action="store_true",help='if used, directions flagged as outliers in qa_report.json are left out of the averages (numpy engine only)')
+
+    p = subparsers.add_parser('mask', parents=[cache, masks], help='masks from b0_averaged.nrrd (create_masks.py)')
+    p.add_argument('-d', '--directories',type=str,nargs='+',required=True,help='directories with b0_averaged.nrrd (or with averaged/b0_averaged.nrrd)')
+
+    p = subparsers.add_parser('convert', help='convert files between .nrrd, .nii, .nii.gz and .vtk (svtools.svconvert_batch)')
+    p.add_argument('-f', '--files',type=str,nargs='+',required=True,help='files to convert')
+    p.add_argument('--format',type=str,required=True,choices=['.nrrd','.nii.gz','.nii','.vtk'],help='output format')
+    p.add_argument('--workers',type=int,default=None,help='number of threads (default - number of cpus)')
+    p.add_argument('--skip_existing',action="store_true",help='if used, files whose converted output is up to date are skipped')
+
+    p = subparsers.add_parser('run', parents=[cache, masks], help='full pipeline for 4D files (pipeline.py)')
+    p.add_argument('-f', '--files',type=str,nargs='+',required=True,help='4D .nii or .nii.gz files')
+    p.add_argument('--noabsolute',action="store_true",help='if used, the paths of b-value files written to .txt files will be relative, not absolute')
+    p.add_argument('--save_directions',action="store_true",help='if used, individual 3D files (e.g. b50#_2.nii.gz) are also written to disk')
+    p.add_argument('--stack',action="store_true",help='if used, averages are also saved as a single 4D file (averaged/averaged_stack.nrrd)')
+    p.add_argument('--qa',action="store_true",help='if used, quality statistics of each volume are saved to averaged/qa_report.json / qa_report.csv (see qa.py)')
+    p.add_argument('--exclude_outliers',action="store_true",help='if used, directions flagged as outliers by QA are left out of the averages (implies --qa)')
+    p.add_argument('--profile',type=str,default=None,choices=['split_average','write_txt','write_stack','mask'],help='name of a stage to profile with cProfile (requires --instrument)')
+
+    p = subparsers.add_parser('stats', help='per-ROI statistics of a cohort as a single .csv table (roi_stats.py)')
+    group = p.add_mutually_exclusive_group(required=True)
+    group.add_argument('-d', '--directories',type=str,nargs='+',help='subject directories')
+    group.add_argument('-m', '--manifest',type=str,help='.txt file with one subject directory per line')
+    p.add_argument('-o', '--output',type=str,default='roi_stats.csv',help='output .csv table')
+    p.add_argument('--labels',type=str,default='averaged/mask.nrrd',help='label map (relative to each subject directory)')
+    p.add_argument('--maps',type=str,nargs='+',default=['averaged/b*_averaged.nrrd', 'averaged/ivim_*.nrrd'],help='glob patterns of maps to summarise (relative to each subject directory)')
+    p.add_argument('--percentiles',type=float,nargs='+',default=[5, 25, 75, 95],help='percentiles to compute (the median is always computed)')
+    p.add_argument('--workers',type=int,default=None,help='number of subjects processed in parallel (default - number of cpus)')
+
+    p = subparsers.add_parser('preview', parents=[masks], help='fast downsampled preview with a .png montage per subject (preview.py)')
+    group = p.add_mutually_exclusive_group(required=True)
+    group.add_argument('-f', '--files',type=str,nargs='+',help='4D .nii or .nii.gz files')
+    group.add_argument('-m', '--manifest',type=str,help='.txt file with one subject directory per line')
+    p.add_argument('-o', '--output',type=str,default=None,help='directory for all montages (default - preview.png next to each 4D file)')
+    p.add_argument('--factor',type=int,default=4,help='in-plane downsampling factor')
+    p.add_argument('--slices',type=int,default=8,help='number of (evenly spaced) slices that are read')
+    p.add_argument('--protocol',type=str,default=None,help='.txt file with the b-values given to the scanner (one per volume)')
+    p.add_argument('--tile',type=int,default=96,help='size of each slice in the montage (pixels)')
+    p.add_argument('--workers',type=int,default=None,help='number of subjects processed in parallel (default - number of cpus)')
+
+    p = subparsers.add_parser('startup', help='measure the startup time of each subcommand')
+    p.add_argument('--commands',type=str,nargs='+',default=list(MODULES),choices=list(MODULES),help='subcommands to measure')
+    p.add_argument('--repeat',type=int,default=5,help='number of runs of each measurement (fastest run is reported)')
+
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def main(argv=None):
+
+    # load input args
+    args = load_args(argv)
+
+    if args.command == 'startup':
+        results = measure_startup(args.commands, args.repeat)
+        print_startup(results)
+        return
+
+    setup = time.perf_counter() - _start
+
+    # heavy imports happen here - only for the subcommand that runs
+    start = time.perf_counter()
+    module = load_module(args.command)
+    imports = time.perf_counter() - start
+
+    start = time.perf_counter()
+    COMMANDS[args.command](args, module)
+    run_time = time.perf_counter() - start
+
+    if args.timing:
+        print(f"Timing ({args.command}): setup {setup:.3f}s, imports {imports:.3f}s, run {run_time:.3f}s")
+
+
+def load_module(command):
+
+    """Import the module needed by a subcommand"""
+
+    import importlib
+    return importlib.import_module(MODULES[command])
+
+
+def split(args, pn):
+    for file in args.files:
+        pn.process_file(args, file)
+
+
+def average(args, ga):
+    ga.process_dirs(args, args.directories)
+
+
+def mask(args, cm):
+    for d in args.directories:
+        cm.process_dir(args, d)
+
+
+def convert(args, sv):
+    sv.svconvert_batch([(f, args.format) for f in args.files], workers=args.workers, skip_existing=args.skip_existing)
+
+
+def run(args, pipeline):
+    for file in args.files:
+        pipeline.process_file(args, file)
+
+
+def stats(args, rs):
+    directories = rs.load_manifest(args.manifest) if args.manifest else args.directories
+    if rs.aggregate_cohort(directories, args.output, labels=args.labels, maps=args.maps, percentiles=args.percentiles, workers=args.workers):
+        sys.exit(1)
+
+
+def preview(args, pv):
+    files = pv.load_manifest(args.manifest) if args.manifest else args.files
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+    results = pv.preview_cohort(files, args.output, factor=args.factor, nslices=args.slices, masktype=args.masktype, protocol=args.protocol, tile=args.tile, workers=args.workers)
+    if any(r['status'] == 'failed' for r in results):
+        sys.exit(1)
+
+
+COMMANDS = {'split': split, 'average': average, 'mask': mask, 'convert': convert, 'run': run, 'stats': stats, 'preview': preview}
+
+
+def time_command(cmd, repeat):
+
+    """Wall time of a command (fastest of `repeat` runs)"""
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(cmd, check=True, cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def measure_startup(commands, repeat=5):
+
+    """Startup time (interpreter + ivim.py + imports) of each subcommand in a fresh interpreter
+
+    Returns:
+        results (dict): command -> seconds. Also includes 'python' (bare interpreter) and 'eager' (all modules imported up front, i.e. the cost every subcommand would pay without lazy imports)
+    """
+
+    results = {'python': time_command([sys.executable, "-c", "pass"], repeat)}
+    for command in commands:
+        results[command] = time_command([sys.executable, "-c", f"import ivim; ivim.load_module('{command}')"], repeat)
+    results['eager'] = time_command([sys.executable, "-c", "import ivim; [ivim.load_module(c) for c in ivim.MODULES]"], repeat)
+
+    return {k: round(v, 3) for k, v in results.items()}
+
+
+def print_startup(results):
+
+    print(f"{'command':<10} {'startup (s)':>12}")
+    for command, seconds in results.items():
+        print(f"{command:<10} {seconds:>12.3f}")
+    print("Startup is paid once per invocation - pass all inputs of a batch to a single invocation")
+
+
+if __name__=='__main__':
+
+    main()
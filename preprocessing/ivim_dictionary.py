@@ -0,0 +1,156 @@
+"""Dictionary (lookup table) IVIM fitting
+
+    A dictionary of normalised IVIM signal curves is precomputed over a grid of (f, D, D*) for a given list of b-values. Each voxel is matched to the dictionary curve with the highest correlation (i.e. least squares fit with a free S0). S0 is obtained from the projection of the signal onto the matched curve.
+
+    Two (equivalent) search methods are available:
+        tree    - nearest-neighbour index (k-d tree) of the unit norm curves. For unit vectors, the nearest neighbour is the curve with the highest correlation. Fastest for the small number of b-values of IVIM protocols (default)
+        matmul  - one matrix product (voxels x curves) per block of voxels, followed by argmax
+
+    Dictionaries are cached on disk (one .npz file per b-value list and grid), so a dictionary is computed once per protocol and reused for every subject of a cohort. Default cache directory is ~/.cache/ivim_dictionary
+
+    Optionally, dictionary estimates are refined with the full bi-exponential fit (see ivim_fit.fit_biexp), which then only needs a few iterations.
+
+    Usage:
+        python ivim_fit.py -d <directory> --method dictionary
+        python ivim_fit.py -d <directory> --method dictionary --refine --dict_cache <cache directory>
+
+"""
+
+import os
+import json
+import hashlib
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+import ivim_fit as fit
+
+
+# default grid: (start, stop, number of points, spacing)
+GRID = {'f': (0., 0.6, 31, 'linear'),
+        'D': (1e-4, 5e-3, 25, 'log'),
+        'Dstar': (5e-3, 0.5, 25, 'log')}
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ivim_dictionary")
+
+
+def grid_values(start, stop, num, spacing):
+
+    """Values of a single grid axis"""
+
+    return np.geomspace(start, stop, num) if spacing == 'log' else np.linspace(start, stop, num)
+
+
+def dictionary_key(bvals, grid):
+
+    """Key of a dictionary - hash of the b-value list and the grid"""
+
+    content = json.dumps({'bvals': [float(b) for b in bvals], 'grid': grid}, sort_keys=True)
+    return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+
+
+def build_dictionary(bvals, grid=GRID):
+
+    """Compute normalised IVIM curves (S0 = 1) over a grid of (f, D, D*)
+
+    Returns:
+        atoms (np.ndarray): float32 (n_atoms, n_bvals) curves with unit norm
+        norms (np.ndarray): norm of each curve before normalisation (used to recover S0)
+        params (dict): f, D, Dstar of each atom
+    """
+
+    bvals = np.asarray(bvals, dtype=np.float64)
+    f, D, Dstar = np.meshgrid(*(grid_values(*grid[p]) for p in ['f', 'D', 'Dstar']), indexing='ij')
+    params = {'f': f.ravel(), 'D': D.ravel(), 'Dstar': Dstar.ravel()}
+
+    # D* must be larger than D
+    keep = params['Dstar'] > params['D']
+    params = {p: v[keep] for p, v in params.items()}
+
+    curves = fit.ivim_signal(bvals, np.ones(keep.sum()), params['f'], params['D'], params['Dstar'])
+    norms = np.linalg.norm(curves, axis=1)
+    atoms = (curves / norms[:,None]).astype(np.float32)
+
+    return atoms, norms, params
+
+
+def load_dictionary(bvals, grid=GRID, cache_dir=CACHE_DIR):
+
+    """Load a dictionary from the cache, or build it and save it to the cache"""
+
+    path = os.path.join(cache_dir, "dict_" + dictionary_key(bvals, grid) + ".npz")
+    if os.path.exists(path):
+        with np.load(path) as d:
+            return d['atoms'], d['norms'], {p: d[p] for p in ['f', 'D', 'Dstar']}
+
+    atoms, norms, params = build_dictionary(bvals, grid)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = path + ".tmp" + str(os.getpid()) + ".npz"
+    np.savez(tmp, atoms=atoms, norms=norms, bvals=np.asarray(bvals, dtype=np.float64), **params)
+    os.replace(tmp, path)
+    print(f"Saved dictionary with {len(atoms)} atoms to: {path}")
+
+    return atoms, norms, params
+
+
+def match(signals, atoms, search='tree', block_size=None):
+
+    """Find the best matching atom of each voxel (highest inner product of normalised signals)
+
+    With search='matmul' voxels are processed in blocks - one matrix product per block. With search='tree' a k-d tree of the atoms is queried with unit norm signals.
+
+    Returns:
+        best (np.ndarray): index of the best atom per voxel
+        proj (np.ndarray): inner product of the (unnormalised) signal with the best atom
+    """
+
+    if search == 'tree':
+        norm = np.linalg.norm(signals, axis=1, keepdims=True)
+        _, best = cKDTree(atoms).query(signals / np.where(norm > 0, norm, 1))
+        proj = np.einsum('vb,vb->v', signals, atoms[best].astype(np.float64))
+        return best, proj
+
+    if block_size is None:
+        # ~128 MB of scores per block
+        block_size = max(1, (1 << 25) // len(atoms))
+
+    best = np.empty(len(signals), dtype=np.int64)
+    proj = np.empty(len(signals), dtype=np.float64)
+    for start in range(0, len(signals), block_size):
+        block = signals[start:start+block_size].astype(np.float32)
+        scores = block @ atoms.T
+        best[start:start+block_size] = np.argmax(scores, axis=1)
+        proj[start:start+block_size] = scores[np.arange(len(block)), best[start:start+block_size]]
+
+    return best, proj
+
+
+def fit_dictionary(signals, bvals, grid=GRID, cache_dir=None, search='tree', refine=False, **kwargs):
+
+    """Dictionary IVIM fit of all voxels
+
+    Maximising the inner product with unit norm atoms is equivalent to a least squares fit with a free S0 (for positive projections).
+
+    Args:
+        signals (np.ndarray): (n_voxels, n_bvals)
+        bvals (np.ndarray): b-values
+        grid (dict): dictionary grid - see GRID
+        cache_dir (str): dictionary cache directory (default - CACHE_DIR)
+        search (str): 'tree' (nearest-neighbour index) or 'matmul' (blocked matrix products)
+        refine (bool): if True, refine the estimates with the full bi-exponential fit
+    """
+
+    atoms, norms, params = load_dictionary(bvals, grid, cache_dir or CACHE_DIR)
+    best, proj = match(signals, atoms, search)
+
+    # S0 of the best curve: signal ~ S0 * norm * atom  =>  S0 = <signal, atom> / norm
+    result = {'S0': np.maximum(proj, 0) / norms[best],
+              'f': params['f'][best].astype(np.float64),
+              'D': params['D'][best].astype(np.float64),
+              'Dstar': params['Dstar'][best].astype(np.float64)}
+    fit.clip_params(result)
+
+    if refine:
+        result = fit.fit_biexp(signals, np.asarray(bvals, dtype=np.float64), init=result, **kwargs)
+
+    return result
@@ -0,0 +1,381 @@
+"""Estimate IVIM parameters (S0, f, D, D*) from geometrically averaged b-value images
+
+    Reads the averaged b-value files listed in 'bvalsFileNames_average.txt' (output of geometric_averages.py or pipeline.py) and the mask 'mask.nrrd' (output of create_masks.py). All voxels inside the mask are fitted at once (vectorized numpy operations - no loop over voxels).
+
+    IVIM model:
+        S(b) = S0 * ( f * exp(-b*D*) + (1-f) * exp(-b*D) )
+
+    Methods:
+        segmented   - D from a log-linear least squares fit of high b-values (b >= 200 by default), f from the intercept of that fit, D* from a log-linear fit of the residual signal at low b-values
+        biexp       - full bi-exponential least squares fit of all b-values (Levenberg-Marquardt), initialised with the segmented fit
+        dictionary  - match each voxel against a cached dictionary of IVIM curves (see ivim_dictionary.py), optionally refined with the bi-exponential fit ('--refine')
+
+    Parameter maps are saved next to the averaged files as ivim_<method>_<parameter>.nrrd, e.g. ivim_biexp_D.nrrd, ivim_biexp_f.nrrd, ivim_biexp_Dstar.nrrd, ivim_biexp_S0.nrrd
+
+    Please specify path to directory(-ies) where '/averaged/bvalsFileNames_average.txt' (or 'bvalsFileNames_average.txt') and 'mask.nrrd' exist.
+
+    With '--stack', signals are read from the single 4D averaged stack ('averaged_stack.nrrd', see stackio.py) instead of the files listed in 'bvalsFileNames_average.txt' - only voxels inside the mask are read.
+
+    Usage:
+        python ivim_fit.py -d <directory>
+        python ivim_fit.py -d <directory> --method segmented --bthreshold 200
+        python ivim_fit.py -d <directory> --method dictionary --refine
+        python ivim_fit.py -d <directory> --workers 16 --chunk_size 20000
+        python ivim_fit.py -d <directory> --stack
+
+    With '--workers', voxels are fitted in chunks by a pool of processes that share the signal matrix (see fit_scheduler.py).
+
+"""
+
+import os
+import argparse
+
+import numpy as np
+import nrrd
+
+import svtools as sv
+import maskio
+import stackio
+
+
+PARAMS = ['S0', 'f', 'D', 'Dstar']
+
+# bounds of IVIM parameters (units of D and D* - mm^2/s, if b-values are in s/mm^2)
+BOUNDS = {'f': (0., 1.), 'D': (0., 0.005), 'Dstar': (0.005, 0.5)}
+
+
+def load_args():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--directories',type=str,nargs='+', required = True, help='full paths to directories to be processed')
+    parser.add_argument('--method',type=str,default='biexp',choices=sorted(FIT_METHODS),help='fitting method')
+    parser.add_argument('--bthreshold',type=int,default=200,help='b-values above (or equal to) this value are used to fit D in the segmented fit')
+    parser.add_argument('--refine',action="store_true",help='if used, dictionary estimates are refined with the bi-exponential fit (dictionary method only)')
+    parser.add_argument('--dict_cache',type=str,default=None,help='directory where dictionaries are cached (dictionary method only, default ~/.cache/ivim_dictionary)')
+    parser.add_argument('--workers',type=int,default=1,help='number of worker processes')
+    parser.add_argument('--chunk_size',type=int,default=10000,help='number of voxels fitted by a worker at a time (if workers > 1)')
+    parser.add_argument('--mask',type=str,default='mask.nrrd',help='name of the mask file (in the same directory as bvalsFileNames_average.txt)')
+    parser.add_argument('--stack',action="store_true",help='if used, signals are read from averaged_stack.nrrd instead of bvalsFileNames_average.txt')
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+
+    # load input args
+    args = load_args()
+
+    # process list of dirs
+    for d in args.directories:
+        process_dir(args,d)
+
+
+def process_dir(args,path):
+
+    """Processes each directory"""
+
+    # perform various checks
+    assert os.path.exists(path), f"path does not exist {path}"
+    assert os.path.isdir(path), f"not a directory: {path}"
+    path = path + "/"
+
+    # get bvalsFileNames_average.txt (or the averaged stack)
+    name = stackio.STACK_NAME if args.stack else "bvalsFileNames_average.txt"
+    txtpath = path + "averaged/" + name
+    if not os.path.exists(txtpath):
+        # try to find the file without the subdir
+        txtpath = path + name
+    assert os.path.exists(txtpath), f"No {name} file found. Please ensure that it exists in the supplied directory or in the subfolder /averaged/ of this same directory"
+    maskpath = os.path.join(os.path.dirname(txtpath), args.mask)
+
+    # fit and save parameter maps
+    fit_dir(txtpath, maskpath, method=args.method, workers=args.workers, chunk_size=args.chunk_size, bthreshold=args.bthreshold, refine=args.refine, cache_dir=args.dict_cache)
+
+
+def read_bvalsFileNames_average(txtpath):
+
+    """Read b-values and paths of averaged files from bvalsFileNames_average.txt (relative paths are relative to the .txt file)
+
+    Returns:
+        bvals (list): b-values (int)
+        files (list): absolute paths to averaged files
+    """
+
+    dirname = os.path.dirname(os.path.abspath(txtpath))
+    bvals, files = [], []
+    with open(txtpath) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            bval, file = line.split(None, 1)
+            file = file.strip()
+            file = file if os.path.isabs(file) else os.path.join(dirname, file)
+
+            # .vtk files (averageBVals) are read from their .nrrd copies (see geometric_averages.vtk2nrrd)
+            if file.endswith(".vtk"):
+                file = file.replace(".vtk", ".nrrd")
+            bvals.append(int(bval))
+            files.append(file)
+
+    return bvals, files
+
+
+def load_signals(txtpath, maskpath, empty=np.empty):
+
+    """Gather signals of all voxels inside the mask into a (voxels x b-values) matrix
+
+    Args:
+        txtpath (str): path to bvalsFileNames_average.txt - or to the averaged stack (.nrrd, see stackio.py)
+        maskpath (str): path to mask (.nrrd or bit-packed .npz)
+        empty (callable): allocates the float64 signal matrix from its shape (e.g. in shared memory - see fit_scheduler.create_shared)
+    Returns:
+        signals (np.ndarray): float64 array (n_voxels, n_bvals), columns sorted by b-value
+        bvals (np.ndarray): sorted b-values
+        idx (np.ndarray): flat (C-order) indices of voxels inside the mask
+        shape (tuple): shape of the volumes
+        header (dict): .nrrd header of the averaged volumes
+    """
+
+    if txtpath.endswith(".nrrd"):
+        return load_signals_stack(txtpath, maskpath, empty)
+
+    bvals, files = read_bvalsFileNames_average(txtpath)
+    order = np.argsort(bvals)
+    bvals = np.array(bvals, dtype=np.float64)[order]
+    files = [files[i] for i in order]
+
+    idx = maskio.load_mask(maskpath, indices=True)
+
+    signals, coords, header = None, None, None
+    for j, file in enumerate(files):
+        vol, hdr = sv.read_image(file)
+        if signals is None:
+            signals = empty((idx.size, len(files)))
+            coords = np.unravel_index(idx, vol.shape)
+            shape, header = vol.shape, hdr
+        signals[:,j] = vol[coords]
+
+    return signals, bvals, idx, shape, header
+
+
+def load_signals_stack(stackpath, maskpath, empty=np.empty):
+
+    """Same as load_signals, for the averaged stack - only voxels inside the mask are read from the (memory-mapped) stack"""
+
+    data, bvals, header = stackio.load_stack(stackpath)
+    idx = maskio.load_mask(maskpath, indices=True)
+    order = np.argsort(bvals)
+    signals = empty((idx.size, len(order)))
+    signals[:] = stackio.masked_signals(data, idx)[:,order]
+
+    return signals, bvals[order], idx, data.shape[1:], stackio.volume_header(header)
+
+
+# -----------
+# Fitting methods - each takes a (voxels x b-values) signal matrix and b-values and returns a dict of parameter arrays (one value per voxel)
+# -----------
+
+def ivim_signal(bvals, S0, f, D, Dstar):
+
+    """IVIM model signal. Parameters are arrays of shape (n_voxels,), returns (n_voxels, n_bvals)"""
+
+    b = bvals[None,:]
+    return S0[:,None] * (f[:,None]*np.exp(-b*Dstar[:,None]) + (1-f[:,None])*np.exp(-b*D[:,None]))
+
+
+def clip_params(params):
+
+    """Clip parameters to BOUNDS (in place)"""
+
+    for p, (low, high) in BOUNDS.items():
+        np.clip(params[p], low, high, out=params[p])
+    return params
+
+
+def loglinear_fit(logS, b):
+
+    """Batched least squares fit of log(S) = a - b*D for all voxels at once. Returns (a, D)"""
+
+    A = np.stack([np.ones_like(b), -b], axis=1)
+    coef = logS @ np.linalg.pinv(A).T
+    return coef[:,0], coef[:,1]
+
+
+def fit_segmented(signals, bvals, bthreshold=200, **kwargs):
+
+    """Segmented IVIM fit of all voxels at once
+
+    1. D (and S0*(1-f)) from a log-linear fit of b-values >= bthreshold
+    2. f = 1 - S0*(1-f) / S0, where S0 is the signal at the lowest b-value
+    3. D* from a log-linear fit (through the origin) of the perfusion signal S - S0*(1-f)*exp(-b*D) at b-values < bthreshold
+    """
+
+    tiny = np.finfo(np.float64).tiny
+    high = bvals >= bthreshold
+    low = (bvals < bthreshold) & (bvals > bvals.min())
+    assert high.sum() >= 2, f"At least 2 b-values >= {bthreshold} are required for the segmented fit"
+
+    # 1. diffusion
+    a, D = loglinear_fit(np.log(np.maximum(signals[:,high], tiny)), bvals[high])
+    S0_diff = np.exp(a)
+
+    # 2. perfusion fraction
+    S0 = signals[:,np.argmin(bvals)].copy()
+    f = 1 - S0_diff / np.maximum(S0, tiny)
+
+    # 3. pseudo-diffusion - voxels with negative residuals are ignored at that b-value
+    b = bvals[low] - bvals.min()
+    perf = signals[:,low] - S0_diff[:,None]*np.exp(-bvals[low][None,:]*D[:,None])
+    valid = (perf > 0) & (f[:,None] > 0)
+    y = np.log(np.maximum(perf, tiny)) - np.log(np.maximum(S0*f, tiny))[:,None]
+    w = valid * b[None,:]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        Dstar = -np.sum(w*y, axis=1) / np.sum(w*b[None,:], axis=1)
+    Dstar = np.where(np.isfinite(Dstar), Dstar, BOUNDS['Dstar'][0])
+
+    return clip_params({'S0': S0, 'f': f, 'D': D, 'Dstar': Dstar})
+
+
+def fit_biexp(signals, bvals, init=None, iterations=100, tol=1e-6, **kwargs):
+
+    """Full bi-exponential IVIM fit of all voxels at once (batched Levenberg-Marquardt)
+
+    Args:
+        signals (np.ndarray): (n_voxels, n_bvals)
+        bvals (np.ndarray): b-values
+        init (dict): initial parameters - segmented fit is used by default
+        iterations (int): maximum number of iterations
+        tol (float): relative change of the cost below which a voxel is considered converged
+    """
+
+    if init is None:
+        init = fit_segmented(signals, bvals, **kwargs)
+
+    # fit signals normalised by S0 - parameters are then of similar magnitude
+    scale = np.where(init['S0'] > 0, init['S0'], 1.)
+    y = signals / scale[:,None]
+    x = np.stack([init['S0']/scale, init['f'], init['D'], init['Dstar']], axis=1)
+    lower = np.array([0., BOUNDS['f'][0], BOUNDS['D'][0], BOUNDS['Dstar'][0]])
+    upper = np.array([np.inf, BOUNDS['f'][1], BOUNDS['D'][1], BOUNDS['Dstar'][1]])
+    x = np.clip(x, lower, upper)
+
+    def residuals(x, y):
+        return ivim_signal(bvals, *x.T) - y
+
+    def jacobian(x):
+        S0, f, D, Dstar = (p[:,None] for p in x.T)
+        b = bvals[None,:]
+        e1, e2 = np.exp(-b*Dstar), np.exp(-b*D)
+        return np.stack([f*e1 + (1-f)*e2, S0*(e1 - e2), -S0*(1-f)*b*e2, -S0*f*b*e1], axis=2)
+
+    r = residuals(x, y)
+    cost = np.sum(r**2, axis=1)
+    lam = np.full(len(x), 1e-3)
+    active = np.ones(len(x), dtype=bool)
+    eye = np.eye(4)
+
+    for it in range(iterations):
+        if not active.any():
+            break
+        xa, ra = x[active], r[active]
+
+        # damped normal equations (Marquardt scaling) for all active voxels at once
+        J = jacobian(xa)
+        JTJ = np.einsum('vbi,vbj->vij', J, J)
+        g = np.einsum('vbi,vb->vi', J, ra)
+        A = JTJ + lam[active][:,None,None]*(JTJ*eye) + 1e-12*eye
+        step = np.linalg.solve(A, -g[:,:,None])[:,:,0]
+
+        # accept steps that decrease the cost, otherwise increase damping
+        xnew = np.clip(xa + step, lower, upper)
+        rnew = residuals(xnew, y[active])
+        costnew = np.sum(rnew**2, axis=1)
+        better = costnew < cost[active]
+
+        ids = np.flatnonzero(active)
+        acc = ids[better]
+        converged = np.zeros(len(x), dtype=bool)
+        converged[acc] = ((cost[acc] - costnew[better]) <= tol*cost[acc]) | (costnew[better] <= tol**2)
+        x[acc], r[acc], cost[acc] = xnew[better], rnew[better], costnew[better]
+        lam[acc] /= 10
+        lam[ids[~better]] *= 10
+
+        # voxels stop when the cost no longer decreases (or damping becomes huge)
+        active &= ~converged & (lam < 1e10)
+
+    return {'S0': x[:,0]*scale, 'f': x[:,1], 'D': x[:,2], 'Dstar': x[:,3]}
+
+
+def fit_dictionary(signals, bvals, **kwargs):
+
+    """Dictionary (lookup table) fit - see ivim_dictionary.py"""
+
+    import ivim_dictionary
+    return ivim_dictionary.fit_dictionary(signals, bvals, **kwargs)
+
+
+# available fitting methods
+FIT_METHODS = {'segmented': fit_segmented,
+               'biexp': fit_biexp,
+               'dictionary': fit_dictionary}
+
+
+def fit_dir(txtpath, maskpath, method='biexp', workers=1, chunk_size=10000, **kwargs):
+
+    """Fit IVIM parameters of all voxels inside the mask and save parameter maps next to the averaged files
+
+    Args:
+        txtpath (str): path to bvalsFileNames_average.txt (or to the averaged stack - see load_signals)
+        maskpath (str): path to mask (.nrrd or bit-packed .npz)
+        method (str): name of the fitting method - see FIT_METHODS
+        workers (int): number of worker processes. If > 1, voxels are fitted in chunks in parallel (see fit_scheduler.py)
+        chunk_size (int): number of voxels per chunk (if workers > 1)
+        kwargs: passed to the fitting method (e.g. bthreshold)
+    Returns:
+        savenames (list): paths to saved parameter maps
+    """
+
+    if workers > 1:
+        import fit_scheduler
+        # signals are read straight into shared memory, so that they are not copied again for the workers
+        blocks = []
+        def empty(shape):
+            shm, array = fit_scheduler.create_shared(shape)
+            blocks.append(shm)
+            return array
+        try:
+            signals, bvals, idx, shape, header = load_signals(txtpath, maskpath, empty)
+            print(f"Fitting {len(idx)} voxels, b-values: {bvals.astype(int).tolist()}, method: {method}")
+            params = fit_scheduler.fit_parallel(signals, bvals, method, workers=workers, chunk_size=chunk_size, signals_shm=blocks[0], **kwargs)
+        finally:
+            signals = None
+            for shm in blocks:
+                fit_scheduler.release(shm)
+    else:
+        signals, bvals, idx, shape, header = load_signals(txtpath, maskpath)
+        print(f"Fitting {len(idx)} voxels, b-values: {bvals.astype(int).tolist()}, method: {method}")
+        params = FIT_METHODS[method](signals, bvals, **kwargs)
+
+    return save_maps(params, idx, shape, header, os.path.dirname(os.path.abspath(txtpath)), method)
+
+
+def save_maps(params, idx, shape, header, outputdir, method):
+
+    """Save parameter maps (zero outside of the mask) as <outputdir>/ivim_<method>_<param>.nrrd"""
+
+    savenames = []
+    for p in PARAMS:
+        vol = np.zeros(int(np.prod(shape)), dtype=np.float32)
+        vol[idx] = params[p]
+        savename = os.path.join(outputdir, f"ivim_{method}_{p}.nrrd")
+        nrrd.write(savename, vol.reshape(shape), header=header)
+        savenames.append(savename)
+        print(f"Saved: {savename}")
+
+    return savenames
+
+
+if __name__=='__main__':
+
+    main()
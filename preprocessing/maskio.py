@@ -0,0 +1,92 @@
+"""Compact storage of binary masks and a reader that returns boolean arrays (or voxel indices)
+
+    Masks created by create_masks.py are stored as uint8 .nrrd files (mask.nrrd). Optionally, a bit-packed sidecar (mask_packed.npz) can be written next to it.
+    The sidecar only stores the bounding box of the mask, with 1 bit per voxel - background voxels outside of the bounding box are not stored at all.
+
+    Usage (from python):
+
+        import maskio
+        mask = maskio.load_mask("averaged/mask.nrrd")                       # boolean array (x,y,z)
+        idx = maskio.load_mask("averaged/mask_packed.npz", indices=True)    # flat (C-order) indices of voxels inside the mask
+        signals = image.ravel()[idx]                                       # gather voxels for voxelwise fitting
+
+"""
+
+import os
+
+import numpy as np
+import nrrd
+
+
+def sidecar_path(maskpath):
+
+    """Path of the bit-packed sidecar of a mask (e.g. mask.nrrd -> mask_packed.npz)"""
+
+    return os.path.splitext(maskpath)[0] + "_packed.npz"
+
+
+def bounding_box(mask):
+
+    """Bounding box of nonzero voxels - list of (start, stop) per dimension"""
+
+    bbox = []
+    for axis in range(mask.ndim):
+        other = tuple(a for a in range(mask.ndim) if a != axis)
+        nonzero = np.flatnonzero(mask.any(axis=other))
+        bbox.append((nonzero[0], nonzero[-1]+1) if nonzero.size else (0, 0))
+    return bbox
+
+
+def write_packed(mask, savename):
+
+    """Write a mask as a bit-packed .npz file that stores only the bounding box of the mask"""
+
+    mask = np.asarray(mask) != 0
+    bbox = bounding_box(mask)
+    crop = mask[tuple(slice(start, stop) for start, stop in bbox)]
+    np.savez_compressed(savename, bits=np.packbits(crop, axis=None), shape=mask.shape, bbox=np.array(bbox, dtype=np.int64))
+
+    return savename
+
+
+def read_packed(path):
+
+    """Read a bit-packed mask. Returns (crop, shape, bbox) - the boolean crop of the bounding box, the full shape and the bounding box"""
+
+    with np.load(path) as f:
+        shape, bbox = tuple(f['shape']), f['bbox']
+        cropshape = tuple(bbox[:,1] - bbox[:,0])
+        crop = np.unpackbits(f['bits'], count=int(np.prod(cropshape))).view(bool).reshape(cropshape)
+    return crop, shape, bbox
+
+
+def load_mask(path, indices=False):
+
+    """Load a mask as a boolean array (or as flat indices of the voxels inside the mask)
+
+    Args:
+        path (str): mask.nrrd (any data type) or bit-packed mask_packed.npz
+        indices (bool): if True, return flat indices (C-order, i.e. np.ravel_multi_index over the (x,y,z) shape) of nonzero voxels instead of the full array
+    Returns:
+        mask (np.ndarray): boolean array (x,y,z) - or int64 array of indices
+
+    """
+
+    assert os.path.exists(path), f"Mask does not exist: {path}"
+
+    if path.endswith(".npz"):
+        crop, shape, bbox = read_packed(path)
+        if indices:
+            # indices are computed from the bounding box only - the full volume is never built
+            coords = np.nonzero(crop)
+            coords = tuple(c + start for c, start in zip(coords, bbox[:,0]))
+            return np.ravel_multi_index(coords, shape)
+        mask = np.zeros(shape, dtype=bool)
+        mask[tuple(slice(start, stop) for start, stop in bbox)] = crop
+    else:
+        mask, _ = nrrd.read(path)
+        mask = mask != 0
+        if indices:
+            return np.flatnonzero(mask)
+
+    return mask
@@ -0,0 +1,184 @@
+"""Generate a synthetic IVIM phantom in the same format as the output of DCM2NIIX (4D .nii.gz + .bval + .bvec + .json)
+
+    The phantom is an elliptical cylinder ("body") with an inner ellipse ("lesion") on a background of pure noise. Each region has known IVIM parameters (S0, f, D, D*), and the signal of each b-value and direction is:
+
+        S(b) = S0 * (f * exp(-b*D*) + (1-f) * exp(-b*D))
+
+    Rician noise with standard deviation `noise` is added to every voxel (magnitude of the signal plus complex gaussian noise), so the background follows a Rayleigh distribution as in real magnitude images.
+
+    The b-values are written to .bval in acquisition order (all directions of each b-value in sequence, e.g. 0 0 0 50 50 50 ...), as expected by process_nifti.py. Ground truth parameter maps are saved to <name>_truth.npz (arrays 'S0', 'f', 'D', 'Dstar' and 'body').
+
+    Usage:
+        python phantom.py -o <full path to output .nii.gz file>
+        python phantom.py -o /tmp/phantom/sub01.nii.gz --matrix 256 --slices 40 --bvals 0 50 100 200 400 600 800 --directions 6 --noise 15
+        python phantom.py -o /tmp/phantom/sub01.nii.gz --S0 1000 --f 0.1 --D 0.0015 --Dstar 0.02
+
+    or from python:
+
+        import phantom
+        impath = phantom.write_phantom("/tmp/phantom/sub01.nii.gz", matrix=128, slices=20)
+
+"""
+
+import argparse
+import os
+import json
+
+import numpy as np
+import nibabel as nb
+
+
+# default IVIM parameters of the two regions (D and D* in mm^2/s)
+BODY = {'S0': 1000., 'f': 0.1, 'D': 0.0015, 'Dstar': 0.02}
+LESION = {'S0': 1400., 'f': 0.25, 'D': 0.0008, 'Dstar': 0.05}
+
+
+def load_args():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output',type=str, required = True, help='full path to output 4D .nii.gz (or .nii) file')
+    parser.add_argument('--matrix',type=int,default=128,help='in-plane matrix size (matrix x matrix)')
+    parser.add_argument('--slices',type=int,default=20,help='number of slices')
+    parser.add_argument('--bvals',type=int,nargs='+',default=[0,50,100,200,400,600],help='b-values')
+    parser.add_argument('--directions',type=int,default=6,help='number of diffusion directions of each b-value')
+    parser.add_argument('--S0',type=float,default=BODY['S0'],help='S0 of the body')
+    parser.add_argument('--f',type=float,default=BODY['f'],help='perfusion fraction of the body')
+    parser.add_argument('--D',type=float,default=BODY['D'],help='diffusion coefficient of the body (mm^2/s)')
+    parser.add_argument('--Dstar',type=float,default=BODY['Dstar'],help='pseudo-diffusion coefficient of the body (mm^2/s)')
+    parser.add_argument('--noise',type=float,default=20.,help='standard deviation of the Rician noise')
+    parser.add_argument('--seed',type=int,default=0,help='random seed')
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+
+    # load input arguments
+    args = load_args()
+
+    assert args.output.endswith(".nii") or args.output.endswith(".nii.gz"), "Please provide path to a .nii or .nii.gz file"
+
+    body = {'S0': args.S0, 'f': args.f, 'D': args.D, 'Dstar': args.Dstar}
+    write_phantom(args.output, args.matrix, args.slices, args.bvals, args.directions, body, noise=args.noise, seed=args.seed)
+
+
+def phantom_regions(matrix, slices):
+
+    """Boolean (x,y,z) masks of the body and the lesion"""
+
+    x, y = np.mgrid[:matrix, :matrix] / matrix - 0.5
+    body = (x/0.4)**2 + (y/0.3)**2 < 1
+    lesion = ((x-0.1)/0.1)**2 + (y/0.08)**2 < 1
+
+    # body and lesion do not cover the first and last slice
+    inside = np.zeros(slices, dtype=bool)
+    inside[1:-1] = True
+
+    return body[:,:,None] & inside, lesion[:,:,None] & inside
+
+
+def parameter_maps(matrix, slices, body=None, lesion=None):
+
+    """Ground truth IVIM parameter maps (x,y,z) of the phantom"""
+
+    body = body or BODY
+    lesion = lesion or LESION
+    body_mask, lesion_mask = phantom_regions(matrix, slices)
+
+    maps = {}
+    for p in ['S0', 'f', 'D', 'Dstar']:
+        maps[p] = np.zeros((matrix, matrix, slices), dtype=np.float32)
+        maps[p][body_mask] = body[p]
+        maps[p][lesion_mask] = lesion[p]
+    maps['body'] = body_mask
+
+    return maps
+
+
+def gradient_directions(directions):
+
+    """Unit gradient directions spread over a hemisphere (golden spiral)"""
+
+    i = np.arange(directions) + 0.5
+    z = 1 - i/directions
+    phi = np.pi * (1 + 5**0.5) * i
+    r = np.sqrt(1 - z**2)
+    return np.stack([r*np.cos(phi), r*np.sin(phi), z], axis=1)
+
+
+def make_phantom(matrix=128, slices=20, bvals=(0,50,100,200,400,600), directions=6, body=None, lesion=None, noise=20., seed=0, dtype=np.int16):
+
+    """Simulate a 4D diffusion weighted phantom
+
+    Args:
+        matrix (int): in-plane matrix size
+        slices (int): number of slices
+        bvals (list): b-values (each acquired `directions` times)
+        directions (int): number of diffusion directions per b-value
+        body (dict): IVIM parameters of the body - see BODY
+        lesion (dict): IVIM parameters of the lesion - see LESION
+        noise (float): standard deviation of the Rician noise
+        seed (int): random seed
+        dtype: on-disk data type of the 4D image
+    Returns:
+        data (np.ndarray): 4D image (x,y,z,volume)
+        full_bvals (list): b-value of each volume
+        bvecs (np.ndarray): (3, volumes) gradient direction of each volume (zero for b=0)
+        maps (dict): ground truth parameter maps - see parameter_maps
+    """
+
+    rng = np.random.default_rng(seed)
+    maps = parameter_maps(matrix, slices, body, lesion)
+    dirs = gradient_directions(directions)
+
+    full_bvals = [b for b in bvals for _ in range(directions)]
+    bvecs = np.array([dirs[i % directions] if b > 0 else np.zeros(3) for i, b in enumerate(full_bvals)]).T
+
+    data = np.empty((matrix, matrix, slices, len(full_bvals)), dtype=dtype)
+    for i, b in enumerate(full_bvals):
+        signal = maps['S0'] * (maps['f']*np.exp(-b*maps['Dstar']) + (1-maps['f'])*np.exp(-b*maps['D']))
+        real = signal + rng.normal(0, noise, signal.shape)
+        imag = rng.normal(0, noise, signal.shape)
+        data[...,i] = np.round(np.sqrt(real**2 + imag**2))
+
+    return data, full_bvals, bvecs, maps
+
+
+def write_phantom(savename, matrix=128, slices=20, bvals=(0,50,100,200,400,600), directions=6, body=None, lesion=None, noise=20., seed=0, voxel_size=(1.5,1.5,5.)):
+
+    """Write a phantom as <name>.nii.gz + <name>.bval + <name>.bvec + <name>.json, and ground truth maps as <name>_truth.npz
+
+    Returns:
+        savename (str): path to the 4D image
+    """
+
+    data, full_bvals, bvecs, maps = make_phantom(matrix, slices, bvals, directions, body, lesion, noise, seed)
+
+    dirname = os.path.dirname(savename)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    name = savename[:-len(".nii.gz")] if savename.endswith(".nii.gz") else savename[:-len(".nii")]
+
+    affine = np.diag(list(voxel_size) + [1.])
+    nb.save(nb.Nifti1Image(data, affine), savename)
+
+    # dcm2niix style sidecars
+    with open(name + ".bval", 'w') as f:
+        f.write(' '.join(str(b) for b in full_bvals) + '\n')
+    with open(name + ".bvec", 'w') as f:
+        for row in bvecs:
+            f.write(' '.join(f"{v:g}" for v in row) + '\n')
+    with open(name + ".json", 'w') as f:
+        json.dump({'Phantom': True, 'Matrix': matrix, 'Slices': slices, 'bvals': list(bvals), 'Directions': directions,
+                   'Noise': noise, 'Seed': seed, 'Body': body or BODY, 'Lesion': lesion or LESION}, f, indent=4)
+    np.savez_compressed(name + "_truth.npz", **maps)
+
+    print(f"Saved phantom {data.shape} to: {savename}")
+
+    return savename
+
+
+if __name__=='__main__':
+
+    main()
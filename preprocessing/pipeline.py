@@ -0,0 +1,346 @@
+"""Run the full preprocessing pipeline in a single pass: 4D diffusion mosaic (nifti) -> geometric averages -> mask
+
+    Chains process_nifti.py, geometric_averages.py and create_masks.py in memory. The 4D input file is read once (one 3D volume at a time) and only the final outputs are written to disk:
+        <dir>/averaged/b<bval>_averaged.nrrd
+        <dir>/averaged/bvalsFileNames_average.txt
+        <dir>/averaged/mask.nrrd
+
+    where <dir> is the directory of the 4D input file.
+
+    The individual 3D files (e.g. b50#_2.nii.gz) are NOT written by default. Use '--save_directions' flag to write them as well (e.g. for debugging).
+
+    Use '--stack' to also save all averages in a single, memory-mappable 4D file (<dir>/averaged/averaged_stack.nrrd - see stackio.py).
+
+    Use '--memory_budget <MB>' for 4D files whose volumes (times the number of b-values) do not fit into memory. All stages are then run in slabs of slices that fit into the budget (see slabs.py) and outputs are written slab by slab - outputs are the same as in the whole-volume mode. A .nii.gz input is first decompressed into a temporary file next to the outputs (removed at the end), so that all volumes of a slab can be read without decompressing the file again.
+
+    Use '--qa' to compute quality statistics of each volume in the same pass (saved to <dir>/averaged/qa_report.json and qa_report.csv - see qa.py). With '--exclude_outliers' (implies '--qa'), directions flagged as outliers are left out of the averages - b-values with excluded directions are averaged again from the remaining directions (only their volumes are read again).
+
+    The same requirements apply to the input as in process_nifti.py - the 4D file must have a corresponding .bval file with CORRECT b-values.
+
+    Usage:
+        python pipeline.py -f <full path to .nii file>
+        python pipeline.py -f <full path to .nii file> --noabsolute --masktype simple
+        python pipeline.py -f <full path to .nii file> --save_directions
+        python pipeline.py -f <full path to .nii file> --packed
+        python pipeline.py -f <full path to .nii file> --stack
+        python pipeline.py -f <full path to .nii file> --cache --cache_store /path/to/shared/store --cache_store_size 50
+        python pipeline.py -f <full path to .nii file> --instrument --profile mask
+        python pipeline.py -f <full path to .nii file> --memory_budget 512
+        python pipeline.py -f <full path to .nii file> --qa --exclude_outliers
+
+    With '--cache', averaging is skipped if the 4D file and b-values have not changed since the last run, and the mask is skipped if b0_averaged.nrrd and mask parameters have not changed (see buildcache.py).
+
+    With '--instrument', time, memory and bytes read / written by each stage are saved to <dir>/averaged/instrument.json (see instrument.py). Add '--profile <stage>' to also profile a single stage ('split_average', 'write_txt', 'write_stack' or 'mask') with cProfile.
+
+"""
+
+import argparse
+import os
+from collections import Counter
+
+import numpy as np
+import nibabel as nb
+import nrrd
+
+import svtools as sv
+import buildcache as bc
+import process_nifti as pn
+import geometric_averages as ga
+import create_masks as cm
+import maskio
+import instrument
+import stackio
+import slabs
+import qa as qa_stats
+
+
+def load_args():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--file',type=str, required = True, help='full path to 4D .nii or .nii.gz file')
+    parser.add_argument('--noabsolute',action="store_true",help='if used, the paths of b-value files written to .txt files will be relative, not absolute')
+    parser.add_argument('--masktype',type=str,default='improved',choices=['improved','simple','dummy'],help='type of mask to create')
+    parser.add_argument('--save_directions',action="store_true",help='if used, individual 3D files (e.g. b50#_2.nii.gz) are also written to disk')
+    parser.add_argument('--packed',action="store_true",help='if used, a bit-packed copy of the mask is also saved (mask_packed.npz)')
+    parser.add_argument('--stack',action="store_true",help='if used, averages are also saved as a single 4D file (averaged/averaged_stack.nrrd)')
+    parser.add_argument('--cache',action="store_true",help='if used, stages are only rerun if their inputs or parameters changed')
+    parser.add_argument('--cache_store',type=str,default=None,help='optional path to a shared content-addressed cache store')
+    parser.add_argument('--cache_store_size',type=float,default=None,help='maximum size of the cache store in GB')
+    parser.add_argument('--instrument',action="store_true",help='if used, timings, memory and bytes read / written by each stage are saved to averaged/instrument.json')
+    parser.add_argument('--profile',type=str,default=None,choices=['split_average','write_txt','write_stack','mask'],help='name of a stage to profile with cProfile (saved as averaged/<stage>.prof, requires --instrument)')
+    parser.add_argument('--memory_budget',type=float,default=None,help='if used, all stages run in slabs of slices that fit into this many MB')
+    parser.add_argument('--qa',action="store_true",help='if used, quality statistics of each volume are saved to averaged/qa_report.json / qa_report.csv (see qa.py)')
+    parser.add_argument('--exclude_outliers',action="store_true",help='if used, directions flagged as outliers by QA are left out of the averages (implies --qa)')
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+
+    # load input arguments
+    args = load_args()
+
+    process_file(args, args.file)
+
+
+def process_file(args, im):
+
+    """Run the pipeline for a single 4D file (options are given by `args` - see load_args)"""
+
+    # perform basic checks
+    assert os.path.exists(im)
+    assert im.endswith(".nii") or im.endswith(".nii.gz"), "Please provide path to a .nii or .nii.gz file"
+
+    # get bvector
+    bval_path = im.replace(".nii", ".bval") if im.endswith(".nii") else im.replace(".nii.gz", ".bval")
+    assert os.path.exists(bval_path), f"Corresponding .bval files does not exist {bval_path}"
+    bvals = pn.get_bvector(bval_path)
+
+    # run
+    filepaths_type = 'relative' if args.noabsolute else 'absolute'
+    max_store_size = int(args.cache_store_size*1e9) if args.cache_store_size else None
+    if args.instrument:
+        instrument.start(os.path.abspath(im), profile=args.profile, profile_dir=get_outputdir(im))
+    outputdir = run_pipeline(im, bvals, masktype=args.masktype, save_directions=args.save_directions, filepaths_type=filepaths_type, packed=args.packed, stack=args.stack, cache=args.cache, cache_store=args.cache_store, max_store_size=max_store_size, memory_budget=args.memory_budget, qa=args.qa or args.exclude_outliers, exclude_outliers=args.exclude_outliers)
+    instrument.finish(outputdir + "instrument.json")
+
+
+def get_outputdir(impath):
+
+    """Output directory of the pipeline - <dir>/averaged/ where <dir> is the directory of the 4D file"""
+
+    dirname = os.path.dirname(impath)
+    dirname = dirname + "/" if dirname else ''
+    return dirname + "averaged/"
+
+
+def run_pipeline(impath, bvals, masktype='improved', save_directions=False, filepaths_type='absolute', packed=False, stack=False, cache=False, cache_store=None, max_store_size=None, memory_budget=None, qa=False, exclude_outliers=False):
+
+    """Split a 4D diffusion mosaic, geometrically average each b-value and create a mask - in a single pass over the input file
+
+    Args:
+        impath (str): full path to .nii file produced by the DCM2NIIX process
+        bvals (list): FULL list of b-values (one per volume in the 4D file) - see process_nifti.convert_4D_to_3D
+        masktype (str): type of mask - see create_masks.create_mask
+        save_directions (bool): if True, also write individual 3D files (b<bval>#_<dir>.nii.gz) next to the input file
+        filepaths_type (str): 'absolute' or 'relative' paths in bvalsFileNames_average.txt
+        packed (bool): if True, also save a bit-packed copy of the mask (mask_packed.npz)
+        stack (bool): if True, also save all averages in a single 4D file (averaged_stack.nrrd - see stackio.py)
+        cache (bool): if True, stages are only rerun if their inputs or parameters changed (see buildcache.py)
+        cache_store (str): optional path to a shared content-addressed cache store
+        max_store_size (int): maximum size of the cache store in bytes
+        memory_budget (float): if given (MB), all stages run in slabs of slices that fit into the budget (see average_4D_slabs, create_masks.mask_slabs)
+        qa (bool): if True, QA statistics of each volume are saved to <outputdir>/qa_report.json / qa_report.csv (see qa.py)
+        exclude_outliers (bool): if True (and `qa`), outlier directions are left out of the averages
+    Returns:
+        outputdir (str): directory with averaged files and the mask
+
+    """
+
+    assert os.path.exists(impath)
+
+    outputdir = get_outputdir(impath)
+    os.makedirs(outputdir, exist_ok=True)
+
+    # 1-2. Split + geometric averages
+    averages = {}
+    avg_files = [outputdir + "b" + str(bvalnum) + "_averaged.nrrd" for bvalnum in sorted(set(bvals))]
+    if memory_budget is None:
+        run = lambda: averages.update(average_4D(impath, bvals, outputdir, save_directions, qa, exclude_outliers))
+    else:
+        # averages are never held in memory - later stages read them back slab by slab
+        run = lambda: average_4D_slabs(impath, bvals, outputdir, memory_budget, save_directions, qa, exclude_outliers)
+    outputs = avg_files + (pn.get_savenames(impath, bvals) if save_directions else []) + (qa_stats.report_paths(outputdir) if qa else [])
+    with instrument.stage('split_average', inputs=[impath], outputs=outputs):
+        if cache:
+            params = {'bvals': bvals, 'save_directions': save_directions, 'qa': qa, 'exclude_outliers': exclude_outliers}
+            bc.cached_stage('split_average', [impath], params, outputs, run, outputdir, cache_store, max_store_size)
+        else:
+            run()
+    with instrument.stage('write_txt', outputs=[outputdir + "bvalsFileNames_average.txt"]):
+        ga.write_bvalsFileNames_average(outputdir, sorted(set(bvals)), '.nrrd', filepaths_type, overwrite=True)
+    if stack:
+        with instrument.stage('write_stack', outputs=[outputdir + stackio.STACK_NAME]):
+            if averages:
+                stackio.write_stack((averages[b] for b in sorted(averages)), sorted(averages), nrrd.read_header(avg_files[0]), outputdir + stackio.STACK_NAME)
+            else:
+                # averages were not recomputed (cache) - read them back
+                stackio.write_stack_from_files(avg_files, sorted(set(bvals)), outputdir + stackio.STACK_NAME, memory_budget)
+
+    # 3. Mask
+    assert 0 in bvals, "No b0 volumes found - cannot create mask"
+    b0path = outputdir + "b0_averaged.nrrd"
+    if memory_budget is None:
+        run = lambda: write_mask(averages.get(0), b0path, masktype, packed)
+    else:
+        run = lambda: cm.mask_slabs(b0path, outputdir + "mask.nrrd", masktype, packed, memory_budget)
+    outputs = [outputdir + "mask.nrrd", outputdir + "mask_packed.npz"] if packed else [outputdir + "mask.nrrd"]
+    with instrument.stage('mask', inputs=[] if 0 in averages else [b0path], outputs=outputs):
+        if cache:
+            params = dict(cm.MASK_PARAMS, masktype=masktype)
+            bc.cached_stage('mask', [b0path], params, outputs, run, outputdir, cache_store, max_store_size)
+        else:
+            run()
+
+    return outputdir
+
+
+def average_4D(impath, bvals, outputdir, save_directions=False, qa=False, exclude_outliers=False):
+
+    """Geometrically average each b-value of a 4D diffusion mosaic, reading each volume once. Averages are written to <outputdir>/b<bval>_averaged.nrrd
+
+    If `qa`, QA statistics of each volume are computed in the same pass and saved to <outputdir>/qa_report.json / qa_report.csv. If `exclude_outliers`, b-values with outlier directions are averaged again without them (see qa.py).
+
+    Returns:
+        averages (dict): b-value -> averaged volume (float32)
+    """
+
+    # keep the (gzip) file handle open between volumes - volumes are read in order, so the file is only decompressed once
+    imo = nb.load(impath, keep_file_open=True)
+    assert len(bvals) == imo.shape[-1], "length of the original vector must be the same as the image produced by the dcm2nii converter"
+
+    # header for individual 3D files (if written)
+    header = imo.header.copy()
+    header['dim'][4] = 1
+    savenames = pn.get_savenames(impath, bvals)
+
+    # read each volume once and add it to the running (log domain) sum of its b-value
+    acc = {}
+    c = Counter()
+    stats = []
+    buf = np.empty(imo.shape[:3], dtype=np.float32)
+    for i, bvalnum in enumerate(bvals):
+
+        vol = pn.read_volume(imo, i)
+        if qa:
+            stats.append(qa_stats.volume_stats([qa_stats.partial_stats(vol)]))
+
+        if save_directions:
+            pn.save_volume(vol, imo.affine, header, savenames[i])
+
+        if bvalnum not in acc:
+            acc[bvalnum] = np.zeros(imo.shape[:3], dtype=np.float32)
+        ga.add_log(acc[bvalnum], vol, buf)
+        c[bvalnum] += 1
+
+    # QA report - b-values with excluded outliers are summed again without them
+    if qa:
+        report = qa_stats.qa_report(bvals, stats, pn.get_savenames(impath, bvals))
+        qa_stats.write_report(report, outputdir)
+        if exclude_outliers:
+            for bvalnum, kept in kept_volumes(bvals, qa_stats.excluded_volumes(report)).items():
+                acc[bvalnum][:] = 0
+                for i in kept:
+                    ga.add_log(acc[bvalnum], pn.read_volume(imo, i), buf)
+                c[bvalnum] = len(kept)
+
+    # geometric averages
+    nrrd_header = sv.nifti2nrrd_header(imo.affine)
+    averages = {}
+    for bvalnum in sorted(acc):
+        averages[bvalnum] = ga.exp_mean(acc[bvalnum], c[bvalnum])
+        savename = outputdir + "b" + str(bvalnum) + "_averaged.nrrd"
+        nrrd.write(savename, averages[bvalnum], header=nrrd_header)
+        print(f"Averaged {c[bvalnum]} volumes: {savename}")
+
+    return averages
+
+
+def kept_volumes(bvals, excluded):
+
+    """Volumes of each b-value that has excluded volumes - b-value -> indices of the remaining volumes"""
+
+    return {bvalnum: [i for i, b in enumerate(bvals) if b == bvalnum and i not in excluded] for bvalnum in sorted({bvals[i] for i in excluded})}
+
+
+def average_4D_slabs(impath, bvals, outputdir, memory_budget, save_directions=False, qa=False, exclude_outliers=False):
+
+    """Geometrically average each b-value of a 4D diffusion mosaic in slabs of slices - same outputs as average_4D
+
+    For each slab, all volumes are read (from a memory-mapped, uncompressed copy of the input - see slabs.uncompressed) and averaged, and the slab of each average is appended to its b<bval>_averaged.nrrd file. QA statistics (if `qa`) are collected slab by slab - with `exclude_outliers`, b-values with outlier directions are averaged again from their remaining volumes.
+    """
+
+    with slabs.uncompressed(impath, outputdir) as path:
+        imo = nb.load(path, mmap=True)
+        assert len(bvals) == imo.shape[-1], "length of the original vector must be the same as the image produced by the dcm2nii converter"
+
+        # individual 3D files - one volume at a time, slab by slab
+        if save_directions:
+            header = imo.header.copy()
+            header['dim'][4] = 1
+            for i, savename in enumerate(pn.get_savenames(impath, bvals)):
+                pn.save_volume_slabs(imo, i, header, savename, memory_budget)
+
+        groups = {bvalnum: [i for i, b in enumerate(bvals) if b == bvalnum] for bvalnum in sorted(set(bvals))}
+        parts = [[] for _ in bvals] if qa else None
+        write_slab_averages(imo, groups, outputdir, memory_budget, parts)
+
+        if qa:
+            report = qa_stats.qa_report(bvals, [qa_stats.volume_stats(p) for p in parts], pn.get_savenames(impath, bvals))
+            qa_stats.write_report(report, outputdir)
+            if exclude_outliers:
+                kept = kept_volumes(bvals, qa_stats.excluded_volumes(report))
+                if kept:
+                    write_slab_averages(imo, kept, outputdir, memory_budget)
+
+
+def write_slab_averages(imo, groups, outputdir, memory_budget, stats=None):
+
+    """Write the geometric average of each b-value, slab by slab
+
+    Args:
+        imo (nibabel image): 4D image (memory-mapped)
+        groups (dict): b-value -> indices of the volumes that are averaged
+        outputdir (str): averages are written to <outputdir>/b<bval>_averaged.nrrd
+        memory_budget (float): memory budget in MB
+        stats (list): if given, one list per volume of the 4D image - QA statistics of each slab of the volume are appended to it (see qa.partial_stats)
+    """
+
+    shape = imo.shape[:3]
+    volumes = sorted((i, bvalnum) for bvalnum, indices in groups.items() for i in indices)
+
+    # per slice: running sum of each b-value + buffer (float32) + one volume slab (up to float64 after scaling)
+    size = slabs.slab_size(shape[0] * shape[1] * (4 * (len(groups) + 1) + 8), memory_budget, shape[2])
+
+    nrrd_header = sv.nifti2nrrd_header(imo.affine)
+    writers = {bvalnum: slabs.nrrd_writer(outputdir + "b" + str(bvalnum) + "_averaged.nrrd", shape, np.float32, nrrd_header) for bvalnum in sorted(groups)}
+    try:
+        for z0, z1 in slabs.slab_ranges(shape[2], size):
+            acc = {bvalnum: np.zeros(shape[:2] + (z1 - z0,), dtype=np.float32) for bvalnum in groups}
+            buf = np.empty(shape[:2] + (z1 - z0,), dtype=np.float32)
+            for i, bvalnum in volumes:
+                vol = pn.read_volume(imo, i, slices=(z0, z1))
+                ga.add_log(acc[bvalnum], vol, buf)
+                if stats is not None:
+                    stats[i].append(qa_stats.partial_stats(vol))
+            for bvalnum in sorted(groups):
+                writers[bvalnum].write(ga.exp_mean(acc[bvalnum], len(groups[bvalnum])))
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    for bvalnum in sorted(groups):
+        print(f"Averaged {len(groups[bvalnum])} volumes: {outputdir}b{bvalnum}_averaged.nrrd")
+
+
+def write_mask(b0, b0path, masktype='improved', packed=False):
+
+    """Create mask from b0 image and save it next to b0_averaged.nrrd. If `b0` is None, it is read from `b0path`. If `packed` - also save a bit-packed copy"""
+
+    if b0 is None:
+        b0, header = sv.read_image(b0path)
+    else:
+        header = nrrd.read_header(b0path)
+    mask = cm.create_mask(b0, masktype)
+    savename = b0path.replace("b0_averaged.nrrd", "mask.nrrd")
+    with sv.atomic_write(savename) as tmp:
+        nrrd.write(tmp, mask, header=header)
+    if packed:
+        maskio.write_packed(mask, maskio.sidecar_path(savename))
+    print(f"Saved mask to: {savename}")
+
+
+if __name__=='__main__':
+
+    main()
@@ -0,0 +1,250 @@
+"""Fast, downsampled preview of the preprocessing pipeline - to check b-value ordering, averaging and masks of every subject before a full cohort run
+
+    For each 4D diffusion mosaic, only every <factor>-th voxel in-plane and a few evenly spaced slices of every volume are read from the file (strided slicing of nibabel's proxy - the full 4D array is never loaded). The same stages as in pipeline.py then run on this small grid:
+        1. geometric average of each b-value (geometric_averages.add_log / exp_mean)
+        2. mask of the b0 average (create_masks.create_mask, with sizes and areas scaled to the grid - see create_masks.scale_mask_params)
+        3. check of the b-values - the mean signal inside the mask must decrease with the b-value (a wrong .bval file, or low b-values written as 0, usually break this)
+
+    A quick-look .png montage is written for each subject - one row per b-value average and a last row with the mask over the b0 average, one column per sampled slice. b-value averages share the intensity window of b0, so the signal decay is visible. Warnings are printed at the end and written into the montage.
+
+    The montage is saved as <dir>/preview.png (next to the 4D file), or as <output>/<subject>_preview.png with '--output'.
+
+    Usage:
+        python preview.py -f <4D file> <4D file> ...
+        python preview.py -m <manifest .txt file with one subject directory per line> --workers 16 --output previews/
+        python preview.py -f <4D file> --factor 2 --slices 12
+        python preview.py -f <4D file> --protocol <protocol .txt file>
+
+"""
+
+import argparse
+import os
+import sys
+import time
+import traceback
+
+import numpy as np
+import nibabel as nb
+import cv2
+
+import process_nifti as pn
+import geometric_averages as ga
+import create_masks as cm
+from run_cohort import load_manifest, find_4D_file, run_pool
+
+
+def load_args():
+
+    parser = argparse.ArgumentParser()
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-f', '--files',type=str,nargs='+', help='4D .nii or .nii.gz files (with corresponding .bval files)')
+    group.add_argument('-m', '--manifest',type=str, help='.txt file with one subject directory per line (lines starting with # are ignored) - see run_cohort.py')
+    parser.add_argument('-o', '--output',type=str,default=None,help='directory for all montages (<subject>_preview.png). Default - preview.png next to each 4D file')
+    parser.add_argument('--factor',type=int,default=4,help='in-plane downsampling factor - every <factor>-th voxel is read')
+    parser.add_argument('--slices',type=int,default=8,help='number of (evenly spaced) slices that are read')
+    parser.add_argument('--masktype',type=str,default='improved',choices=['improved','simple','dummy'],help='type of mask to create')
+    parser.add_argument('--protocol',type=str,default=None,help='.txt file with the b-values given to the scanner (one per volume) - see process_nifti.py')
+    parser.add_argument('--tile',type=int,default=96,help='size of each slice in the montage (pixels)')
+    parser.add_argument('--workers',type=int,default=os.cpu_count(),help='number of subjects processed in parallel')
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+
+    # load input args
+    args = load_args()
+
+    # subject directories are resolved to their 4D file by the workers (see run_cohort.find_4D_file)
+    files = load_manifest(args.manifest) if args.manifest else args.files
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+
+    results = preview_cohort(files, args.output, factor=args.factor, nslices=args.slices, masktype=args.masktype, protocol=args.protocol, tile=args.tile, workers=args.workers)
+
+    # non-zero exit code if any subject failed
+    if any(r['status'] == 'failed' for r in results):
+        sys.exit(1)
+
+
+def read_preview(impath, factor=4, nslices=8):
+
+    """Read a strided subset of a 4D file - every `factor`-th voxel in-plane and `nslices` evenly spaced slices of every volume
+
+    Returns:
+        data (np.ndarray): (x/factor, y/factor, nslices, volumes) - scaled as in nibabel
+        zs (list): indices of the sampled slices
+    """
+
+    imo = nb.load(impath)
+    nz = imo.shape[2]
+    nslices = min(nslices, nz)
+    step = max(1, nz // nslices)
+    start = (nz - 1 - step * (nslices - 1)) // 2
+    zsl = slice(start, start + step * (nslices - 1) + 1, step)
+
+    # strided slicing of the proxy - only the sampled slices are read (the file is memory-mapped if uncompressed)
+    data = np.asanyarray(imo.dataobj[::factor, ::factor, zsl, :])
+    return data, list(range(nz))[zsl]
+
+
+def check_bvals(signal):
+
+    """Warnings about the b-values - the mean signal inside the mask must decrease with the b-value
+
+    Args:
+        signal (dict): b-value -> mean signal of its average inside the mask
+    """
+
+    warnings = []
+    bvals = sorted(signal)
+    for b1, b2 in zip(bvals[:-1], bvals[1:]):
+        if signal[b2] > signal[b1]:
+            warnings.append(f"signal of b{b2} ({signal[b2]:.1f}) > b{b1} ({signal[b1]:.1f})")
+    return warnings
+
+
+def to_tile(sl, tile, window):
+
+    """Slice (x,y) -> uint8 image (rows = y, anterior up) of size `tile`, with intensities scaled to [0, window]"""
+
+    img = np.flipud(sl.T)
+    img = np.clip(img / window * 255, 0, 255).astype(np.uint8) if window > 0 else np.zeros(img.shape, dtype=np.uint8)
+    scale = tile / max(img.shape)
+    return cv2.resize(img, (max(1, round(img.shape[1] * scale)), max(1, round(img.shape[0] * scale))), interpolation=cv2.INTER_NEAREST)
+
+
+def montage(averages, mask, zs, title, warnings=(), tile=96):
+
+    """Montage (BGR) of the averages of each b-value and of the mask over b0 - one row per b-value (+ mask), one column per slice"""
+
+    margin, header = 70, 40 + 18 * len(warnings)
+    b0 = averages[min(averages)]
+    inside = b0[mask > 0] if mask.any() else b0.ravel()
+    window = float(np.percentile(inside, 99.5)) if inside.size else 0
+
+    rows = []
+    for bvalnum in sorted(averages):
+        tiles = [to_tile(averages[bvalnum][:,:,k], tile, window) for k in range(len(zs))]
+        rows.append((f"b{bvalnum}", [cv2.cvtColor(t, cv2.COLOR_GRAY2BGR) for t in tiles]))
+
+    # mask in red over b0
+    tiles = []
+    for k in range(len(zs)):
+        t = cv2.cvtColor(to_tile(b0[:,:,k], tile, window), cv2.COLOR_GRAY2BGR)
+        m = to_tile(mask[:,:,k].astype(np.float32), tile, 1) > 0
+        t[m] = (0.6 * t[m] + 0.4 * np.array([0, 0, 255])).astype(np.uint8)
+        tiles.append(t)
+    rows.append(("mask", tiles))
+
+    th, tw = tiles[0].shape[:2]
+    canvas = np.zeros((header + 16 + len(rows) * (th + 2), margin + len(zs) * (tw + 2), 3), dtype=np.uint8)
+    cv2.putText(canvas, title, (5, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+    for j, w in enumerate(warnings):
+        cv2.putText(canvas, "WARNING: " + w, (5, 38 + 18 * j), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (0, 0, 255), 1)
+    for k, z in enumerate(zs):
+        cv2.putText(canvas, f"z={z}", (margin + k * (tw + 2), header + 12), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (200, 200, 200), 1)
+    for r, (name, row) in enumerate(rows):
+        y = header + 16 + r * (th + 2)
+        cv2.putText(canvas, name, (5, y + th // 2), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (255, 255, 255), 1)
+        for k, t in enumerate(row):
+            canvas[y:y + th, margin + k * (tw + 2):margin + k * (tw + 2) + tw] = t
+
+    return canvas
+
+
+def get_savename(impath, output=None):
+
+    """preview.png next to the 4D file, or <output>/<subject>_preview.png (subject - name of the directory of the 4D file)"""
+
+    dirname = os.path.dirname(os.path.abspath(impath))
+    if output is None:
+        return os.path.join(dirname, "preview.png")
+    return os.path.join(output, os.path.basename(dirname) + "_preview.png")
+
+
+def preview_subject(impath, output=None, factor=4, nslices=8, masktype='improved', protocol=None, tile=96):
+
+    """Run the preview of a single 4D file (or of the 4D file in a subject directory) and save its montage. Never raises - errors are returned in the result
+
+    Returns:
+        result (dict): {'file', 'status', 'time', 'png', 'signal' (b-value -> mean signal inside the mask), 'mask_fraction', 'warnings', 'error'}
+    """
+
+    result = {'file': impath, 'status': None, 'time': None, 'png': None, 'signal': None, 'mask_fraction': None, 'warnings': [], 'error': None}
+    start = time.time()
+    try:
+        if os.path.isdir(impath):
+            impath = find_4D_file(impath)
+        bval_path = impath.replace(".nii.gz", ".bval") if impath.endswith(".nii.gz") else impath.replace(".nii", ".bval")
+        assert os.path.exists(bval_path), f"Corresponding .bval files does not exist {bval_path}"
+        bvals = pn.get_bvector(bval_path)
+        if protocol:
+            bvals = pn.correct_bvals(bvals, pn.read_protocol(protocol))
+
+        # 1. strided read + geometric averages
+        data, zs = read_preview(impath, factor, nslices)
+        assert len(bvals) == data.shape[-1], "length of the b-value vector must be the same as the number of volumes"
+        acc, c = {}, {}
+        for i, bvalnum in enumerate(bvals):
+            if bvalnum not in acc:
+                acc[bvalnum], c[bvalnum] = np.zeros(data.shape[:3], dtype=np.float32), 0
+            ga.add_log(acc[bvalnum], data[..., i])
+            c[bvalnum] += 1
+        averages = {bvalnum: ga.exp_mean(acc[bvalnum], c[bvalnum]) for bvalnum in sorted(acc)}
+
+        # 2. mask with parameters scaled to the grid
+        assert 0 in averages, "No b0 volumes found - cannot create mask"
+        mask = cm.create_mask(averages[0], masktype, **cm.scale_mask_params(factor))
+        result['mask_fraction'] = round(float(mask.mean()), 4)
+        if not mask.any():
+            result['warnings'].append("mask is empty")
+
+        # 3. b-value check
+        inside = mask > 0 if mask.any() else np.ones(mask.shape, dtype=bool)
+        result['signal'] = {int(b): round(float(v[inside].mean()), 3) for b, v in averages.items()}
+        result['warnings'] += check_bvals(result['signal'])
+
+        title = f"{impath}  ({len(bvals)} volumes, every {factor} voxels, {len(zs)} slices, mask {100*result['mask_fraction']:.1f}%)"
+        result['png'] = get_savename(impath, output)
+        assert cv2.imwrite(result['png'], montage(averages, mask, zs, title, result['warnings'], tile)), f"Could not write {result['png']}"
+        result['status'] = 'warning' if result['warnings'] else 'ok'
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    result['time'] = round(time.time() - start, 2)
+
+    return result
+
+
+def preview_cohort(files, output=None, factor=4, nslices=8, masktype='improved', protocol=None, tile=96, workers=None):
+
+    """Preview many 4D files in parallel (see preview_subject). A worker process that dies (e.g. out of memory) fails only its own file - see run_cohort.run_pool
+
+    Returns:
+        results (list): result of each file, in the order of `files`
+    """
+
+    n = len(files)
+    results = [None] * n
+    for k, (i, result, error) in enumerate(run_pool(preview_subject, files, workers, (output, factor, nslices, masktype, protocol, tile))):
+        if error is not None:
+            # worker process died (e.g. out of memory)
+            result = {'file': files[i], 'status': 'failed', 'time': None, 'png': None, 'signal': None, 'mask_fraction': None, 'warnings': [], 'error': error}
+        results[i] = result
+        print(f"[{k+1}/{n}] {result['status']} ({result['time']}s): {result['png'] or result['file']}")
+
+    print(f"Previewed {n} files: {sum(r['status'] == 'ok' for r in results)} ok, {sum(r['status'] == 'warning' for r in results)} with warnings, {sum(r['status'] == 'failed' for r in results)} failed")
+    for r in results:
+        if r['status'] == 'warning':
+            print(f"WARNING: {r['file']}: " + "; ".join(r['warnings']))
+        elif r['status'] == 'failed':
+            print(f"FAILED: {r['file']}\n{r['error']}")
+
+    return results
+
+
+if __name__=='__main__':
+
+    main()
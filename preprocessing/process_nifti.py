@@ -4,7 +4,7 @@
 
     Note that the .bval file CAN have randomly ordered b-values (e.g. 0 0 0 100 100 100 200 200 200 50 50 50 600 600 600 is OKAY). 
     
-    However, you must ensure that the b-values listed in .bval file are CORRECT values. The new 3T scanner sometimes lists low b-values (e.g. b=20) as '0' in the .bval file. Therefore .bval file may need to be edited manually. There may be a script available later which corrects .bval automatically (however this has not yet been completed).
+    However, you must ensure that the b-values listed in .bval file are CORRECT values. The new 3T scanner sometimes lists low b-values (e.g. b=20) as '0' in the .bval file. Therefore .bval file may need to be edited manually - or use '--protocol' with a .txt file that lists the b-values given to the scanner (one per volume, in acquisition order, same format as .bval). The .bval values are then checked against the protocol and low b-values written as '0' are corrected automatically (see correct_bvals). 
 
     The output 3D files are created in the correct naming convention for further processing. 
     e.g. b50#_2.nii.gz - where 50 refers to b-value and 2 refers to direction.
@@ -12,21 +12,58 @@
     Usage: 
         python process_nifti.py -f <full_path_to_.nii_file> 
         python process_nifti.py -f <full path to .nii file> -d <# of diffusion directions, default = 6>
+        python process_nifti.py -f <full path to .nii file> --stream
+        python process_nifti.py -f <full path to .nii file> --workers 8 --compresslevel 1
+        python process_nifti.py -f <full path to .nii file> --workers 8 --uncompressed
+        python process_nifti.py -f <full path to .nii file> --cache
+        python process_nifti.py -f <full path to .nii file> --instrument
+        python process_nifti.py -f <full path to .nii file> --protocol <protocol .txt file>
+        python process_nifti.py -f <full path to .nii file> --memory_budget 256
+        python process_nifti.py -f <full path to .nii file> --qa
+    
+    Use '--stream' for large 4D files. In this mode the 4D file is never loaded into memory as a whole - each 3D volume is read (and memory-mapped, if the input is an uncompressed .nii) one at a time, and written with the same data type and scaling as the input file. 
+    
+    Use '--memory_budget <MB>' if even a single 3D volume is too large. Each volume is then read and written in slabs of slices that fit into the budget (see slabs.py) - output files are the same as with '--stream'. 
+    
+    Use '--workers' to compress and write the 3D files in parallel (threads by default, or processes with '--pool process'). The gzip level of the output files can be set with '--compresslevel' (0-9), or the files can be written as uncompressed .nii files with '--uncompressed' (fastest option if the files are processed further by geometric_averages.py straight away). 
+    
+    Use '--qa' to compute quality statistics of each volume (mean, corner noise, SNR, deviation from the other directions of its b-value) while the file is split, and save them to qa_report.json / qa_report.csv next to the 3D files. Outlier directions are flagged in the report, and can be left out of the geometric averages with 'geometric_averages.py --exclude_outliers' (see qa.py). 
+    
+    Use '--cache' to skip the conversion if the 4D file, b-values and output options have not changed since the 3D files were last written (see buildcache.py). 
     
 """
 
 
 import argparse
 import os 
+import gzip 
 import numpy as np
 import nibabel as nb 
-from collections import Counter 
+from collections import Counter, deque 
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import buildcache as bc 
+import instrument 
+import slabs 
+import qa as qa_stats 
 
 def load_args():
     
     parser = argparse.ArgumentParser()
     parser.add_argument('-f', '--file',type=str, required = True, help='full paths to directories to be processed')
     parser.add_argument('-d','--directions',type=int,default = 6, help='directions for bval')
+    parser.add_argument('--protocol',type=str,default=None,help='.txt file with the b-values given to the scanner (one per volume) - b-values of the .bval file are checked and corrected against it')
+    parser.add_argument('--stream',action="store_true",help='if used, 3D volumes are read one at a time (peak memory of a single 3D volume) and keep the data type and scaling of the input file')
+    parser.add_argument('--workers',type=int,default=1,help='number of parallel workers that compress and write the 3D files')
+    parser.add_argument('--pool',type=str,default='thread',choices=['thread','process'],help='type of the writer pool')
+    parser.add_argument('--compresslevel',type=int,default=None,choices=range(0,10),metavar='[0-9]',help='gzip compression level of the output .nii.gz files (default - nibabel default)')
+    parser.add_argument('--uncompressed',action="store_true",help='if used, 3D files are written as uncompressed .nii files')
+    parser.add_argument('--memory_budget',type=float,default=None,help='if used, volumes are read and written in slabs of slices that fit into this many MB (implies --stream)')
+    parser.add_argument('--qa',action="store_true",help='if used, quality statistics of each volume are computed while splitting and saved to qa_report.json / qa_report.csv (see qa.py)')
+    parser.add_argument('--cache',action="store_true",help='if used, 3D files are only rewritten if the 4D file, b-values or output options changed')
+    parser.add_argument('--cache_store',type=str,default=None,help='optional path to a shared content-addressed cache store')
+    parser.add_argument('--cache_store_size',type=float,default=None,help='maximum size of the cache store in GB')
+    parser.add_argument('--instrument',action="store_true",help='if used, timings, memory and bytes read / written are saved to instrument_split.json next to the 4D file (see instrument.py)')
     args = parser.parse_args()
     
     return args
@@ -38,7 +75,10 @@ def main():
     # load input arguments
     args = load_args()
     
-    im = args.file
+    process_file(args, args.file)
+    
+def process_file(args, im):
+    """Split a single 4D file (options are given by `args` - see load_args)"""
     
     # perform basic checks
     assert os.path.exists(im)
@@ -48,9 +88,24 @@ def main():
     bval_path = im.replace(".nii", ".bval") if im.endswith(".nii") else im.replace(".nii.gz", ".bval")
     assert os.path.exists(bval_path), f"Corresponding .bval files does not exist {bval_path}"
     bvals = get_bvector(bval_path)
+    if args.protocol: 
+        bvals = correct_bvals(bvals, read_protocol(args.protocol))
 
     # convert nifti file 
-    convert_4D_to_3D(im, bvals, args.directions)    
+    run = lambda: convert_4D_to_3D(im, bvals, args.directions, stream=args.stream, workers=args.workers, pool=args.pool, compresslevel=args.compresslevel, uncompressed=args.uncompressed, memory_budget=args.memory_budget, qa=args.qa)    
+    outputs = get_savenames(im, bvals, args.uncompressed)
+    if args.qa: 
+        outputs = outputs + qa_stats.report_paths(os.path.dirname(im))
+    if args.instrument: 
+        instrument.start(os.path.abspath(im))
+    with instrument.stage('split', inputs=[im], outputs=outputs): 
+        if args.cache: 
+            params = {'bvals': bvals, 'directions': args.directions, 'stream': args.stream or args.memory_budget is not None, 'compresslevel': args.compresslevel, 'uncompressed': args.uncompressed, 'qa': args.qa}
+            max_store_size = int(args.cache_store_size*1e9) if args.cache_store_size else None
+            bc.cached_stage('split', [im], params, outputs, run, os.path.dirname(os.path.abspath(im)), args.cache_store, max_store_size)
+        else: 
+            run()
+    instrument.finish(os.path.join(os.path.dirname(os.path.abspath(im)), "instrument_split.json"))
     
     
 
@@ -69,7 +124,113 @@ def get_bvector(bval_path):
 
     return bvals
     
-def convert_4D_to_3D(impath, original_bvals, directions):
+def read_protocol(path):
+    """Read the b-values given to the scanner from a .txt file (whitespace separated, one per volume - same format as .bval)"""
+    
+    with open(path) as f: 
+        return [int(round(float(b))) for b in f.read().split()]
+
+def correct_bvals(bvals, protocol, tolerance=0.05, low_bval=50):
+    """Check b-values reported by the scanner against the protocol (b-values given to the scanner) and correct them 
+    
+    The scanner may round b-values, and it lists low b-values (e.g. b=20) as '0'. Reported values are replaced by the protocol values if: 
+        - they differ by less than `tolerance` (relative) or 5 s/mm^2, or 
+        - the reported value is 0 and the protocol value is a low b-value (<= low_bval) 
+    Any other difference means that the protocol does not match the scan (e.g. wrong order of b-values) and raises an error. 
+    
+    Args: 
+        bvals (list): b-values of each volume as reported by the scanner (.bval file or dicom headers)
+        protocol (list): b-values given to the scanner, one per volume, in acquisition order 
+    Returns: 
+        corrected (list): protocol b-values (int)
+    """
+    
+    assert len(bvals) == len(protocol), f"Number of b-values in the protocol ({len(protocol)}) is not the same as the number of volumes ({len(bvals)})"
+    
+    corrected = []
+    for i, (b, p) in enumerate(zip(bvals, protocol)): 
+        if abs(b - p) <= max(5, tolerance*p) or (b == 0 and p <= low_bval): 
+            if round(b) != p: 
+                print(f"Corrected b-value of volume {i}: {b} -> {p}")
+            corrected.append(int(p))
+        else: 
+            raise AssertionError(f"b-value of volume {i} ({b}) does not match the protocol ({p}). Please check the order of b-values in the protocol")
+    
+    return corrected 
+    
+def get_savenames(impath, bvals, uncompressed=False):
+    """Paths of the 3D files written by convert_4D_to_3D (e.g. b50#_2.nii.gz), one per volume of the 4D file"""
+    
+    dirname = os.path.dirname(impath)
+    dirname = dirname + "/" if dirname else ''
+    ext = ".nii" if uncompressed else ".nii.gz"
+    
+    c = Counter()
+    savenames = []
+    for bvalnum in bvals: 
+        savenames.append(dirname + 'b'+str(bvalnum)+"#_"+str(c[bvalnum])+ ext)
+        c[bvalnum] += 1 
+    return savenames 
+
+def read_volume(imo, i, scaled=True, slices=None):
+    """Read a single 3D volume from a 4D image without loading the whole 4D array 
+    
+    Slicing nibabel's proxy `dataobj` reads only the requested volume from disk (the file is memory-mapped if it is an uncompressed .nii). 
+    
+    Args: 
+        imo (nibabel image): 4D image loaded with nb.load 
+        i (int): index of the volume along the 4th dimension 
+        scaled (bool): if False, return the raw on-disk values (scl_slope / scl_inter are not applied)
+        slices (tuple): if given, (start, stop) - only this slab of slices of the volume is read 
+    
+    """
+    
+    slicer = (slice(None),)*2 + (slice(*slices) if slices is not None else slice(None), i)
+    if not scaled and nb.is_proxy(imo.dataobj):
+        return imo.dataobj._get_unscaled(slicer)
+    return np.asanyarray(imo.dataobj[slicer])
+
+def save_volume(data, affine, header, savename, slope_inter=None, compresslevel=None):
+    """Make a 3D nifti image and save it to disk 
+    
+    Args: 
+        data (np.ndarray): 3D volume 
+        affine (np.ndarray): 4x4 affine of the volume 
+        header (nb.Nifti1Header): header of the volume 
+        savename (str): output path (.nii or .nii.gz)
+        slope_inter (tuple): if given, (scl_slope, scl_inter) of the raw values in `data` - these are written as they are, without rescaling 
+        compresslevel (int): gzip compression level for .nii.gz files. If None - nibabel default is used. 
+    
+    """
+    
+    imnewo = nb.Nifti1Image(data, affine=affine, header=header)
+    if slope_inter is not None: 
+        imnewo.header.set_slope_inter(*slope_inter)
+    
+    if savename.endswith(".nii.gz") and compresslevel is not None: 
+        with gzip.open(savename, 'wb', compresslevel=compresslevel) as f: 
+            f.write(imnewo.to_bytes())
+    else: 
+        nb.save(imnewo, savename)
+    
+    return savename 
+
+def save_volume_slabs(imo, i, header, savename, memory_budget, compresslevel=None, stats=None):
+    """Copy volume `i` of a 4D image into a 3D file slab by slab - raw on-disk values, data type and scaling are kept (same output as save_volume in streaming mode). If `stats` (list) is given, QA statistics of each (raw) slab are appended to it (see qa.partial_stats)"""
+    
+    shape = imo.shape[:3]
+    dtype = imo.get_data_dtype()
+    size = slabs.slab_size(2 * shape[0] * shape[1] * dtype.itemsize, memory_budget, shape[2])
+    with slabs.nifti_writer(savename, shape, imo.affine, header, dtype, (imo.dataobj.slope, imo.dataobj.inter), compresslevel) as writer: 
+        for z0, z1 in slabs.slab_ranges(shape[2], size): 
+            slab = read_volume(imo, i, scaled=False, slices=(z0, z1))
+            writer.write(slab)
+            if stats is not None: 
+                stats.append(qa_stats.partial_stats(slab))
+    
+    return savename 
+
+def convert_4D_to_3D(impath, original_bvals, directions, stream=False, workers=1, pool='thread', compresslevel=None, uncompressed=False, memory_budget=None, qa=False):
     
     """Convert a 4D diffusion mosaic into individual 3D files. 
     
@@ -84,13 +245,28 @@ def convert_4D_to_3D(impath, original_bvals, directions):
     Args: 
         imagepath (str): full path to .nii file produced by the DCM2NIIX process 
         original_bvalues (list): list of integers denoting the FULL list of bvalues that correspond to the list of bvectors given to the scanner. E.g. if there were 8 b-values and 6 directions for each, this will be a list of length 8*6 (assuming that the first bvalue, such as b0, was acquired 6 times)
-        
+        stream (bool): if True, read one 3D volume at a time instead of loading the full 4D array as float64. Output files keep the on-disk data type and scaling of the input file. 
+        workers (int): number of parallel workers that compress and write the output files 
+        pool (str): 'thread' or 'process' - type of the writer pool (only used if workers > 1) 
+        compresslevel (int): gzip compression level of the output files. If None - nibabel default is used. 
+        uncompressed (bool): if True, output files are written as uncompressed .nii files 
+        memory_budget (float): if given (MB), each volume is read and written in slabs of slices that fit into the budget (implies `stream`, writer pool is not used)
+        qa (bool): if True, QA statistics of each volume are computed from the data that is being written and saved to qa_report.json / qa_report.csv next to the 3D files (see qa.py)
     
+    Returns: 
+        report (dict): QA report if `qa`, else None 
     
     """
     assert os.path.exists(impath)
-    imo = nb.load(impath)
-    im = imo.get_fdata()
+    if memory_budget is not None: 
+        stream, workers = True, 1 
+    if stream:
+        # keep the (gzip) file handle open between volumes - volumes are read in order, so the file is only decompressed once 
+        imo = nb.load(impath, keep_file_open=True)
+        im = None
+    else: 
+        imo = nb.load(impath)
+        im = imo.get_fdata()
     
     dirname = os.path.dirname(impath)
     dirname = dirname + "/" if dirname else ''
@@ -105,30 +281,87 @@ def convert_4D_to_3D(impath, original_bvals, directions):
     # build new header (require to decrease the number of directions in t) - this will be the same for all files 
     header = imo.header 
     header['dim'][4] = 1 
+    
+    # scaling of the on-disk data (only used in streaming mode, where raw on-disk values are copied to the output files)
+    slope, inter = imo.dataobj.slope, imo.dataobj.inter
 
-    # cycle through each individual file
-    for i in range(0,len(original_vector)):
+    # output file extension 
+    ext = ".nii" if uncompressed else ".nii.gz"
+    
+    # start writer pool - at most 2 volumes per worker are kept in memory while waiting to be written
+    executor = None
+    if workers > 1: 
+        executor = ProcessPoolExecutor(workers) if pool == 'process' else ThreadPoolExecutor(workers)
+    pending = deque()
+    
+    # QA statistics of each volume (computed from the volumes as they are written - no extra read of the file)
+    stats, savenames = [], []
 
-        # get individual image that represents single bvalues and single direction
-        im_singleBval_singleDir = im[:,:,:,i]
+    try: 
+        # cycle through each individual file
+        for i in range(0,len(original_vector)):
 
-        # extract bvalue number 
-        bvalnum = original_vector[i]    
+            # get individual image that represents single bvalues and single direction (in slab mode - read later, slab by slab)
+            if memory_budget is not None: 
+                im_singleBval_singleDir = None 
+            elif stream: 
+                im_singleBval_singleDir = read_volume(imo, i, scaled=False)
+            else: 
+                im_singleBval_singleDir = im[:,:,:,i]
 
-        # extract the direction number (direction is equal to the number of times that a particular bvalue has already been seen - starting from zero)
-        # for reference see the following file - ~/w/code/ivim/2020/brain_ivim/fetch_dicoms.py
-        directionnum = c[bvalnum]
-        c[bvalnum] += 1  # increment counter 
+            # extract bvalue number 
+            bvalnum = original_vector[i]    
 
+            # extract the direction number (direction is equal to the number of times that a particular bvalue has already been seen - starting from zero)
+            # for reference see the following file - ~/w/code/ivim/2020/brain_ivim/fetch_dicoms.py
+            directionnum = c[bvalnum]
+            c[bvalnum] += 1  # increment counter 
 
-        # save this image into separate file  in the following format: b<bvalnum>#_<directionnum>.nii.gz 
-        savename = dirname + 'b'+str(bvalnum)+"#_"+str(directionnum)+ ".nii.gz"
 
-        # make a nifti image and save
-        imnewo = nb.Nifti1Image(im_singleBval_singleDir,affine=imo.affine, header=header)
-        nb.save(imnewo, savename)
-        # print progress
-        print(savename)        
+            # save this image into separate file  in the following format: b<bvalnum>#_<directionnum>.nii.gz 
+            savename = dirname + 'b'+str(bvalnum)+"#_"+str(directionnum)+ ext
+
+            # in streaming mode - copy the original scaling, so that nibabel writes raw values as they are (no rescaling)
+            slope_inter = (slope, inter) if stream else None
+        
+            savenames.append(savename)
+        
+            # make a nifti image and save
+            if memory_budget is not None: 
+                parts = [] if qa else None 
+                save_volume_slabs(imo, i, header, savename, memory_budget, compresslevel, stats=parts)
+                if qa: 
+                    stats.append(qa_stats.volume_stats(parts, slope_inter))
+                print(savename)
+                continue 
+        
+            if qa: 
+                stats.append(qa_stats.volume_stats([qa_stats.partial_stats(im_singleBval_singleDir)], slope_inter))
+        
+            if executor is None: 
+                save_volume(im_singleBval_singleDir, imo.affine, header, savename, slope_inter, compresslevel)
+                # print progress
+                print(savename)        
+            else: 
+                pending.append(executor.submit(save_volume, im_singleBval_singleDir, imo.affine, header, savename, slope_inter, compresslevel))
+                if len(pending) >= 2*workers: 
+                    print(pending.popleft().result())
+
+        # wait for the remaining files to be written 
+        while pending: 
+            print(pending.popleft().result())
+    finally: 
+        # also if a write fails or on Ctrl-C - files that are still queued are not written (cancel() only cancels futures that have not started yet)
+        if executor is not None: 
+            for future in pending: 
+                future.cancel()
+            executor.shutdown()
+    
+    # QA report 
+    if qa: 
+        report = qa_stats.qa_report(original_vector, stats, savenames)
+        qa_stats.write_report(report, dirname)
+        return report 
 
     
     
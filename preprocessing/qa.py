@@ -0,0 +1,183 @@
+"""Quality assurance of diffusion directions - per-volume statistics and outlier detection, computed while the 4D file is split (no extra read of the scan)
+
+    For each volume (one b-value, one direction) of the 4D file:
+        mean            - mean intensity of the volume
+        noise           - robust noise level: 1.4826 * median absolute deviation of the corner voxels (same corners that create_masks.py uses to measure noise)
+        snr             - mean / noise
+        deviation       - relative deviation of the mean from the median mean of all directions of the same b-value
+        slice_deviation - largest relative deviation of a slice mean from the median of the same slice over all directions of the b-value (only slices with signal above noise) - catches signal dropout in a few slices (e.g. motion during a single slice)
+
+    A direction is flagged as an outlier if |deviation| > max_deviation or slice_deviation > max_slice_deviation. Flagged directions can be excluded from the geometric averages ('--exclude_outliers' in geometric_averages.py and pipeline.py) - if all directions of a b-value are flagged, none are excluded.
+
+    The report is written as .json (summary per b-value + one record per volume) and .csv (one row per volume).
+
+    Usage:
+        python process_nifti.py -f <full path to .nii file> --qa
+        python geometric_averages.py -d <directory> --exclude_outliers
+        python pipeline.py -f <full path to .nii file> --qa --exclude_outliers
+
+"""
+
+import os
+import csv
+import json
+
+import numpy as np
+
+
+# size of the (square) corners used to measure noise - same as create_masks.MASK_PARAMS['corner_size']
+CORNER_SIZE = 20
+
+# outlier thresholds (relative)
+MAX_DEVIATION = 0.2
+MAX_SLICE_DEVIATION = 0.3
+
+REPORT_NAME = "qa_report"
+
+CSV_FIELDS = ['index', 'bval', 'direction', 'file', 'mean', 'noise', 'snr', 'deviation', 'slice_deviation', 'outlier']
+
+
+def partial_stats(vol, corner_size=CORNER_SIZE):
+
+    """Statistics of a volume - or of a slab of slices of a volume (combine the slabs with volume_stats)"""
+
+    vol = np.asarray(vol)
+    corners = np.concatenate([vol[0:corner_size,0:corner_size,:].ravel(), vol[-corner_size:,-corner_size:,:].ravel()])
+    return {'sum': float(vol.sum(dtype=np.float64)),
+            'count': vol.size,
+            'corners': corners.astype(np.float32),
+            'slice_means': vol.mean(axis=(0,1), dtype=np.float64)}
+
+
+def volume_stats(parts, slope_inter=None):
+
+    """Combine partial statistics of the slabs of a volume (see partial_stats)
+
+    Args:
+        parts (list): partial statistics of each slab, in slice order (a single item for a whole volume)
+        slope_inter (tuple): if the statistics were computed on raw on-disk values - (scl_slope, scl_inter) of the file
+    Returns:
+        stats (dict): {'mean', 'noise', 'snr', 'slice_means'}
+    """
+
+    mean = sum(p['sum'] for p in parts) / sum(p['count'] for p in parts)
+    corners = np.concatenate([p['corners'] for p in parts])
+    noise = 1.4826 * float(np.median(np.abs(corners - np.median(corners))))
+    slice_means = np.concatenate([p['slice_means'] for p in parts])
+
+    # scaling is linear - statistics of raw values are scaled afterwards
+    if slope_inter is not None and not np.isnan(slope_inter[0]):
+        slope, inter = slope_inter[0], (0 if np.isnan(slope_inter[1]) else slope_inter[1])
+        mean, noise, slice_means = mean * slope + inter, noise * abs(slope), slice_means * slope + inter
+
+    return {'mean': mean, 'noise': noise, 'snr': mean / noise if noise > 0 else None, 'slice_means': slice_means}
+
+
+def qa_report(bvals, stats, savenames=None, max_deviation=MAX_DEVIATION, max_slice_deviation=MAX_SLICE_DEVIATION):
+
+    """Compare directions of each b-value and flag outliers
+
+    Args:
+        bvals (list): b-value of each volume
+        stats (list): statistics of each volume (see volume_stats)
+        savenames (list): 3D file of each volume (optional - e.g. b50#_2.nii.gz)
+        max_deviation (float): maximum relative deviation of the mean of a direction from the median of its b-value
+        max_slice_deviation (float): maximum relative deviation of a slice mean
+    Returns:
+        report (dict): {'thresholds', 'bvals': {bval: summary}, 'volumes': [record per volume], 'outliers': [indices of flagged volumes]}
+    """
+
+    volumes = []
+    directions = {}
+    for i, (bvalnum, s) in enumerate(zip(bvals, stats)):
+        directions.setdefault(bvalnum, []).append(i)
+        volumes.append({'index': i, 'bval': int(bvalnum), 'direction': len(directions[bvalnum]) - 1,
+                        'file': os.path.basename(savenames[i]) if savenames else None,
+                        'mean': round(s['mean'], 4), 'noise': round(s['noise'], 4), 'snr': round(s['snr'], 3) if s['snr'] is not None else None,
+                        'deviation': None, 'slice_deviation': None, 'outlier': False, 'reasons': []})
+
+    summary = {}
+    for bvalnum, idx in directions.items():
+        means = np.array([stats[i]['mean'] for i in idx])
+        slice_means = np.stack([stats[i]['slice_means'] for i in idx])
+        median = float(np.median(means))
+        median_slices = np.median(slice_means, axis=0)
+
+        # slices with signal (slice means of background-only slices are dominated by noise)
+        noise = np.median([stats[i]['noise'] for i in idx])
+        signal = median_slices > noise
+
+        for i, m, sm in zip(idx, means, slice_means):
+            v = volumes[i]
+            v['deviation'] = round((m - median) / median, 4) if median > 0 else 0.0
+            v['slice_deviation'] = round(float(np.max(np.abs(sm[signal] - median_slices[signal]) / median_slices[signal])), 4) if signal.any() else 0.0
+            if abs(v['deviation']) > max_deviation:
+                v['reasons'].append('deviation')
+            if v['slice_deviation'] > max_slice_deviation:
+                v['reasons'].append('slice_deviation')
+            v['outlier'] = bool(v['reasons'])
+
+        summary[int(bvalnum)] = {'directions': len(idx),
+                                 'median_mean': round(median, 4),
+                                 'median_snr': round(float(np.median([volumes[i]['snr'] or 0 for i in idx])), 3),
+                                 'outliers': [volumes[i]['direction'] for i in idx if volumes[i]['outlier']]}
+
+    return {'thresholds': {'max_deviation': max_deviation, 'max_slice_deviation': max_slice_deviation, 'corner_size': CORNER_SIZE},
+            'bvals': summary,
+            'volumes': volumes,
+            'outliers': [v['index'] for v in volumes if v['outlier']]}
+
+
+def excluded_volumes(report):
+
+    """Indices of outlier volumes that are excluded from averaging - outliers of a b-value are kept if all of its directions are outliers"""
+
+    excluded = []
+    for bvalnum, summary in report['bvals'].items():
+        if summary['outliers'] and len(summary['outliers']) < summary['directions']:
+            excluded.extend(v['index'] for v in report['volumes'] if v['bval'] == int(bvalnum) and v['outlier'])
+        elif summary['outliers']:
+            print(f"WARNING: all directions of b={bvalnum} are outliers - none are excluded")
+    return sorted(excluded)
+
+
+def exclude_files(files, report):
+
+    """Files (3D b-value files) without the outliers excluded by the report - see excluded_volumes"""
+
+    excluded = {report['volumes'][i]['file'] for i in excluded_volumes(report)}
+    kept = [f for f in files if os.path.basename(f) not in excluded]
+    print(f"Excluded {len(files) - len(kept)} outlier direction{'s' if len(files) - len(kept) != 1 else ''}" + (": " + ", ".join(sorted(excluded)) if excluded else ""))
+    return kept
+
+
+def report_paths(savedir):
+
+    """Paths of the .json and .csv report in `savedir`"""
+
+    savedir = savedir + "/" if savedir and not savedir.endswith("/") else savedir
+    return [savedir + REPORT_NAME + ".json", savedir + REPORT_NAME + ".csv"]
+
+
+def write_report(report, savedir):
+
+    """Write the report as <savedir>/qa_report.json and <savedir>/qa_report.csv. Returns both paths"""
+
+    jsonpath, csvpath = report_paths(savedir)
+    with open(jsonpath, 'w') as f:
+        json.dump(report, f, indent=2)
+    with open(csvpath, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(report['volumes'])
+
+    n = len(report['outliers'])
+    print(f"QA: {n} outlier direction{'s' if n != 1 else ''}" + (": " + ", ".join(f"b{v['bval']}#_{v['direction']} ({'+'.join(v['reasons'])})" for v in report['volumes'] if v['outlier']) if n else ""))
+    print(f"Saved QA report to: {jsonpath}")
+
+    return jsonpath, csvpath
+
+
+def read_report(path):
+    with open(path) as f:
+        return json.load(f)
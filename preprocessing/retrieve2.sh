@@ -40,5 +40,6 @@ for s in  ${StudyUIDs[@]}; do
  $dcm4che/getscu -c RESEARCHPACS@researchpacs:11112 -L STUDY -M StudyRoot -mStudyInstanceUID="$s" --directory "$outdir"
 done
 
+# faster alternative (header-only parse, no dcmdump / GNU parallel): python sort_dicoms.py -d "$outdir"
 find "$outdir" -maxdepth 1 -type f -print | /home/ch163210/bin/parallel -j `nproc` -k sortd 
 
@@ -0,0 +1,270 @@
+"""Per-subject, per-ROI statistics of averaged signals and IVIM parameter maps for a cohort - written as a single tidy .csv table
+
+    For each subject directory, the label map (default - averaged/mask.nrrd created by create_masks.py, or any custom label map with integer labels) is read once, and every map (default - averaged/b<bval>_averaged.nrrd and averaged/ivim_<method>_<parameter>.nrrd) is reduced over all labels at once with grouped reductions (np.bincount over the label of each voxel, percentiles from a single sort of the values grouped by label) - there is no loop over label values. Label 0 is background and is ignored. Non-finite values (e.g. failed fits) are ignored.
+
+    Subjects are processed in parallel worker processes, one subject per worker at a time (only one subject per worker is ever held in memory), and rows are appended to the table as subjects finish (in the order of the input). A failed subject does not stop the others - it is listed at the end (a worker process that dies, e.g. out of memory, fails only its own subject - see run_cohort.run_pool). Subjects without rows (no labels in the label map, or no maps found) are listed with a warning.
+
+    Output columns:
+        subject, map, label, count, mean, std, min, p<percentile> .., median, .. max
+
+    Usage:
+        python roi_stats.py -d <subject directory> <subject directory> ... -o roi_stats.csv
+        python roi_stats.py -m <manifest .txt file with one subject directory per line> --workers 16 -o roi_stats.csv
+        python roi_stats.py -m <manifest> --labels labels/aseg.nii.gz --maps "averaged/ivim_biexp_*.nrrd"
+        python roi_stats.py -m <manifest> --percentiles 10 90
+
+    Paths of the label map and map patterns are relative to each subject directory.
+
+"""
+
+import argparse
+import os
+import sys
+import csv
+import glob
+import traceback
+
+import numpy as np
+
+import svtools as sv
+import maskio
+from run_cohort import load_manifest, run_pool
+
+
+LABELS = "averaged/mask.nrrd"
+MAPS = ["averaged/b*_averaged.nrrd", "averaged/ivim_*.nrrd"]
+PERCENTILES = [5, 25, 75, 95]
+
+
+def load_args():
+
+    parser = argparse.ArgumentParser()
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-d', '--directories',type=str,nargs='+', help='full paths to subject directories')
+    group.add_argument('-m', '--manifest',type=str, help='.txt file with one subject directory per line (lines starting with # are ignored)')
+    parser.add_argument('-o', '--output',type=str,default='roi_stats.csv',help='output .csv table')
+    parser.add_argument('--labels',type=str,default=LABELS,help='label map (relative to each subject directory) - .nrrd, .nii, .nii.gz or bit-packed mask .npz')
+    parser.add_argument('--maps',type=str,nargs='+',default=MAPS,help='glob patterns of maps to summarise (relative to each subject directory)')
+    parser.add_argument('--percentiles',type=float,nargs='+',default=PERCENTILES,help='percentiles to compute (the median is always computed)')
+    parser.add_argument('--workers',type=int,default=os.cpu_count(),help='number of subjects processed in parallel')
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+
+    # load input args
+    args = load_args()
+
+    # get list of subjects
+    directories = load_manifest(args.manifest) if args.manifest else args.directories
+
+    failed = aggregate_cohort(directories, args.output, labels=args.labels, maps=args.maps, percentiles=args.percentiles, workers=args.workers)
+
+    # non-zero exit code if any subject failed
+    if failed:
+        sys.exit(1)
+
+
+def read_labels(path):
+
+    """Read a label map as an integer array (bit-packed masks are read with maskio)"""
+
+    if path.endswith(".npz"):
+        return maskio.load_mask(path).astype(np.uint8)
+    labels, _ = sv.read_image(path, dtype=np.float64)
+    assert np.array_equal(labels, np.round(labels)), f"Label map must contain integer labels: {path}"
+    return labels.astype(np.int64)
+
+
+def group_labels(labels):
+
+    """Group the voxels of a label map by label (label 0 - background - is ignored)
+
+    Returns:
+        idx (np.ndarray): flat indices of the labelled voxels
+        values (np.ndarray): sorted label values
+        inverse (np.ndarray): group of each labelled voxel - index into `values`
+    """
+
+    flat = labels.ravel()
+    idx = np.flatnonzero(flat)
+    lab = flat[idx]
+    if lab.size and lab.min() < 0:
+        values, inverse = np.unique(lab, return_inverse=True)
+        return idx, values, inverse
+
+    # labels are small non-negative integers - a lookup table (label -> group) avoids sorting the labels
+    present = np.bincount(lab)
+    values = np.flatnonzero(present)
+    lut = np.zeros(present.size, dtype=np.int64)
+    lut[values] = np.arange(values.size)
+    return idx, values, lut[lab]
+
+
+def grouped_stats(v, inverse, ngroups, percentiles=PERCENTILES):
+
+    """Statistics of the values of all groups at once
+
+    Args:
+        v (np.ndarray): values (float64) of the labelled voxels
+        inverse (np.ndarray): group of each value
+        ngroups (int): number of groups
+        percentiles (list): percentiles (0-100) to compute - linear interpolation, as np.percentile
+    Returns:
+        stats (dict): name -> array with one value per group (NaN for empty groups). Names are count, mean, std, min, p<percentile>, median, max
+    """
+
+    # non-finite values are ignored
+    finite = np.isfinite(v)
+    if not finite.all():
+        v, inverse = v[finite], inverse[finite]
+
+    count = np.bincount(inverse, minlength=ngroups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(inverse, weights=v, minlength=ngroups) / count
+        dev = v - mean[inverse]
+        std = np.sqrt(np.bincount(inverse, weights=dev * dev, minlength=ngroups) / count)
+
+    # sort values by group, then by value - each group is a contiguous, sorted run
+    # (sort by value first, then a stable sort by group - groups as the smallest integer type, so that numpy uses a radix sort)
+    order = np.argsort(v)
+    order = order[np.argsort(inverse.astype(np.min_scalar_type(max(ngroups - 1, 0)))[order], kind='stable')]
+    v = v[order]
+    start = np.concatenate([[0], np.cumsum(count)[:-1]])
+    nonempty = count > 0
+
+    def percentile(q):
+        out = np.full(ngroups, np.nan)
+        pos = start[nonempty] + q / 100 * (count[nonempty] - 1)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo + 1, start[nonempty] + count[nonempty] - 1)
+        out[nonempty] = v[lo] + (pos - lo) * (v[hi] - v[lo])
+        return out
+
+    stats = {'count': count, 'mean': mean, 'std': std, 'min': percentile(0)}
+    for q in sorted(set(percentiles) | {50}):
+        stats['median' if q == 50 else percentile_name(q)] = percentile(q)
+    stats['max'] = percentile(100)
+
+    return stats
+
+
+def percentile_name(q):
+    return "p" + ('%g' % q).replace('.', '_')
+
+
+def columns(percentiles=PERCENTILES):
+
+    """Columns of the output table"""
+
+    names = ['median' if q == 50 else percentile_name(q) for q in sorted(set(percentiles) | {50})]
+    return ['subject', 'map', 'label', 'count', 'mean', 'std', 'min'] + names + ['max']
+
+
+def map_name(path):
+
+    """Name of a map in the table - file name without extension (e.g. ivim_biexp_D)"""
+
+    name = os.path.basename(path)
+    for ext in (".nii.gz", ".nii", ".nrrd"):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def subject_stats(directory, labels=LABELS, maps=MAPS, percentiles=PERCENTILES):
+
+    """Statistics of all maps of a subject for all labels. Never raises - errors are returned in the result
+
+    Returns:
+        result (dict): {'subject', 'rows' (list of dicts - see columns), 'warnings', 'error'}
+    """
+
+    result = {'subject': directory, 'rows': [], 'warnings': [], 'error': None}
+    try:
+        labelmap = read_labels(os.path.join(directory, labels))
+        shape = labelmap.shape
+        idx, values, inverse = group_labels(labelmap)
+        del labelmap
+        if not len(values):
+            result['warnings'].append(f"no labels in {labels}")
+
+        files = sorted({f for pattern in maps for f in glob.glob(os.path.join(directory, pattern))} - {os.path.join(directory, labels)})
+        if not files:
+            result['warnings'].append("no maps found: " + " ".join(maps))
+        for f in files:
+            # one map in memory at a time
+            vol, _ = sv.read_image(f, dtype=np.float64)
+            assert vol.shape == shape, f"Shape of {f} {vol.shape} does not match the shape of the label map {shape}"
+            stats = grouped_stats(vol.ravel()[idx], inverse, len(values), percentiles)
+            del vol
+
+            name = map_name(f)
+            for j, label in enumerate(values):
+                row = {'subject': directory, 'map': name, 'label': int(label)}
+                row.update({k: (int(s[j]) if k == 'count' else float(s[j])) for k, s in stats.items()})
+                result['rows'].append(row)
+    except Exception:
+        result['error'] = traceback.format_exc()
+
+    return result
+
+
+def aggregate_cohort(directories, output, labels=LABELS, maps=MAPS, percentiles=PERCENTILES, workers=None):
+
+    """Compute ROI statistics of a cohort in parallel and write them to a single .csv table
+
+    Args:
+        directories (list): subject directories
+        output (str): output .csv table
+        labels (str): label map, relative to each subject directory
+        maps (list): glob patterns of maps, relative to each subject directory
+        percentiles (list): percentiles to compute (the median is always computed)
+        workers (int): number of subjects processed in parallel (default - number of cpus)
+    Returns:
+        failed (list): results of subjects that failed (see subject_stats)
+    """
+
+    failed, warned = [], []
+    nrows = 0
+    n = len(directories)
+    with open(output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns(percentiles))
+        writer.writeheader()
+
+        # subjects finish in any order - their rows are buffered and written in the order of the input, as soon as all subjects before them are done
+        buffer, nwritten = {}, 0
+        for i, result, error in run_pool(subject_stats, directories, workers, (labels, maps, percentiles)):
+            if error is not None:
+                # worker process died (e.g. out of memory)
+                result = {'subject': directories[i], 'rows': [], 'warnings': [], 'error': error}
+            buffer[i] = result
+            status = 'failed' if result['error'] is not None else 'warning' if result['warnings'] else f"{len(result['rows'])} rows"
+            print(f"[{len(buffer) + nwritten}/{n}] {status}: {result['subject']}")
+
+            while nwritten in buffer:
+                result = buffer.pop(nwritten)
+                nwritten += 1
+                if result['error'] is not None:
+                    failed.append(result)
+                    continue
+                if result['warnings']:
+                    warned.append(result)
+                writer.writerows(result['rows'])
+                nrows += len(result['rows'])
+
+    print(f"Processed {n} subjects: {n - len(failed)} done ({len(warned)} with warnings), {len(failed)} failed")
+    for r in warned:
+        print(f"WARNING: {r['subject']}: " + "; ".join(r['warnings']))
+    for r in failed:
+        print(f"FAILED: {r['subject']}\n{r['error']}")
+    print(f"Saved {nrows} rows to: {output}")
+
+    return failed
+
+
+if __name__=='__main__':
+
+    main()
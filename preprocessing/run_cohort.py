@@ -0,0 +1,279 @@
+"""Run the full preprocessing pipeline (see pipeline.py) for a cohort of subjects in parallel
+
+    Each subject directory must contain a single 4D diffusion mosaic (.nii or .nii.gz) with a corresponding .bval file (i.e. output of the dcm2niix conversion).
+
+    Subjects are processed in a pool of worker processes. Nothing is ever prompted - existing outputs are handled according to '--policy':
+        skip        - subjects that already have all outputs (averaged/bvalsFileNames_average.txt and averaged/mask.nrrd) are skipped (default)
+        overwrite   - all subjects are recomputed
+
+    A failure of one subject does not stop the others. The result of each subject is appended to a journal file as soon as it finishes. If the run crashes (or is stopped), rerun the same command with '--resume' and all subjects that have already finished successfully are skipped.
+
+    A summary report (.json) is written at the end of the run.
+
+    With '--memory_budget', each subject runs in slabs of slices that fit into the budget (see pipeline.py) - peak memory per worker is then bounded by the budget (plus the imported libraries) instead of the size of the volumes, so more subjects can run on the same node.
+
+    With '--instrument', each subject gets a record of the time, memory and bytes read / written by each stage (<subject>/averaged/instrument.json, see instrument.py), and the time of each stage is added to the journal and the report - e.g. to find which subjects and stages dominate the run time.
+
+    Usage:
+        python run_cohort.py -d <subject directory> <subject directory> ... --workers 8
+        python run_cohort.py -m <manifest .txt file with one subject directory per line> --workers 8 --report cohort_report.json
+        python run_cohort.py -m <manifest> --workers 8 --resume
+        python run_cohort.py -m <manifest> --policy overwrite --noabsolute
+        python run_cohort.py -m <manifest> --instrument --profile mask
+        python run_cohort.py -m <manifest> --workers 16 --memory_budget 512
+
+"""
+
+import argparse
+import os
+import glob
+import sys
+import json
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+
+def load_args():
+
+    parser = argparse.ArgumentParser()
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-d', '--directories',type=str,nargs='+', help='full paths to subject directories to be processed')
+    group.add_argument('-m', '--manifest',type=str, help='.txt file with one subject directory per line (lines starting with # are ignored)')
+    parser.add_argument('--workers',type=int,default=os.cpu_count(),help='number of subjects processed in parallel')
+    parser.add_argument('--policy',type=str,default='skip',choices=['skip','overwrite'],help='what to do with subjects that already have outputs')
+    parser.add_argument('--report',type=str,default='cohort_report.json',help='path to the summary report. The journal is written to the same path with .journal extension')
+    parser.add_argument('--resume',action="store_true",help='if used, subjects that finished successfully in a previous run (according to the journal) are skipped')
+    parser.add_argument('--noabsolute',action="store_true",help='if used, the paths of b-value files written to .txt files will be relative, not absolute')
+    parser.add_argument('--masktype',type=str,default='improved',choices=['improved','simple','dummy'],help='type of mask to create')
+    parser.add_argument('--instrument',action="store_true",help='if used, timings, memory and bytes read / written by each stage are saved to <subject>/averaged/instrument.json')
+    parser.add_argument('--profile',type=str,default=None,choices=['split_average','write_txt','write_stack','mask'],help='name of a stage to profile with cProfile (saved as <subject>/averaged/<stage>.prof, requires --instrument)')
+    parser.add_argument('--memory_budget',type=float,default=None,help='if used, each subject is processed in slabs of slices that fit into this many MB')
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+
+    # load input args
+    args = load_args()
+
+    # get list of subjects
+    directories = load_manifest(args.manifest) if args.manifest else args.directories
+
+    # run
+    filepaths_type = 'relative' if args.noabsolute else 'absolute'
+    report = run_cohort(directories, workers=args.workers, policy=args.policy, report_path=args.report, resume=args.resume, filepaths_type=filepaths_type, masktype=args.masktype, instrumented=args.instrument, profile=args.profile, memory_budget=args.memory_budget)
+
+    # non-zero exit code if any subject failed
+    if report['failed']:
+        sys.exit(1)
+
+
+def load_manifest(manifest):
+
+    """Read a list of subject directories from a .txt file (one per line, # for comments)"""
+
+    with open(manifest) as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def find_4D_file(directory):
+
+    """Find the 4D diffusion mosaic (.nii or .nii.gz with a corresponding .bval file) in a subject directory"""
+
+    files = glob.glob(os.path.join(directory, "*.nii.gz")) + glob.glob(os.path.join(directory, "*.nii"))
+    files = [f for f in files if os.path.exists(f.replace(".nii.gz", ".bval") if f.endswith(".nii.gz") else f.replace(".nii", ".bval"))]
+    assert len(files) == 1, f"Expected exactly one .nii / .nii.gz file with a corresponding .bval file in {directory}. Found: {files}"
+
+    return files[0]
+
+
+def outputs_exist(directory):
+
+    """Check if the final outputs of the pipeline already exist in a subject directory (both are written atomically - see svtools.atomic_write - so they are never half-written)"""
+
+    outputdir = os.path.join(directory, "averaged")
+    return os.path.exists(os.path.join(outputdir, "bvalsFileNames_average.txt")) and os.path.exists(os.path.join(outputdir, "mask.nrrd"))
+
+
+def process_subject(directory, policy='skip', filepaths_type='absolute', masktype='improved', instrumented=False, profile=None, memory_budget=None):
+
+    """Run the pipeline for a single subject. Never raises - errors are returned in the result
+
+    If `instrumented`, the instrumentation record is saved to <directory>/averaged/instrument.json and the time of each stage is added to the result (see instrument.py)
+    """
+
+    result = {'subject': directory, 'status': None, 'time': None, 'error': None}
+    start = time.time()
+    try:
+        if policy == 'skip' and outputs_exist(directory):
+            result['status'] = 'skipped'
+        else:
+            # imported here, so that the (heavy) imports happen in the worker processes
+            import pipeline
+            import process_nifti as pn
+            import instrument
+
+            impath = find_4D_file(directory)
+            bval_path = impath.replace(".nii.gz", ".bval") if impath.endswith(".nii.gz") else impath.replace(".nii", ".bval")
+            bvals = pn.get_bvector(bval_path)
+            if instrumented:
+                instrument.start(directory, profile=profile, profile_dir=pipeline.get_outputdir(impath))
+            try:
+                pipeline.run_pipeline(impath, bvals, masktype=masktype, filepaths_type=filepaths_type, memory_budget=memory_budget)
+            finally:
+                # stages that finished before a failure are recorded as well
+                record = instrument.finish(os.path.join(directory, "averaged", "instrument.json"))
+            if record is not None:
+                result['stages'] = instrument.summary(record)
+                result['peak_rss_mb'] = record['peak_rss_mb']
+            result['status'] = 'done'
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    result['time'] = round(time.time() - start, 2)
+
+    return result
+
+
+def run_pool(fn, items, workers=None, args=()):
+
+    """Run fn(item, *args) for each item in a process pool and yield the results as they finish
+
+    If a worker process dies (e.g. out of memory), the pool breaks and all of its unfinished futures fail with BrokenProcessPool. Items that were running when the pool broke are then run again each in a pool of its own (at most `workers` at a time), so that only the item that actually crashed a worker is returned with an error - afterwards, all other unfinished items are resubmitted to a new pool. Every item is yielded exactly once.
+
+    Args:
+        fn (callable): function run in the workers (must be picklable)
+        items (list): first argument of each call
+        workers (int): maximum number of items processed in parallel (default - number of cpus)
+        args (tuple): other arguments of each call
+    Yields:
+        (i, result, error): index of the item in `items`, result of the call (None if it failed) and the traceback of the failure (None if it did not)
+    """
+
+    workers = workers or os.cpu_count()
+    pending, isolated = list(range(len(items))), []
+    while pending or isolated:
+        # items suspected of crashing a worker - each in its own pool, so that a crash breaks only its own pool (pending items wait until all suspects are done)
+        alone = bool(isolated)
+        if alone:
+            batches, isolated = [[i] for i in isolated[:workers]], isolated[workers:]
+        else:
+            batches, pending = [pending], []
+        executors, futures, running, broken = [], {}, set(), []
+        try:
+            for batch in batches:
+                executor = ProcessPoolExecutor(max_workers=1 if alone else workers)
+                executors.append(executor)
+                futures.update({executor.submit(fn, items[i], *args): i for i in batch})
+            not_done = set(futures)
+            while not_done:
+                running |= {f for f in not_done if f.running()}
+                done, not_done = wait(not_done, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        yield futures[future], future.result(), None
+                    except BrokenProcessPool:
+                        if alone:
+                            yield futures[future], None, traceback.format_exc()
+                        else:
+                            broken.append(future)
+                    except Exception:
+                        yield futures[future], None, traceback.format_exc()
+        finally:
+            for executor in executors:
+                executor.shutdown()
+
+        # only a shared pool can break without yielding its items
+        if broken:
+            isolated = sorted(futures[f] for f in broken if f in running)
+            pending = sorted(futures[f] for f in broken if f not in running)
+            if not isolated:
+                # not known which item crashed the pool - all of them are run on their own
+                isolated, pending = pending, []
+            print(f"WARNING: a worker process died - restarting the pool ({len(isolated)} items run on their own, {len(pending)} resubmitted)")
+
+
+def read_journal(journal_path):
+
+    """Get results of subjects that were already processed (last entry for each subject is used)"""
+
+    results = {}
+    if os.path.exists(journal_path):
+        with open(journal_path) as f:
+            for line in f:
+                if line.strip():
+                    result = json.loads(line)
+                    results[result['subject']] = result
+    return results
+
+
+def run_cohort(directories, workers=None, policy='skip', report_path='cohort_report.json', resume=False, filepaths_type='absolute', masktype='improved', instrumented=False, profile=None, memory_budget=None):
+
+    """Process a list of subject directories in a process pool
+
+    Args:
+        directories (list): subject directories
+        workers (int): maximum number of subjects processed in parallel (default - number of cpus)
+        policy (str): 'skip' or 'overwrite' - what to do with subjects that already have outputs
+        report_path (str): path to the .json summary report. Each finished subject is also appended to <report_path>.journal
+        resume (bool): if True, skip subjects that finished successfully according to the journal
+        filepaths_type (str): 'absolute' or 'relative' paths in bvalsFileNames_average.txt
+        masktype (str): type of mask - see create_masks.create_mask
+        instrumented (bool): if True, save an instrumentation record per subject and add stage times to the results (see instrument.py)
+        profile (str): name of a stage to profile with cProfile (if instrumented)
+        memory_budget (float): if given (MB), each subject is processed in slabs of slices that fit into the budget (see pipeline.run_pipeline)
+    Returns:
+        report (dict): summary of the run
+
+    """
+
+    directories = [os.path.abspath(d) for d in directories]
+    journal_path = os.path.splitext(report_path)[0] + ".journal"
+
+    # subjects finished in a previous run
+    previous = read_journal(journal_path) if resume else {}
+    results = {d: previous[d] for d in directories if d in previous and previous[d]['status'] in ('done', 'skipped')}
+    todo = [d for d in directories if d not in results]
+    if results:
+        print(f"Resuming: {len(results)} subjects already processed, {len(todo)} remaining")
+
+    start = time.time()
+    with open(journal_path, 'a' if resume else 'w') as journal:
+        # a worker that dies (e.g. out of memory) fails only its own subject - the others are resubmitted (see run_pool)
+        for i, result, error in run_pool(process_subject, todo, workers, (policy, filepaths_type, masktype, instrumented, profile, memory_budget)):
+            if error is not None:
+                result = {'subject': todo[i], 'status': 'failed', 'time': None, 'error': error}
+            results[result['subject']] = result
+
+            # record progress immediately, so that the run can be resumed after a crash
+            journal.write(json.dumps(result) + "\n")
+            journal.flush()
+            print(f"[{len(results)}/{len(directories)}] {result['status']}: {result['subject']}")
+
+    # summary
+    report = {'subjects': len(directories),
+              'done': sum(r['status'] == 'done' for r in results.values()),
+              'skipped': sum(r['status'] == 'skipped' for r in results.values()),
+              'failed': sum(r['status'] == 'failed' for r in results.values()),
+              'time': round(time.time() - start, 2),
+              'results': [results[d] for d in directories]}
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f"Processed {report['subjects']} subjects: {report['done']} done, {report['skipped']} skipped, {report['failed']} failed")
+    for r in report['results']:
+        if r['status'] == 'failed':
+            print(f"FAILED: {r['subject']}\n{r['error']}")
+    print(f"Saved report to: {report_path}")
+
+    return report
+
+
+if __name__=='__main__':
+
+    main()
@@ -0,0 +1,249 @@
+"""Out-of-core (slab-wise) reading and writing of volumes - blocks of slices sized to a memory budget
+
+    All volumes are stored with the slice axis (z) slowest on disk (.nii and .nrrd are Fortran order), so a slab of consecutive slices is a contiguous block of the file. Slabs are read and written in order (z = 0, 1, ..), i.e. every file - compressed or not - is read and written sequentially, once.
+
+    Used by the '--memory_budget' mode of process_nifti.py, geometric_averages.py, create_masks.py and pipeline.py. Outputs of the slab mode are the same as outputs of the whole-volume mode (same values, same data types, same geometry).
+
+    Usage (from python):
+
+        import slabs
+        size = slabs.slab_size(slice_bytes, budget_mb, nslices)
+        for z0, z1, slab in slabs.nrrd_slabs("averaged/b0_averaged.nrrd", size):
+            ...
+        with slabs.SlabWriter(savename, slabs.nrrd_head(shape, np.uint8, header), np.uint8) as writer:
+            writer.write(slab)
+
+"""
+
+import os
+import io
+import gzip
+import zlib
+import shutil
+import contextlib
+
+import numpy as np
+import nrrd
+
+import stackio
+
+
+# numpy -> nrrd type names (as written by pynrrd), and back (also names written by stackio)
+NUMPY2NRRD = {'f4': 'float', 'f8': 'double', 'i1': 'int8', 'u1': 'uint8', 'i2': 'int16', 'u2': 'uint16', 'i4': 'int32', 'u4': 'uint32', 'i8': 'int64', 'u8': 'uint64'}
+NRRD2NUMPY = dict({v: k for k, v in NUMPY2NRRD.items()}, uchar='u1', short='i2', ushort='u2', int='i4')
+
+
+def slab_size(slice_bytes, budget_mb, nslices):
+
+    """Number of slices per slab that fit into the memory budget (at least 1, at most `nslices`)
+
+    Args:
+        slice_bytes (int): memory needed per slice (all buffers of the stage)
+        budget_mb (float): memory budget in MB
+        nslices (int): number of slices of the volume
+    """
+
+    return int(max(1, min(nslices, int(budget_mb * 2**20) // max(int(slice_bytes), 1))))
+
+
+def slab_ranges(nslices, size):
+
+    """(start, stop) of each slab"""
+
+    return [(z, min(z + size, nslices)) for z in range(0, nslices, size)]
+
+
+@contextlib.contextmanager
+def uncompressed(impath, tmpdir):
+
+    """Path of an uncompressed copy of a .nii.gz file, so that it can be memory-mapped and read in any order
+
+    The file is decompressed once (in chunks) into a hidden file in `tmpdir`, which is removed at the end. Uncompressed .nii files are used as they are.
+    """
+
+    if not impath.endswith(".gz"):
+        yield impath
+        return
+
+    tmppath = os.path.join(tmpdir, "." + os.path.basename(impath)[:-3])
+    try:
+        with gzip.open(impath, 'rb') as src, open(tmppath, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 16 * 2**20)
+        yield tmppath
+    finally:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+
+
+# -----------
+# Read
+# -----------
+
+def nifti_slabs(path, size, scaled=True):
+
+    """Read a 3D nifti file (.nii or .nii.gz) slab by slab
+
+    Yields:
+        z0, z1 (int): slices of the slab
+        slab (np.ndarray): (x, y, z1-z0) - scaled as in nibabel (or raw on-disk values if not `scaled`)
+    """
+
+    import nibabel as nb
+
+    # keep the (gzip) file handle open between slabs - slabs are read in order, so the file is only decompressed once
+    imo = nb.load(path, keep_file_open=True)
+    for z0, z1 in slab_ranges(imo.shape[2], size):
+        slicer = (slice(None), slice(None), slice(z0, z1))
+        yield z0, z1, np.asanyarray(imo.dataobj[slicer]) if scaled else imo.dataobj._get_unscaled(slicer)
+
+
+def nrrd_slabs(path, size):
+
+    """Read a 3D .nrrd file (raw or gzip encoding, attached header) slab by slab
+
+    Yields:
+        z0, z1 (int): slices of the slab
+        slab (np.ndarray): (x, y, z1-z0)
+    """
+
+    header = nrrd.read_header(path)
+    assert header['encoding'] in ('raw', 'gzip', 'gz'), f"Only raw and gzip encoded .nrrd files can be read in slabs: {path}"
+    shape = tuple(header['sizes'])
+    dtype = np.dtype(NRRD2NUMPY[header['type']]).newbyteorder('<' if header.get('endian', 'little') == 'little' else '>')
+    slice_bytes = shape[0] * shape[1] * dtype.itemsize
+
+    with open(path, 'rb') as f:
+        f.seek(stackio.data_offset(path))
+        stream = gzip.GzipFile(fileobj=f) if header['encoding'] != 'raw' else f
+        for z0, z1 in slab_ranges(shape[2], size):
+            data = stream.read(slice_bytes * (z1 - z0))
+            assert len(data) == slice_bytes * (z1 - z0), f"Unexpected end of data: {path}"
+            yield z0, z1, np.frombuffer(data, dtype=dtype).reshape(shape[:2] + (z1 - z0,), order='F')
+
+
+def image_slabs(path, size):
+
+    """Read a 3D .nii, .nii.gz or .nrrd file slab by slab (float32, scaled) - see nifti_slabs, nrrd_slabs"""
+
+    slabs = nrrd_slabs(path, size) if path.endswith(".nrrd") else nifti_slabs(path, size)
+    for z0, z1, slab in slabs:
+        yield z0, z1, slab.astype(np.float32, copy=False)
+
+
+def image_shape(path):
+
+    """Shape of a .nii, .nii.gz or .nrrd file (header only)"""
+
+    if path.endswith(".nrrd"):
+        return tuple(nrrd.read_header(path)['sizes'])
+    import nibabel as nb
+    return nb.load(path).shape
+
+
+# -----------
+# Write
+# -----------
+
+def nrrd_head(shape, dtype, header):
+
+    """Attached .nrrd header (gzip encoding) of a 3D volume. Space, space directions, space origin and kinds are copied from `header`"""
+
+    lines = ["NRRD0004",
+             "type: " + NUMPY2NRRD[np.dtype(dtype).str[1:]],
+             "dimension: 3",
+             "sizes: " + " ".join(str(s) for s in shape),
+             "endian: little",
+             "encoding: gzip"]
+    if header.get('space') is not None:
+        lines.append("space: " + header['space'])
+    if header.get('space directions') is not None:
+        lines.append("space directions: " + " ".join(stackio.format_vector(v) for v in np.asarray(header['space directions'])))
+    if header.get('kinds') is not None:
+        lines.append("kinds: " + " ".join(header['kinds']))
+    if header.get('space origin') is not None:
+        lines.append("space origin: " + stackio.format_vector(header['space origin']))
+
+    return ("\n".join(lines) + "\n\n").encode('ascii')
+
+
+def nifti_head(shape, affine, header, dtype, slope_inter=None):
+
+    """Header (with extensions and padding up to the data offset) of a 3D nifti file with on-disk data type `dtype`
+
+    Returns:
+        head (bytes), dtype (np.dtype with the byte order of the header)
+    """
+
+    import nibabel as nb
+
+    # the image is never written - a zero-stride array stands in for the data, so that nibabel fills in the header
+    imo = nb.Nifti1Image(np.broadcast_to(np.zeros((), dtype=dtype), shape), affine=affine, header=header)
+    imo.update_header()
+    hdr = imo.header
+    hdr.set_data_dtype(dtype)
+    if slope_inter is not None:
+        hdr.set_slope_inter(*slope_inter)
+
+    f = io.BytesIO()
+    hdr.write_to(f)
+    f.write(b"\0" * (int(hdr.get_data_offset()) - f.tell()))
+
+    return f.getvalue(), np.dtype(dtype).newbyteorder(hdr.endianness)
+
+
+class SlabWriter:
+
+    """Write a volume slab by slab into a file - slabs must be written in order
+
+    Args:
+        savename (str): output file
+        head (bytes): header written before the data (see nrrd_head, nifti_head)
+        dtype: on-disk data type of the data
+        compress (bool): gzip the data
+        compress_head (bool): gzip the header as well (.nii.gz - the whole file is a gzip stream; .nrrd - only the data is)
+        compresslevel (int): gzip compression level
+    """
+
+    def __init__(self, savename, head, dtype, compress=True, compress_head=False, compresslevel=1):
+        self.dtype = np.dtype(dtype)
+        self.file = open(savename, 'wb')
+        # wbits=31 - gzip container
+        self.zip = zlib.compressobj(compresslevel, zlib.DEFLATED, 31) if compress else None
+        if compress_head:
+            self.file.write(self.zip.compress(head))
+        else:
+            self.file.write(head)
+
+    def write(self, slab):
+        data = np.asarray(slab).astype(self.dtype, copy=False).tobytes(order='F')
+        self.file.write(self.zip.compress(data) if self.zip is not None else data)
+
+    def close(self):
+        if self.zip is not None:
+            self.file.write(self.zip.flush())
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def nrrd_writer(savename, shape, dtype, header, compresslevel=9):
+
+    """SlabWriter of a gzip encoded .nrrd file (same compression level as nrrd.write)"""
+
+    return SlabWriter(savename, nrrd_head(shape, dtype, header), np.dtype(dtype).newbyteorder('<'), compresslevel=compresslevel)
+
+
+def nifti_writer(savename, shape, affine, header, dtype, slope_inter=None, compresslevel=None):
+
+    """SlabWriter of a 3D .nii or .nii.gz file (default compression level - same as nibabel)"""
+
+    import nibabel as nb
+
+    head, dtype = nifti_head(shape, affine, header, dtype, slope_inter)
+    compress = savename.endswith(".gz")
+    compresslevel = nb.openers.Opener.default_compresslevel if compresslevel is None else compresslevel
+    return SlabWriter(savename, head, dtype, compress=compress, compress_head=compress, compresslevel=compresslevel)
@@ -0,0 +1,187 @@
+"""Sort a directory of DICOM files into <output>/<PatientID>/<AccessionNumber>/<SeriesNumber>_<SeriesDescription>/
+
+    Python replacement of the 'sortd' step of retrieve2.sh. Each file is parsed once, and only the four header tags that are needed are read (no pixel data) - instead of four dcmdump calls per file. Headers are read in a pool of threads (or processes), files are then moved in the main process.
+
+    Tag values are formatted as in retrieve2.sh (spaces replaced by '_'). Files with any of the tags missing (or files that are not DICOM) are left where they are. If a file with the same name already exists at the destination, the existing file is kept as a numbered backup (<name>.~1~, <name>.~2~, ..), same as 'mv --backup=t'.
+
+    With '--dry_run', nothing is moved - the planned destination of each file is written to a manifest (.json).
+
+    Retrieval from PACS (findscu / movescu / getscu in retrieve2.sh) is not part of this script.
+
+    Usage:
+        python sort_dicoms.py -d <directory with dicoms>
+        python sort_dicoms.py -d <directory with dicoms> -o <output directory> --workers 16
+        python sort_dicoms.py -d <directory with dicoms> --dry_run --manifest sort_manifest.json
+        python sort_dicoms.py -d <directory with dicoms> --recursive --pool process
+
+"""
+
+import argparse
+import os
+import re
+import json
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import pydicom
+
+
+# tags that define the destination of a file (in order of the output directory levels)
+TAGS = ['PatientID', 'AccessionNumber', 'SeriesNumber', 'SeriesDescription']
+
+
+def load_args():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--directory',type=str, required = True, help='directory with dicom files to be sorted')
+    parser.add_argument('-o', '--output',type=str,default=None,help='output directory (default - same as the input directory)')
+    parser.add_argument('--workers',type=int,default=os.cpu_count(),help='number of parallel workers that read dicom headers')
+    parser.add_argument('--pool',type=str,default='thread',choices=['thread','process'],help='type of the worker pool')
+    parser.add_argument('--recursive',action="store_true",help='if used, files in subdirectories are sorted as well (default - only files directly in the input directory)')
+    parser.add_argument('--dry_run',action="store_true",help='if used, files are not moved - planned destinations are written to the manifest')
+    parser.add_argument('--manifest',type=str,default=None,help='path to .json manifest with the destination of each file (default - sort_manifest.json in the output directory, with --dry_run)')
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+
+    # load input args
+    args = load_args()
+
+    assert os.path.isdir(args.directory), f"not a directory: {args.directory}"
+    outdir = os.path.abspath(args.output or args.directory)
+
+    manifest = args.manifest
+    if manifest is None and args.dry_run:
+        manifest = os.path.join(outdir, "sort_manifest.json")
+
+    sort_dicoms(args.directory, outdir, workers=args.workers, pool=args.pool, recursive=args.recursive, dry_run=args.dry_run, manifest=manifest)
+
+
+def list_files(directory, recursive=False):
+
+    """Files to be sorted (only files directly in `directory`, unless `recursive`)"""
+
+    if not recursive:
+        return sorted(e.path for e in os.scandir(directory) if e.is_file())
+    files = []
+    for root, _, names in os.walk(directory):
+        files.extend(os.path.join(root, n) for n in names)
+    return sorted(files)
+
+
+def format_tag(value):
+
+    """Format a tag value for a directory name (as in retrieve2.sh - spaces replaced by '_')"""
+
+    value = str(value).strip()
+    value = re.sub(r"\s", "_", value)
+    return value.replace("/", "_")
+
+
+def read_tags(path):
+
+    """Read the sorting tags of a dicom file - header only, without pixel data
+
+    Returns:
+        tags (dict): tag name -> formatted value ('' if missing), or None if the file is not a dicom file
+    """
+
+    try:
+        ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=TAGS)
+    except Exception:
+        return None
+    return {tag: format_tag(ds.get(tag, '') or '') for tag in TAGS}
+
+
+def destination(tags, outdir):
+
+    """Destination directory of a file - <outdir>/<patient>/<study>/<seriesnum>_<series>. None if any tag is missing"""
+
+    if tags is None or not all(tags[tag] for tag in TAGS):
+        return None
+    return os.path.join(outdir, tags['PatientID'], tags['AccessionNumber'], tags['SeriesNumber'] + "_" + tags['SeriesDescription'])
+
+
+def backup_name(path):
+
+    """First free numbered backup name of a file (<path>.~1~, <path>.~2~, ..)"""
+
+    n = 1
+    while os.path.exists(f"{path}.~{n}~"):
+        n += 1
+    return f"{path}.~{n}~"
+
+
+def move_file(src, dpath):
+
+    """Move a file into directory `dpath`. An existing file with the same name is kept as a numbered backup. Returns the new path"""
+
+    os.makedirs(dpath, exist_ok=True)
+    dest = os.path.join(dpath, os.path.basename(src))
+    if os.path.abspath(src) == os.path.abspath(dest):
+        return dest
+    if os.path.exists(dest):
+        os.rename(dest, backup_name(dest))
+    os.replace(src, dest)
+
+    return dest
+
+
+def sort_dicoms(directory, outdir, workers=None, pool='thread', recursive=False, dry_run=False, manifest=None):
+
+    """Sort dicom files into <outdir>/<patient>/<study>/<seriesnum>_<series>
+
+    Args:
+        directory (str): directory with dicom files
+        outdir (str): output directory
+        workers (int): number of parallel workers that read dicom headers (default - number of cpus)
+        pool (str): 'thread' or 'process' - type of the worker pool
+        recursive (bool): if True, also sort files in subdirectories of `directory`
+        dry_run (bool): if True, nothing is moved
+        manifest (str): path to .json file where the destination of each file is saved (optional)
+    Returns:
+        records (list): one dict per file - {'file', 'destination', 'status' ('moved', 'planned', 'missing_tags' or 'not_dicom'), and the tags}
+    """
+
+    files = list_files(directory, recursive)
+    print(f"Reading headers of {len(files)} files")
+
+    # read headers in parallel - files are moved afterwards, in order, so that numbered backups are deterministic
+    Executor = ProcessPoolExecutor if pool == 'process' else ThreadPoolExecutor
+    with Executor(workers) as executor:
+        tags = list(executor.map(read_tags, files, chunksize=64 if pool == 'process' else 1))
+
+    records = []
+    for file, t in zip(files, tags):
+        dpath = destination(t, outdir)
+        record = {'file': file, 'destination': None, 'status': None}
+        record.update(t or {})
+        if t is None:
+            record['status'] = 'not_dicom'
+        elif dpath is None:
+            record['status'] = 'missing_tags'
+            print(f"missing dicom info, doing nothing: {file}")
+        elif dry_run:
+            record['destination'] = os.path.join(dpath, os.path.basename(file))
+            record['status'] = 'planned'
+        else:
+            record['destination'] = move_file(file, dpath)
+            record['status'] = 'moved'
+        records.append(record)
+
+    counts = {s: sum(r['status'] == s for r in records) for s in ['moved', 'planned', 'missing_tags', 'not_dicom']}
+    print("Sorted dicoms: " + ", ".join(f"{n} {s}" for s, n in counts.items() if n))
+
+    if manifest is not None:
+        with open(manifest, 'w') as f:
+            json.dump(records, f, indent=2)
+        print(f"Saved manifest to: {manifest}")
+
+    return records
+
+
+if __name__=='__main__':
+
+    main()
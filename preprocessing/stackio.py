@@ -0,0 +1,221 @@
+"""Averaged stack format - all geometric averages of a subject in a single 4D file, and a lazy (memory-mapped) reader
+
+    The stack is a 4D .nrrd file (averaged/averaged_stack.nrrd) with raw (uncompressed) little-endian float32 data and an attached header:
+        sizes            - (b-values, x, y, z) - the b-value axis is the fastest, so the signal vector of each voxel is contiguous on disk
+        kinds            - list domain domain domain
+        space directions - none for the b-value axis, followed by the directions of the averaged volumes
+        space origin     - origin of the averaged volumes
+        bvals:=          - custom field with the b-value of each volume (sorted)
+
+    Any nrrd reader (e.g. nrrd.read, 3D Slicer) can read the stack. load_stack() maps the file into memory instead - nothing is read until it is used, per b-value volumes and per voxel signal vectors are views of the mapped file (no copies).
+
+    The per b-value files (b<bval>_averaged.nrrd) and bvalsFileNames_average.txt are still written - the stack is an additional output.
+
+    Usage:
+        python geometric_averages.py -d <directory> --stack
+        python pipeline.py -f <full path to .nii file> --stack
+
+    or from python:
+
+        import stackio
+        data, bvals, header = stackio.load_stack("averaged/averaged_stack.nrrd")     # data: (b-values, x, y, z) memory map
+        b0 = stackio.bval_volume(data, bvals, 0)                                    # (x, y, z) view
+        signal = data[:, 64, 64, 10]                                                # signal vector of one voxel (view)
+        signals = stackio.masked_signals(data, maskio.load_mask(maskpath, indices=True))   # (voxels, b-values) matrix of voxels inside a mask
+
+"""
+
+import os
+
+import numpy as np
+import nrrd
+
+
+STACK_NAME = "averaged_stack.nrrd"
+
+# nrrd type names of the supported data types
+NRRD_TYPES = {'float32': 'float', 'float64': 'double', 'int16': 'short', 'uint16': 'ushort', 'int32': 'int', 'uint8': 'uchar'}
+
+
+def format_vector(v):
+    return "(" + ",".join(repr(float(x)) for x in v) + ")"
+
+
+def stack_header(shape, bvals, header, dtype=np.float32):
+
+    """Text of the attached nrrd header of a stack
+
+    Args:
+        shape (tuple): shape of a single volume (x,y,z)
+        bvals (list): b-values
+        header (dict): nrrd header of the averaged volumes (space, space directions, space origin are copied if present)
+        dtype: data type of the stack
+    """
+
+    lines = ["NRRD0005",
+             "# averaged stack - see stackio.py",
+             "type: " + NRRD_TYPES[np.dtype(dtype).name],
+             "dimension: 4",
+             "sizes: " + " ".join(str(s) for s in (len(bvals),) + tuple(shape)),
+             "kinds: list domain domain domain",
+             "endian: little",
+             "encoding: raw"]
+    if header.get('space') is not None:
+        lines.append("space: " + header['space'])
+    if header.get('space directions') is not None:
+        lines.append("space directions: none " + " ".join(format_vector(v) for v in np.asarray(header['space directions'])[-3:]))
+    if header.get('space origin') is not None:
+        lines.append("space origin: " + format_vector(header['space origin']))
+    lines.append("bvals:=" + " ".join(str(b) for b in bvals))
+
+    return "\n".join(lines) + "\n\n"
+
+
+def open_stack(shape, bvals, header, savename, dtype=np.float32):
+
+    """Create a stack file and map it into memory for writing - (b-values, x, y, z) array
+
+    Args:
+        shape (tuple): shape of a single volume (x,y,z)
+        bvals (list): b-values (int)
+        header (dict): nrrd header of the averaged volumes
+        savename (str): path to the stack (.nrrd)
+    """
+
+    text = stack_header(shape, bvals, header, dtype).encode('ascii')
+    shape = (len(bvals),) + tuple(shape)
+    with open(savename, 'wb') as f:
+        f.write(text)
+        f.truncate(len(text) + int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    return np.memmap(savename, dtype=np.dtype(dtype).newbyteorder('<'), mode='r+', offset=len(text), shape=shape, order='F')
+
+
+def write_stack(volumes, bvals, header, savename, dtype=np.float32):
+
+    """Write averaged volumes as a single 4D stack
+
+    The file is written one volume at a time into a memory map, so only one volume needs to be in memory (`volumes` can be a generator).
+
+    Args:
+        volumes (iterable): 3D volumes (x,y,z), one per b-value, in the same order as `bvals`
+        bvals (list): b-values (int)
+        header (dict): nrrd header of the averaged volumes
+        savename (str): path to the stack (.nrrd)
+    Returns:
+        savename (str)
+    """
+
+    data = None
+    for i, vol in enumerate(volumes):
+        if data is None:
+            data = open_stack(vol.shape, bvals, header, savename, dtype)
+        data[i] = vol
+    assert data is not None and i == len(bvals)-1, "Number of volumes must be the same as the number of b-values"
+
+    data.flush()
+    del data
+    print(f"Saved averaged stack to: {savename}")
+
+    return savename
+
+
+def write_stack_from_files(files, bvals, savename, memory_budget=None):
+
+    """Write a stack from per b-value .nrrd files (e.g. b0_averaged.nrrd, b50_averaged.nrrd, ..). Files are read one at a time
+
+    If `memory_budget` is given (MB), each file is read in slabs of slices that fit into the budget (see slabs.py) instead of as a whole volume.
+    """
+
+    order = np.argsort(bvals)
+    bvals = [int(bvals[i]) for i in order]
+    files = [files[i] for i in order]
+    header = nrrd.read_header(files[0])
+
+    if memory_budget is None:
+        volumes = (nrrd.read(file)[0] for file in files)
+        return write_stack(volumes, bvals, header, savename)
+
+    # imported here - slabs.py itself uses stackio
+    import slabs
+    shape = tuple(header['sizes'])
+    size = slabs.slab_size(4 * shape[0] * shape[1], memory_budget, shape[2])
+    data = open_stack(shape, bvals, header, savename)
+    for i, file in enumerate(files):
+        for z0, z1, slab in slabs.nrrd_slabs(file, size):
+            data[i, :, :, z0:z1] = slab
+    data.flush()
+    del data
+    print(f"Saved averaged stack to: {savename}")
+
+    return savename
+
+
+def data_offset(path):
+
+    """Position of the data in a .nrrd file with an attached header (the header ends with an empty line)"""
+
+    with open(path, 'rb') as f:
+        head = f.read(1 << 16)
+    end = head.find(b"\n\n")
+    assert end >= 0, f"Could not find the end of the nrrd header: {path}"
+    return end + 2
+
+
+def load_stack(path, mode='r'):
+
+    """Memory-map an averaged stack
+
+    Args:
+        path (str): path to the stack (.nrrd written by write_stack)
+        mode (str): memory map mode ('r' - read only, 'c' - copy on write)
+    Returns:
+        data (np.memmap): (b-values, x, y, z) array mapped to the file
+        bvals (np.ndarray): b-value of each volume
+        header (dict): nrrd header
+    """
+
+    assert os.path.exists(path), f"Stack does not exist: {path}"
+
+    header = nrrd.read_header(path)
+    assert header['encoding'] == 'raw', f"Only raw (uncompressed) stacks can be memory-mapped: {path}"
+    assert 'bvals' in header, f"No b-values in the header: {path}"
+
+    types = {v: k for k, v in NRRD_TYPES.items()}
+    dtype = np.dtype(types[header['type']]).newbyteorder('<' if header.get('endian', 'little') == 'little' else '>')
+    bvals = np.array([float(b) for b in header['bvals'].split()])
+    data = np.memmap(path, dtype=dtype, mode=mode, offset=data_offset(path), shape=tuple(header['sizes']), order='F')
+
+    return data, bvals, header
+
+
+def volume_header(header):
+
+    """nrrd header of a single volume (x,y,z) of the stack - e.g. to save maps computed from the stack"""
+
+    volume = {}
+    for field in ['space', 'space origin']:
+        if header.get(field) is not None:
+            volume[field] = header[field]
+    if header.get('space directions') is not None:
+        volume['space directions'] = np.asarray(header['space directions'])[-3:]
+    return volume
+
+
+def bval_volume(data, bvals, bval):
+
+    """Volume (x,y,z) of a given b-value (a view of the stack)"""
+
+    i = np.flatnonzero(np.asarray(bvals) == bval)
+    assert i.size, f"b-value {bval} not found in the stack: {bvals}"
+    return data[i[0]]
+
+
+def masked_signals(data, idx):
+
+    """Signal vectors of voxels given by flat (C-order) indices (see maskio.load_mask) - (voxels, b-values) array
+
+    Only the selected voxels are read from disk. Unlike single voxels (data[:, i, j, k]), a selection of voxels is a copy.
+    """
+
+    coords = np.unravel_index(idx, data.shape[1:])
+    return np.asarray(data[(slice(None),) + coords]).T
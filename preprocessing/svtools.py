@@ -1,8 +1,15 @@
 import subprocess
+import asyncio
 import os 
+import time 
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import nrrd 
+import numpy as np 
 
-import SimpleITK as sitk
+import instrument
+
+# SimpleITK and nibabel are imported inside the functions that use them - they are slow to import, and most callers (e.g. execute, nifti2nrrd_header) do not need them
 
 
 # -----------
@@ -11,33 +18,106 @@ import SimpleITK as sitk
 
 
 def execute(cmd,sudo=False):
-    """Execute commands in bash and print output to stdout directly"""
+    """Execute commands in bash and print output to stdout directly (many commands at once - see execute_many)"""
 
     if sudo:
         cmd = ["sudo"]+cmd
+    start = time.time()
     with subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=1, universal_newlines=True) as p:
         for line in p.stdout:
             print(line, end='') # process line here
 
+    # wall time of the command (recorded only if instrumentation is on - see instrument.py)
+    instrument.add_subprocess(cmd, time.time() - start, p.returncode)
+
     if p.returncode != 0:
         raise subprocess.CalledProcessError(p.returncode, p.args)
+
+async def run_command(cmd, semaphore, prefix=None, timeout=None, echo=True):
+
+    """Run a single command once a slot of the semaphore is free. Output is captured line by line (and echoed with an optional prefix)"""
+
+    async with semaphore:
+        start = time.time()
+        try:
+            proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        except OSError as e:
+            # e.g. binary not found - reported like a failed command (return code 127, as in bash)
+            print(f"[{prefix}] {e}" if prefix else str(e), flush=True)
+            return {'prefix': prefix, 'cmd': cmd, 'returncode': 127, 'timed_out': False, 'time': 0., 'output': [], 'error': str(e)}
+        output = []
+
+        async def read_output():
+            async for line in proc.stdout:
+                line = line.decode(errors='replace').rstrip('\n')
+                output.append(line)
+                if echo:
+                    print(f"[{prefix}] {line}" if prefix else line, flush=True)
+            return await proc.wait()
+
+        timed_out = False
+        try:
+            returncode = await asyncio.wait_for(read_output(), timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            proc.kill()
+            returncode = await proc.wait()
+            print(f"[{prefix}] TIMEOUT after {timeout}s: {' '.join(cmd)}" if prefix else f"TIMEOUT after {timeout}s: {' '.join(cmd)}", flush=True)
+
+    seconds = time.time() - start
+
+    # wall time of the command (recorded only if instrumentation is on - see instrument.py)
+    instrument.add_subprocess(cmd, seconds, returncode)
+
+    return {'prefix': prefix, 'cmd': cmd, 'returncode': returncode, 'timed_out': timed_out, 'time': round(seconds, 3), 'output': output, 'error': None}
+
+async def run_commands(jobs, max_concurrent, timeout, echo):
+
+    semaphore = asyncio.Semaphore(max_concurrent)
+    return await asyncio.gather(*(run_command(cmd, semaphore, prefix, timeout, echo) for prefix, cmd in jobs))
+
+def execute_many(cmds, max_concurrent=None, timeout=None, sudo=False, echo=True):
+
+    """Execute many commands concurrently (e.g. averageBVals for every subject of a cohort)
+
+    At most `max_concurrent` commands run at a time. A failed (or timed out) command does not stop the others.
+
+    Args:
+        cmds (list): commands (lists of arguments) - or (prefix, command) pairs, where prefix (e.g. subject name) is added to each line of output
+        max_concurrent (int): maximum number of commands running at the same time (default - number of cpus)
+        timeout (float): commands running longer than `timeout` seconds are killed (default - no timeout)
+        sudo (bool): run commands with sudo
+        echo (bool): print output of the commands as it arrives
+    Returns:
+        results (list): one dict per command (same order) - {'prefix', 'cmd', 'returncode', 'timed_out', 'time' (s), 'output' (list of lines), 'error' (message if the command could not be started)}
+    """
+
+    jobs = [c if isinstance(c, tuple) else (None, c) for c in cmds]
+    jobs = [(prefix, ["sudo"]+list(cmd) if sudo else list(cmd)) for prefix, cmd in jobs]
+    results = asyncio.run(run_commands(jobs, max_concurrent or os.cpu_count(), timeout, echo))
+
+    failed = [r for r in results if r['returncode'] != 0]
+    if len(results) > 1:
+        print(f"Executed {len(results)} commands: {len(results)-len(failed)} succeeded, {len(failed)} failed")
+        for r in failed:
+            reason = "timed out" if r['timed_out'] else f"return code {r['returncode']}"
+            print(f"FAILED ({reason}): {r['prefix'] or ''} {' '.join(r['cmd'])}")
+
+    return results
         
 # -----------
 # File conversion 
 # -----------
 
-def svconvert(file,newformat, verbose=True, skip_existing=False):
+def get_newfile(file, newformat):
 
-    """Convert between MRI formats: nrrd, nii, vtk"""
+    """Get path of the converted file (e.g. b0.nii.gz, .nrrd -> b0.nrrd)"""
 
     # check if format is correct 
     formats=[".nrrd", ".nii.gz", ".nii", ".vtk"]
     newformat = "." + newformat if not newformat.startswith(".") else newformat
     assert newformat in formats, f"Incorrect conversion format: {newformat}. Only accept: {formats}"
 
-    # check file 
-    assert os.path.exists(file), f"File does not exist: {file}"
-
     # output 
     base, ext = os.path.splitext(file)
     if ext == '.gz':
@@ -47,17 +127,149 @@ def svconvert(file,newformat, verbose=True, skip_existing=False):
     # assert extension 
     assert ext in formats, f"Incorrect extension fetched: {ext}. Allowed formats: {formats}"
 
+    return base + newformat
+
+def is_up_to_date(file, newfile):
+    
+    """Check if converted file exists and is newer than the source file"""
+    
+    return os.path.exists(newfile) and os.path.getmtime(newfile) >= os.path.getmtime(file)
+
+def svconvert(file,newformat, verbose=True, skip_existing=False):
+
+    """Convert between MRI formats: nrrd, nii, vtk"""
+
+    # check file 
+    assert os.path.exists(file), f"File does not exist: {file}"
+    newfile = get_newfile(file, newformat)
+
+    # check output before reading the input 
+    if os.path.exists(newfile) and skip_existing:
+        print(f"File already exists, skipping")
+        return 
+    
     # read 
+    import SimpleITK as sitk
     img = sitk.ReadImage(file)
 
     # write 
-    newfile=file.replace(ext, newformat)
-    if os.path.exists(newfile) and skip_existing:
-        print(f"File already exists, skipping")
-    else:
-        sitk.WriteImage(img,newfile)
+    sitk.WriteImage(img,newfile)
+
+    if verbose:
+        print(f"Converted: {file} to {newformat}")
+
+def svconvert_batch(jobs, workers=None, verbose=True, skip_existing=True):
 
-        if verbose:
-            print(f"Converted: {file} to {newformat}")
+    """Convert many files between MRI formats (nrrd, nii, vtk) in a thread pool 
+    
+    SimpleITK releases the GIL while reading / writing, so conversions run in parallel. 
+    
+    Args: 
+        jobs (list): list of (file, newformat) pairs, e.g. [("b0#_0.nii.gz", ".nrrd"), ..]
+        workers (int): number of threads (default - number of cpus)
+        verbose (bool): print a line per file 
+        skip_existing (bool): if True, files whose converted output is already up to date (exists and is newer than the source) are skipped without being read 
+    Returns: 
+        results (list): one dict per job - {'file', 'newfile', 'status' ('converted' or 'skipped'), 'time' (seconds)}
+    """
+    
+    import SimpleITK as sitk
+    
+    def convert(job): 
+        file, newformat = job 
+        start = time.time()
+        assert os.path.exists(file), f"File does not exist: {file}"
+        newfile = get_newfile(file, newformat)
+        if skip_existing and is_up_to_date(file, newfile): 
+            status = 'skipped'
+        else: 
+            sitk.WriteImage(sitk.ReadImage(file), newfile)
+            status = 'converted'
+        result = {'file': file, 'newfile': newfile, 'status': status, 'time': round(time.time()-start, 3)}
+        if verbose: 
+            print(f"{status.capitalize()}: {file} -> {newfile} ({result['time']}s)")
+        return result 
+    
+    with ThreadPoolExecutor(workers) as executor: 
+        results = list(executor.map(convert, jobs))
+    
+    return results 
         
 
+# -----------
+# Read / write images as numpy arrays 
+# -----------
+
+@contextmanager
+def atomic_write(path):
+
+    """Write a file atomically - yields a temporary path (same directory and extension) that replaces `path` only once the block finishes without error
+
+    Final outputs (e.g. mask.nrrd) never exist half-written, so their existence means that they are complete (see run_cohort.outputs_exist)
+
+    Usage:
+        with sv.atomic_write(savename) as tmp:
+            nrrd.write(tmp, mask, header=header)
+    """
+
+    root, ext = os.path.splitext(path)
+    tmp = root + ".tmp" + str(os.getpid()) + ext
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def nifti2nrrd_header(affine):
+    
+    """Build .nrrd header (space directions and origin) from a nifti affine 
+    
+    Nifti affine is defined in RAS space, while .nrrd files are written in LPS space (same as SimpleITK conversion)
+    """
+    
+    lps = np.diag([-1.,-1.,1.]) @ affine[:3,:]
+    header = {'space': 'left-posterior-superior', 
+              'space directions': lps[:,:3].T, 
+              'space origin': lps[:,3], 
+              'kinds': ['domain','domain','domain']}
+    return header 
+
+def read_image(file, dtype=np.float32):
+    
+    """Read .nrrd, .nii or .nii.gz file into a numpy array 
+    
+    Args: 
+        file (str): path to image 
+        dtype: data type of the returned array 
+    Returns: 
+        im (np.ndarray): image array in (x,y,z) order 
+        header (dict): .nrrd header that can be used to write the array (or a derived array) with nrrd.write
+    """
+    
+    assert os.path.exists(file), f"File does not exist: {file}"
+    
+    if file.endswith(".nrrd"):
+        im, header = nrrd.read(file)
+    elif file.endswith(".nii") or file.endswith(".nii.gz"):
+        import nibabel as nb
+        imo = nb.load(file)
+        im = np.asanyarray(imo.dataobj)
+        header = nifti2nrrd_header(imo.affine)
+    else: 
+        raise ValueError(f"Incorrect file format: {file}. Only accept: .nrrd, .nii, .nii.gz")
+    
+    return im.astype(dtype, copy=False), header
+
+def read_header(file):
+    
+    """Read the .nrrd header of a .nrrd, .nii or .nii.gz file (header only - see read_image)"""
+    
+    assert os.path.exists(file), f"File does not exist: {file}"
+    
+    if file.endswith(".nrrd"):
+        return nrrd.read_header(file)
+    elif file.endswith(".nii") or file.endswith(".nii.gz"):
+        import nibabel as nb
+        return nifti2nrrd_header(nb.load(file).affine)
+    raise ValueError(f"Incorrect file format: {file}. Only accept: .nrrd, .nii, .nii.gz")
@@ -0,0 +1,71 @@
+"""Tests of run_cohort.run_pool - a worker that dies fails only its own item, every other item is still yielded exactly once
+
+    Usage:
+        python -m pytest test_run_pool.py
+"""
+
+import os
+import time
+
+from run_cohort import run_pool
+
+
+CRASH = 5
+
+
+def crash_or_square(x, tmpdir, delay=0.02):
+
+    """x*x - or kill the worker process if x == CRASH. Start and end times of the call are written to <tmpdir>/<x>_<pid>.txt"""
+
+    start = time.time()
+    time.sleep(delay)
+    if x == CRASH:
+        os._exit(1)
+    with open(os.path.join(tmpdir, f"{x}_{os.getpid()}_{start}.txt"), 'w') as f:
+        f.write(f"{start} {time.time()}")
+    return x * x
+
+
+def max_concurrent(tmpdir):
+
+    """Largest number of calls that ran at the same time (from the start and end times written by crash_or_square)"""
+
+    events = []
+    for name in os.listdir(tmpdir):
+        with open(os.path.join(tmpdir, name)) as f:
+            start, end = map(float, f.read().split())
+        events += [(start, 1), (end, -1)]
+    n = peak = 0
+    for _, d in sorted(events):
+        n += d
+        peak = max(peak, n)
+    return peak
+
+
+def test_crash_fails_only_its_item(tmp_path):
+
+    items = list(range(40))
+    seen = []
+    for i, result, error in run_pool(crash_or_square, items, 2, (str(tmp_path),)):
+        seen.append(i)
+        if items[i] == CRASH:
+            assert result is None and 'BrokenProcessPool' in error
+        else:
+            assert error is None and result == items[i] ** 2
+
+    assert sorted(seen) == items
+
+
+def test_workers_limit_after_crash(tmp_path):
+
+    workers = 3
+    results = list(run_pool(crash_or_square, list(range(12)), workers, (str(tmp_path), 0.2)))
+
+    assert sorted(i for i, _, _ in results) == list(range(12))
+    assert max_concurrent(str(tmp_path)) <= workers
+
+
+def test_no_crash(tmp_path):
+
+    results = {i: result for i, result, error in run_pool(crash_or_square, [1, 2, 3], 2, (str(tmp_path),))}
+    assert results == {0: 1, 1: 4, 2: 9}
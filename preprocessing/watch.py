@@ -0,0 +1,406 @@
+"""Watch an intake directory and preprocess incoming scans (scan -> averaged b-value files + mask) as soon as they arrive
+
+    The intake directory is scanned every '--interval' seconds (recursively) for two kinds of scans:
+        nifti   - a 4D .nii / .nii.gz file with a corresponding .bval file (i.e. output of dcm2niix). Processed with pipeline.py - outputs are written to <dir>/averaged/
+        dicom   - a directory of DICOM files of a single DWI series (e.g. sorted by sort_dicoms.py). Processed with dicom_to_volumes.py (--average) and create_masks.py - outputs are written to <series>/volumes/averaged/
+
+    A scan is queued once its files have not changed for '--settle' seconds (so that files that are still being copied are not read). Scans whose mask is newer than all of their files are considered processed and are skipped (also after a restart of the service). A scan that changes after it was processed (e.g. re-exported) is processed again.
+
+    Scans are processed by a pool of worker processes that stay alive for the whole run - nibabel, SimpleITK, opencv and pydicom (and the preprocessing modules) are imported once per worker when the pool starts, not once per scan.
+
+    The state of the service is written to a status file (.json, rewritten after every change) and optionally served as JSON on a local HTTP endpoint (http://127.0.0.1:<port>/status):
+        queue_depth     - scans waiting for a free worker
+        running         - scans being processed
+        done / failed   - number of processed / failed scans
+        latency         - seconds from detection of a (settled) scan to its mask - last, mean and max
+        jobs            - most recent scans with their status, timings and errors
+
+    A failed scan is not retried until its files change. If a worker process dies (e.g. out of memory), the pool is replaced and every scan that was running in it is retried once in a pool of its own - only a scan that crashes its own pool as well is failed.
+
+    Usage:
+        python watch.py -d <intake directory>
+        python watch.py -d <intake directory> --workers 4 --interval 10 --settle 30 --port 8765
+        python watch.py -d <intake directory> --status /tmp/ivim_watch_status.json --protocol <protocol .txt file>
+        python watch.py -d <intake directory> --once
+
+"""
+
+import argparse
+import os
+import sys
+import json
+import time
+import signal
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# directories written by the preprocessing itself - never scanned for new scans
+OUTPUT_DIRS = {'averaged', 'volumes'}
+
+# number of finished jobs kept in the status
+HISTORY = 200
+
+
+def load_args():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--directory',type=str, required = True, help='intake directory to watch')
+    parser.add_argument('--workers',type=int,default=2,help='number of worker processes (scans processed in parallel)')
+    parser.add_argument('--interval',type=float,default=10,help='seconds between scans of the intake directory')
+    parser.add_argument('--settle',type=float,default=30,help='a scan is queued once its files did not change for this many seconds')
+    parser.add_argument('--status',type=str,default=None,help='path to the status file (.json) - default: .ivim_watch_status.json in the intake directory')
+    parser.add_argument('--port',type=int,default=None,help='if used, the status is also served on http://127.0.0.1:<port>/status')
+    parser.add_argument('--masktype',type=str,default='improved',choices=['improved','simple','dummy'],help='type of mask to create')
+    parser.add_argument('--protocol',type=str,default=None,help='.txt file with the b-values given to the scanner (one per volume) - b-values of every scan are checked and corrected against it (see process_nifti.correct_bvals)')
+    parser.add_argument('--noabsolute',action="store_true",help='if used, the paths of b-value files written to .txt files will be relative, not absolute')
+    parser.add_argument('--once',action="store_true",help='if used, process the scans that are in the intake directory and exit')
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+
+    # load input args
+    args = load_args()
+
+    assert os.path.isdir(args.directory), f"not a directory: {args.directory}"
+    status_path = args.status or os.path.join(args.directory, ".ivim_watch_status.json")
+    options = {'masktype': args.masktype,
+               'protocol': args.protocol and os.path.abspath(args.protocol),
+               'filepaths_type': 'relative' if args.noabsolute else 'absolute'}
+
+    # stop cleanly on 'kill' as well as on ctrl+c
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    watch(args.directory, options, workers=args.workers, interval=args.interval, settle=args.settle, status_path=status_path, port=args.port, once=args.once)
+
+
+# -----------
+# Find scans
+# -----------
+
+def bval_path(impath):
+    return impath.replace(".nii.gz", ".bval") if impath.endswith(".nii.gz") else impath.replace(".nii", ".bval")
+
+
+def is_dicom(path):
+
+    """Check the DICM magic number of a file (without parsing it)"""
+
+    try:
+        with open(path, 'rb') as f:
+            f.seek(128)
+            return f.read(4) == b"DICM"
+    except OSError:
+        return False
+
+
+def find_scans(directory):
+
+    """Find scans in the intake directory
+
+    Returns:
+        scans (dict): path of the scan (4D file, or directory of a dicom series) -> {'kind': 'nifti' or 'dicom', 'files': files of the scan}
+    """
+
+    scans = {}
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if d not in OUTPUT_DIRS and not d.startswith('.'))
+        names = sorted(n for n in names if not n.startswith('.'))
+        paths = [os.path.join(root, n) for n in names]
+
+        niftis = [p for p in paths if (p.endswith(".nii.gz") or p.endswith(".nii")) and os.path.exists(bval_path(p))]
+        for p in niftis:
+            scans[p] = {'kind': 'nifti', 'files': [p, bval_path(p)]}
+
+        # a dicom series - checking the first file is enough for a sorted series
+        if not niftis and paths and not dirs and is_dicom(paths[0]):
+            scans[root] = {'kind': 'dicom', 'files': paths}
+
+    return scans
+
+
+def signature(files):
+
+    """Signature of the files of a scan - changes while files are being copied / added"""
+
+    sizes, mtime = 0, 0
+    for f in files:
+        try:
+            st = os.stat(f)
+        except OSError:
+            continue
+        sizes += st.st_size
+        mtime = max(mtime, st.st_mtime)
+    return [len(files), sizes, mtime]
+
+
+def mask_path(path, kind):
+
+    """Path of the mask - the final output of a scan"""
+
+    if kind == 'nifti':
+        return os.path.join(os.path.dirname(path), "averaged", "mask.nrrd")
+    return os.path.join(path, "volumes", "averaged", "mask.nrrd")
+
+
+def is_processed(path, kind, sig):
+
+    """Check if the mask of a scan exists and is newer than all files of the scan"""
+
+    mask = mask_path(path, kind)
+    return os.path.exists(mask) and os.path.getmtime(mask) >= sig[2]
+
+
+# -----------
+# Workers
+# -----------
+
+def warm_up():
+
+    """Initializer of the worker processes - heavy modules are imported once per worker, before the first scan arrives"""
+
+    import nibabel
+    import SimpleITK
+    import cv2
+    import pydicom
+    import pipeline
+    import create_masks
+    import dicom_to_volumes
+
+
+def process_scan(path, kind, options):
+
+    """Process a single scan (in a worker process). Never raises - errors are returned in the result"""
+
+    result = {'status': None, 'started': time.time(), 'finished': None, 'error': None, 'mask': mask_path(path, kind)}
+    try:
+        import process_nifti as pn
+        protocol = pn.read_protocol(options['protocol']) if options['protocol'] else None
+
+        if kind == 'nifti':
+            import pipeline
+            bvals = pn.get_bvector(bval_path(path))
+            if protocol is not None:
+                bvals = pn.correct_bvals(bvals, protocol)
+            pipeline.run_pipeline(path, bvals, masktype=options['masktype'], filepaths_type=options['filepaths_type'])
+        else:
+            import dicom_to_volumes as dv
+            import create_masks as cm
+            outputdir = os.path.join(path, "volumes") + "/"
+            os.makedirs(outputdir, exist_ok=True)
+            dv.convert_series(path, outputdir, protocol=protocol, average=True, filepaths_type=options['filepaths_type'])
+            cm.process_b0_image(outputdir + "averaged/b0_averaged.nrrd", masktype=options['masktype'])
+        result['status'] = 'done'
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    result['finished'] = time.time()
+
+    return result
+
+
+# -----------
+# Status
+# -----------
+
+class StatusHandler(BaseHTTPRequestHandler):
+
+    """Serve the current status as JSON (GET /status)"""
+
+    status = {}
+    lock = threading.Lock()
+
+    def do_GET(self):
+        if self.path.rstrip('/') not in ('', '/status'):
+            self.send_error(404)
+            return
+        with self.lock:
+            body = json.dumps(self.status, indent=2).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port):
+
+    """Serve the status on http://127.0.0.1:<port>/status in a background thread"""
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), StatusHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving status on http://127.0.0.1:{port}/status")
+    return server
+
+
+def build_status(intake, workers, pending, running, finished, counts, started):
+
+    """Status of the service (see the module docstring)"""
+
+    latencies = [j['latency'] for j in finished if j.get('latency') is not None]
+    return {'intake': os.path.abspath(intake),
+            'pid': os.getpid(),
+            'workers': workers,
+            'started': started,
+            'updated': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'queue_depth': len(pending),
+            'running': len(running),
+            'done': counts['done'],
+            'failed': counts['failed'],
+            'latency': {'last': latencies[-1] if latencies else None,
+                        'mean': round(sum(latencies) / len(latencies), 2) if latencies else None,
+                        'max': max(latencies) if latencies else None},
+            'jobs': list(pending) + list(running.values()) + list(reversed(finished))}
+
+
+def write_status(status, status_path):
+
+    """Write the status file atomically (readers never see a partial file) and update the HTTP endpoint"""
+
+    with StatusHandler.lock:
+        StatusHandler.status = status
+    tmp = status_path + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump(status, f, indent=2)
+    os.replace(tmp, status_path)
+
+
+# -----------
+# Main loop
+# -----------
+
+def watch(intake, options, workers=2, interval=10, settle=30, status_path=None, port=None, once=False):
+
+    """Watch the intake directory and process scans as they arrive
+
+    Args:
+        intake (str): directory to watch
+        options (dict): {'masktype', 'protocol' (path or None), 'filepaths_type'} - passed to process_scan
+        workers (int): number of worker processes
+        interval (float): seconds between scans of the intake directory
+        settle (float): a scan is queued once its files did not change for this many seconds
+        status_path (str): path to the status file (.json)
+        port (int): if given, the status is also served on http://127.0.0.1:<port>/status
+        once (bool): if True, return once all scans currently in the intake directory are processed
+    Returns:
+        counts (dict): number of 'done' and 'failed' scans
+    """
+
+    status_path = status_path or os.path.join(intake, ".ivim_watch_status.json")
+    started = time.strftime("%Y-%m-%dT%H:%M:%S")
+    if port is not None:
+        start_server(port)
+
+    seen = {}           # path -> {'signature', 'since'} - scans that are not yet settled (or not yet queued)
+    handled = {}        # path -> signature when it was queued
+    pending = deque()   # jobs waiting for a worker
+    running = {}        # future -> job
+    own = {}            # future -> pool of its own (scans retried after a worker died)
+    finished = deque(maxlen=HISTORY)
+    counts = {'done': 0, 'failed': 0}
+
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=warm_up)
+    print(f"Watching {os.path.abspath(intake)} with {workers} workers (status: {status_path})")
+    try:
+        while True:
+            now = time.time()
+            changed = False
+
+            # 1. new or changed scans
+            unsettled = 0
+            for path, scan in find_scans(intake).items():
+                sig = signature(scan['files'])
+                if handled.get(path) == sig:
+                    continue
+                if path not in seen or seen[path]['signature'] != sig:
+                    seen[path] = {'signature': sig, 'since': now}
+                if now - seen[path]['since'] < settle:
+                    unsettled += 1
+                    continue
+                del seen[path]
+                handled[path] = sig
+                if is_processed(path, scan['kind'], sig):
+                    continue
+                pending.append({'scan': path, 'kind': scan['kind'], 'status': 'queued', 'detected': now, 'started': None, 'finished': None, 'latency': None, 'error': None})
+                print(f"Queued {scan['kind']} scan: {path}")
+                changed = True
+
+            # 2. hand queued scans to free workers
+            while pending and len(running) < workers:
+                job = pending.popleft()
+                job['status'] = 'running'
+                if job.get('isolated'):
+                    # suspected of crashing a worker - a crash breaks only its own pool
+                    pool = ProcessPoolExecutor(max_workers=1, initializer=warm_up)
+                    future = pool.submit(process_scan, job['scan'], job['kind'], options)
+                    own[future] = pool
+                else:
+                    future = executor.submit(process_scan, job['scan'], job['kind'], options)
+                running[future] = job
+                changed = True
+
+            # 3. collect finished scans
+            broken, retry = False, []
+            for future in [f for f in running if f.done()]:
+                job = running.pop(future)
+                pool = own.pop(future, None)
+                if pool is not None:
+                    pool.shutdown(wait=False)
+                try:
+                    job.update(future.result())
+                except BrokenProcessPool:
+                    if pool is None:
+                        # a worker of the shared pool died (e.g. out of memory) - the pool is replaced below. It is not known which scan crashed it, so each scan that was running is retried in a pool of its own
+                        broken = True
+                        job.update({'status': 'queued', 'isolated': True})
+                        retry.append(job)
+                        print(f"Worker died - retrying on its own: {job['scan']}")
+                        changed = True
+                        continue
+                    job.update({'status': 'failed', 'finished': time.time(), 'error': traceback.format_exc()})
+                except Exception:
+                    job.update({'status': 'failed', 'finished': time.time(), 'error': traceback.format_exc()})
+                job['latency'] = round(job['finished'] - job['detected'], 2)
+                counts[job['status']] += 1
+                finished.append(job)
+                print(f"{job['status'].capitalize()} ({job['latency']}s): {job['scan']}" + (f"\n{job['error']}" if job['error'] else ""))
+                changed = True
+
+            pending.extendleft(reversed(retry))
+            if broken:
+                executor.shutdown(wait=False)
+                executor = ProcessPoolExecutor(max_workers=workers, initializer=warm_up)
+
+            if changed or not os.path.exists(status_path):
+                write_status(build_status(intake, workers, pending, running, finished, counts, started), status_path)
+
+            if once and not pending and not running and not unsettled:
+                break
+            time.sleep(interval if not running else min(interval, 1))
+    finally:
+        # scans that have not started yet are cancelled (cancel() does nothing to running ones), running scans are finished
+        for future in running:
+            future.cancel()
+        executor.shutdown()
+        for pool in own.values():
+            pool.shutdown()
+        write_status(build_status(intake, workers, pending, running, finished, counts, started), status_path)
+
+    print(f"Processed {counts['done'] + counts['failed']} scans: {counts['done']} done, {counts['failed']} failed")
+
+    return counts
+
+
+if __name__=='__main__':
+
+    main()